@@ -1,133 +1,289 @@
-import boto3
-import logging
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+import botocore.exceptions
+import hashlib
 import json
 import os
+import time
+from sechub_common.init import get_client, get_resource, preinit
+from sechub_common.logs import log_sampling_summary, setup_logging, summarize
+from sechub_common.metrics import flush as flush_metrics, timed
+from sechub_common.pagination import scan_table
 
 
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+logger = setup_logging()
 
+# clients are created during the Lambda init phase and reused by warm invocations
+preinit("dynamodb", "s3", "stepfunctions")
 
-def put_item(control_data, table_name):
-    #API expect data in dictionary format
-    database = boto3.resource('dynamodb')
-    table = database.Table(table_name)
-    table.put_item(Item=control_data)
+# BatchWriteItem accepts up to 25 requests per call
+MAX_BATCH_WRITE_SIZE = 25
+MAX_BATCH_WRITE_ATTEMPTS = 8
+PENDING_KEY = {"StateKey": {"S": "pending"}}
 
 
-def update_item(control_data, table_name):
-    database = boto3.resource('dynamodb')
-    table = database.Table(table_name)
-    if "Enabled" in control_data:
-        table.update_item(
-            Key={
-                'ControlId': control_data['ControlId']
-            },
-            UpdateExpression='REMOVE Disabled SET Enabled = :val1',
-            ExpressionAttributeValues={
-                ':val1': control_data["Enabled"]
-            }
-        )
-    elif "Disabled" in control_data:
-        table.update_item(
-            Key={
-                'ControlId': control_data['ControlId']
-            },
-            UpdateExpression='REMOVE Enabled SET Disabled = :val1, DisabledReason = :val2',
-            ExpressionAttributeValues={
-                ':val1': control_data["Disabled"],
-                ':val2': control_data["DisabledReason"]
-            }
-        )
-    else:
-        logger.info("%s at least one attribute is required", control_data)
-
-
-def item_update(account_data, table_name):
-    database = boto3.resource('dynamodb')
-    table = database.Table(table_name)
-    table.update_item(
-            Key={
-                'AccountId': account_data['AccountId']
-            },
-            UpdateExpression='SET Regions = :val1',
-            ExpressionAttributeValues={
-                ':val1': account_data["Regions"]
-            }
-        )
+def diff_items(items, data, item_type):
+    """
+    Compare items of data with the items of the DDB table. Return items to be written, keys to be deleted and
+    keys of unchanged items.
+    """
+    deserializer = TypeDeserializer()
+    items_in_ddb = dict()
+    for item in items:
+        items_in_ddb[item[item_type]["S"]] = {key: deserializer.deserialize(value) for key, value in item.items()}
+    keys_in_data = set(entry[item_type] for entry in data)
+    to_write = [entry for entry in data if items_in_ddb.get(entry[item_type]) != entry]
+    to_delete = [key for key in items_in_ddb if key not in keys_in_data]
+    unchanged = [entry[item_type] for entry in data if items_in_ddb.get(entry[item_type]) == entry]
+    counts = {
+        "added": len([entry for entry in to_write if entry[item_type] not in items_in_ddb]),
+        "updated": len([entry for entry in to_write if entry[item_type] in items_in_ddb]),
+        "deleted": len(to_delete),
+        "unchanged": len(unchanged),
+    }
+    return to_write, to_delete, counts
+
+
+def batch_write(client, table_name, requests):
+    """
+    Write requests with BatchWriteItem in batches of MAX_BATCH_WRITE_SIZE and retry unprocessed items
+    """
+    for start in range(0, len(requests), MAX_BATCH_WRITE_SIZE):
+        batch = requests[start:start + MAX_BATCH_WRITE_SIZE]
+        attempt = 1
+        while batch:
+            response = client.batch_write_item(RequestItems={table_name: batch})
+            batch = response.get("UnprocessedItems", {}).get(table_name, [])
+            if batch:
+                if attempt >= MAX_BATCH_WRITE_ATTEMPTS:
+                    raise RuntimeError("{} items of {} could not be written".format(len(batch), table_name))
+                logger.info("Retry %s unprocessed items of %s", len(batch), table_name)
+                time.sleep(min(2 ** attempt * 0.1, 5))
+                attempt += 1
+
+
+def diff_hashes(item_hashes, data, hashes, item_type):
+    """
+    Compare items of data with the item hashes recorded by the previous ingest of the file. Return items to be
+    written, keys to be deleted and counts like diff_items, without reading the DDB table.
+    """
+    to_write = [entry for entry in data if item_hashes.get(entry[item_type]) != hashes[entry[item_type]]]
+    to_delete = [key for key in item_hashes if key not in hashes]
+    counts = {
+        "added": len([entry for entry in to_write if entry[item_type] not in item_hashes]),
+        "updated": len([entry for entry in to_write if entry[item_type] in item_hashes]),
+        "deleted": len(to_delete),
+        "unchanged": len(data) - len(to_write),
+    }
+    return to_write, to_delete, counts
+
+
+def write_changes(to_write, to_delete, counts, data, table_name, item_type):
+    """
+    Write to_write and delete to_delete in the DDB table. Return keys of added, updated and deleted items and counts.
+    """
+    if not data and to_delete:
+        # an empty file is more likely a mistake than the intention to remove all exceptions or accounts
+        logger.warning("%s is empty in file, keeping %s items in DDB table", table_name, len(to_delete))
+        to_delete = []
+        counts["deleted"] = 0
+    serializer = TypeSerializer()
+    requests = [
+        {"PutRequest": {"Item": {key: serializer.serialize(value) for key, value in entry.items()}}}
+        for entry in to_write
+    ] + [
+        {"DeleteRequest": {"Key": {item_type: {"S": key}}}}
+        for key in to_delete
+    ]
+    batch_write(get_client("dynamodb"), table_name, requests)
+    logger.info("%s: %s", table_name, counts)
+    return [entry[item_type] for entry in to_write] + to_delete, counts
 
 
 def process_item(items, data, table_name, item_type):
-    items_in_ddb = []
-    for item in items['Items']:
-        logger.info("%s items", items['Items'])
-        items_in_ddb.append(item[item_type]["S"])
-    for control in data:
-        if control[item_type] in items_in_ddb:
-            logger.info("%s item in DDB table updating", control[item_type])
-            if item_type == "ControlId":
-                update_item(control, table_name)
-            else:
-                item_update(control, table_name)
-        else:
-            logger.info("%s item not in DDB table adding", control[item_type])
-            put_item(control, table_name)
-
-
-def get_s3_data(bucket, json_file):
-    s3_client = boto3.client('s3')
-    items_data = json.loads(s3_client.get_object(
-        Bucket=bucket, Key=str(json_file))['Body'].read())
-    logger.info(" items_data: %s", items_data)
-    return items_data
-
-
-def start_execution(table_name, state_machine_arn):
-    # Initialize the DDB client
-    db_client = boto3.client('dynamodb')
-    db_status = db_client.describe_table(TableName=table_name)['Table']['TableStatus']
-    while db_status != 'ACTIVE':
-        db_status = db_client.describe_table(TableName=table_name)['Table']['TableStatus']
+    """
+    Write changed items of data to DDB and delete items missing in data. Return keys of added, updated and
+    deleted items and the counts of added, updated, deleted and unchanged items.
+    """
+    to_write, to_delete, counts = diff_items(items, data, item_type)
+    return write_changes(to_write, to_delete, counts, data, table_name, item_type)
+
+
+def item_hash(entry):
+    """ return hash of an item of a JSON file, independent of the order of its attributes """
+    return hashlib.sha256(json.dumps(entry, sort_keys=True, separators=(",", ":")).encode()).hexdigest()[:16]
+
+
+def ingest_file(bucket, json_file, table_name, item_type):
+    """
+    Write changes of json_file to the DDB table. Uploads with an unchanged ETag or content hash are skipped,
+    otherwise only items whose hash changed since the previous ingest are written. Without a previous ingest
+    the file is compared with the table. Return changed keys, counts and the new state of the file, which is
+    saved with save_file_states once the changes are recorded as pending.
+    """
+    s3_client = get_client('s3')
+    state_table = get_resource('dynamodb').Table(os.environ["IngestStateDynamoDB"])
+    state = state_table.get_item(Key={"StateKey": "file#" + json_file}).get("Item", {})
+    etag = s3_client.head_object(Bucket=bucket, Key=json_file)["ETag"]
+    if state.get("ETag") == etag:
+        logger.info("%s unchanged (ETag %s), skipping", json_file, etag)
+        return [], {"skipped": True}, None
+
+    body = s3_client.get_object(Bucket=bucket, Key=json_file, IfMatch=etag)['Body'].read()
+    content_hash = hashlib.sha256(body).hexdigest()
+    if state.get("ContentHash") == content_hash:
+        logger.info("%s unchanged (content hash %s), skipping", json_file, content_hash)
+        state_table.update_item(Key={"StateKey": "file#" + json_file}, UpdateExpression="SET ETag = :etag",
+                                ExpressionAttributeValues={":etag": etag})
+        return [], {"skipped": True}, None
+
+    data = json.loads(body)
+    hashes = {entry[item_type]: item_hash(entry) for entry in data}
+    if "ItemHashes" in state:
+        to_write, to_delete, counts = diff_hashes(state["ItemHashes"], data, hashes, item_type)
+        changed, counts = write_changes(to_write, to_delete, counts, data, table_name, item_type)
     else:
-        client = boto3.client('stepfunctions')
-        # Start the execution of the state machine
-        execution_response = client.list_executions(
+        changed, counts = process_item(scan_table(get_client("dynamodb"), table_name), data, table_name, item_type)
+    if not data:
+        # item hashes of an empty file would not match the table, which keeps its items
+        return changed, counts, None
+    # About 35 bytes per item, the 400 KB item limit allows more than 10000 accounts, see save_file_states.
+    return changed, counts, {"StateKey": "file#" + json_file, "ETag": etag, "ContentHash": content_hash, "ItemHashes": hashes}
+
+
+def save_file_states(file_states):
+    """
+    Save the states returned by ingest_file. Until then a retried S3 event ingests the files again, so changes
+    are not lost if writing the items or recording them as pending failed. States exceeding the DynamoDB item size
+    are saved without ItemHashes, the next ingest of the file then scans the table.
+    """
+    file_states = [file_state for file_state in file_states if file_state]
+    if not file_states:
+        return
+    state_table = get_resource('dynamodb').Table(os.environ["IngestStateDynamoDB"])
+    for file_state in file_states:
+        try:
+            state_table.put_item(Item=file_state)
+        except botocore.exceptions.ClientError as error:
+            if error.response["Error"]["Code"] != "ValidationException" or "size" not in error.response["Error"]["Message"]:
+                raise
+            logger.warning("Item hashes of %s exceed the DynamoDB item size, saving state without them: %s",
+                           file_state["StateKey"], error)
+            state_table.put_item(Item={key: value for key, value in file_state.items() if key != "ItemHashes"})
+
+
+def add_pending_changes(controls=None):
+    """
+    Record changes in the pending changes item. controls=None requests the reconciliation of all controls.
+    """
+    if controls is None:
+        update = {"UpdateExpression": "SET FullSync = :full_sync", "ExpressionAttributeValues": {":full_sync": {"BOOL": True}}}
+    elif controls:
+        update = {"UpdateExpression": "ADD Controls :controls", "ExpressionAttributeValues": {":controls": {"SS": list(controls)}}}
+    else:
+        return
+    get_client('dynamodb').update_item(TableName=os.environ["IngestStateDynamoDB"], Key=PENDING_KEY, **update)
+
+
+def claim_pending_changes():
+    """
+    Remove the pending changes item. Return its changes, None if another invocation claimed them already.
+    """
+    response = get_client('dynamodb').delete_item(
+        TableName=os.environ["IngestStateDynamoDB"], Key=PENDING_KEY, ReturnValues="ALL_OLD")
+    attributes = response.get("Attributes")
+    if not attributes:
+        return None
+    if attributes.get("FullSync", {}).get("BOOL"):
+        return {"controls": None}
+    return {"controls": sorted(attributes.get("Controls", {}).get("SS", []))}
+
+
+def start_pending(state_machine_arn, finished_execution_arn=None):
+    """
+    Start one execution covering all pending changes, unless an execution is running. The running execution
+    invokes this function again when it finishes, as finished_execution_arn.
+    """
+    client = get_client('stepfunctions')
+    # list_executions is eventually consistent and may still return the execution which just finished
+    running = [
+        execution for execution in
+        client.list_executions(stateMachineArn=state_machine_arn, statusFilter='RUNNING', maxResults=2)['executions']
+        if execution['executionArn'] != finished_execution_arn
+    ]
+    if running:
+        logger.info("%s State Machine execution in progress, changes are applied when it finishes", state_machine_arn)
+        return {'statusCode': 202, 'body': 'Changes pending'}
+    changes = claim_pending_changes()
+    if changes is None:
+        logger.info("No pending changes")
+        return {'statusCode': 200, 'body': 'No pending changes'}
+    try:
+        response = client.start_execution(
             stateMachineArn=state_machine_arn,
-            statusFilter='RUNNING'
-        )['executions']
-        if execution_response:
-            logger.info("%s State Machine execution in progress, skipping new execution", state_machine_arn)
-        else:
-            response = client.start_execution(
-                stateMachineArn=state_machine_arn,
-                input='{}'  # Replace with the input data for your state machine (JSON format)
-            )
-            execution_arn = response['executionArn']
-            logger.info("execution started ID: %s", execution_arn)
-            return {
-                'statusCode': 200,
-                'body': f'Started execution: {execution_arn}'
-            }
+            input=json.dumps({"controls": changes["controls"]} if changes["controls"] is not None else {})
+        )
+    except Exception:
+        # keep the changes for the next attempt
+        add_pending_changes(changes["controls"])
+        raise
+    execution_arn = response['executionArn']
+    logger.info("execution started ID: %s", execution_arn)
+    return {
+        'statusCode': 200,
+        'body': f'Started execution: {execution_arn}'
+    }
+
+
+def start_execution(table_name, state_machine_arn, controls=None, file_states=()):
+    """
+    Schedule an execution of the state machine. If controls is set, only these ControlIds are reconciled.
+    Changes arriving while an execution runs are coalesced into one follow-up execution. file_states are saved
+    once the changes are recorded as pending.
+    """
+    get_client('dynamodb').get_waiter('table_exists').wait(TableName=table_name)
+    add_pending_changes(controls)
+    save_file_states(file_states)
+    # uploads of accounts.json and items.json in quick succession start one execution
+    time.sleep(int(os.environ.get("DebounceSeconds", 0)))
+    return start_pending(state_machine_arn)
 
 
 def lambda_handler(event, context):
-    logger.info("%s event", event)
+    response = handle_event(event)
+    response["metrics"] = flush_metrics("IngestExceptions")
+    log_sampling_summary(logger)
+    return response
+
+
+def handle_event(event):
+    logger.info("%s event", summarize(event))
+    if event.get("source") == "aws.states":
+        # an execution finished, start the pending changes
+        return start_pending(os.environ["StateMachineArn"], event["detail"]["executionArn"])
     bucket = event['Records'][0]['s3']['bucket']['name']
     items_table = os.environ["ItemsDynamoDB"]
     regions_table = os.environ["RegionsDynamoDB"]
     state_machine_arn = os.environ["StateMachineArn"]
-    dynamodb_client = boto3.client("dynamodb")
     ## processing accounts.json
-    accounts_data = get_s3_data(bucket, os.environ["accounts_json_file"])
-    logger.info(" accounts_data: %s", accounts_data)
     logger.info("accounts-region table name: %s", regions_table)
-    regions_response = dynamodb_client.scan(TableName=regions_table)
-    process_item(regions_response, accounts_data, regions_table, item_type="AccountId")
-    
+    with timed("ingest_accounts"):
+        changed_accounts, account_counts, accounts_state = ingest_file(bucket, os.environ["accounts_json_file"], regions_table, item_type="AccountId")
+
     ## processing items.json
-    items_data = get_s3_data(bucket, os.environ["items_json_file"])
-    logger.info(" items_data: %s", items_data)
     logger.info("items table name: %s", items_table)
-    items_response = dynamodb_client.scan(TableName=items_table)
-    process_item(items_response, items_data, items_table, item_type="ControlId")
-    start_execution(items_table, state_machine_arn)
+    with timed("ingest_controls"):
+        changed_controls, control_counts, controls_state = ingest_file(bucket, os.environ["items_json_file"], items_table, item_type="ControlId")
+    counts = {"accounts": account_counts, "controls": control_counts}
+    file_states = [accounts_state, controls_state]
+
+    if changed_accounts:
+        # regions of accounts changed, all controls have to be reconciled
+        logger.info("%s accounts changed: %s", len(changed_accounts), summarize(changed_accounts))
+        return dict(start_execution(items_table, state_machine_arn, file_states=file_states), counts=counts)
+    if changed_controls:
+        # deleted controls are reconciled too, they fall back to the administrator configuration
+        logger.info("%s controls changed: %s", len(changed_controls), summarize(changed_controls))
+        return dict(start_execution(items_table, state_machine_arn, controls=changed_controls, file_states=file_states), counts=counts)
+    logger.info("No accounts or controls changed, skipping new execution")
+    save_file_states(file_states)
+    return {"statusCode": 200, "counts": counts}
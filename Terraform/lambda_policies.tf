@@ -19,10 +19,13 @@ data "aws_iam_policy_document" "ddb_lambda_policy_doc" {
          "dynamodb:Query",
          "dynamodb:PutItem",
          "dynamodb:GetItem",
-         "dynamodb:UpdateItem"
+         "dynamodb:UpdateItem",
+         "dynamodb:BatchWriteItem",
+         "dynamodb:DeleteItem"
     ]
     resources = ["arn:aws:dynamodb:us-east-1:${var.SecurityHubAdminAccountId}:table/${var.items_dynamodb_table}",
-                "arn:aws:dynamodb:us-east-1:${var.SecurityHubAdminAccountId}:table/${var.regions_dynamodb_table}"]
+                "arn:aws:dynamodb:us-east-1:${var.SecurityHubAdminAccountId}:table/${var.regions_dynamodb_table}",
+                aws_dynamodb_table.ingest_state.arn]
   }
   statement {
     effect = "Allow"
@@ -1,8 +1,19 @@
 provider "archive" {}
 data "archive_file" "process_ddb_lambda_zip_file" {
 	type        = "zip"
-	source_file = "lambda/lambda_handlers.py"
 	output_path = "lambda/ddb_lambda.zip"
+	source {
+		content  = file("lambda/lambda_handlers.py")
+		filename = "lambda_handlers.py"
+	}
+	# code shared with the SecurityHub Updater Lambda functions
+	dynamic "source" {
+		for_each = fileset("${path.module}/../src/Common/python", "sechub_common/*.py")
+		content {
+			content  = file("${path.module}/../src/Common/python/${source.value}")
+			filename = source.value
+		}
+	}
 }
 
 resource "aws_lambda_function" "process_ddb_lambda" {
@@ -20,10 +31,26 @@ resource "aws_lambda_function" "process_ddb_lambda" {
             "items_json_file" = "items.json"
             "accounts_json_file" = "accounts.json"
             "StateMachineArn" = var.state_machine_arn
+            "IngestStateDynamoDB" = aws_dynamodb_table.ingest_state.name
+            "DebounceSeconds" = var.debounce_seconds
+            "LOG_LEVEL" = var.log_level
+            "LOG_FORMAT" = var.log_format
         }
     }
 }
 
+# ETag, content hash and item hashes of the last ingested files
+resource "aws_dynamodb_table" "ingest_state" {
+  name         = "${var.lambda_function_name}-ingest-state"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "StateKey"
+
+  attribute {
+    name = "StateKey"
+    type = "S"
+  }
+}
+
 resource "aws_s3_bucket" "items_bucket" {
   bucket = "${var.bucket_name}-${substr(uuid(), 0, 6)}"
   lifecycle {
@@ -77,4 +104,30 @@ resource "aws_s3_object" "accounts_object_upload" {
 resource "aws_cloudwatch_log_group" "lambda_log_group" {
   name              = "/aws/lambda/${var.lambda_function_name}"
   retention_in_days = 30
-}
\ No newline at end of file
+}
+
+# starts the changes uploaded while an execution was running
+resource "aws_cloudwatch_event_rule" "execution_finished" {
+  name = "${var.lambda_function_name}-execution-finished"
+  event_pattern = jsonencode({
+    source      = ["aws.states"]
+    detail-type = ["Step Functions Execution Status Change"]
+    detail = {
+      stateMachineArn = [var.state_machine_arn]
+      status          = ["SUCCEEDED", "FAILED", "TIMED_OUT", "ABORTED"]
+    }
+  })
+}
+
+resource "aws_cloudwatch_event_target" "execution_finished" {
+  rule = aws_cloudwatch_event_rule.execution_finished.name
+  arn  = aws_lambda_function.process_ddb_lambda.arn
+}
+
+resource "aws_lambda_permission" "execution_finished_invoke" {
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.process_ddb_lambda.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.execution_finished.arn
+  statement_id  = "AllowEventBridgeInvoke"
+}
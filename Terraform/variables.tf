@@ -22,4 +22,13 @@ variable "SecurityHubAdminAccountId" {
 }
 variable "state_machine_arn" {
   default = "arn:aws:states:XXXXXXX"
-}
\ No newline at end of file
+}
+variable "debounce_seconds" {
+  default = 10
+}
+variable "log_level" {
+  default = "INFO"
+}
+variable "log_format" {
+  default = "json"
+}
@@ -0,0 +1,97 @@
+#!/bin/python
+"""
+Import time benchmark of the Lambda handler modules, the part of a cold start under our control.
+
+Every module is imported in a fresh interpreter with `python -X importtime`, the cumulative import time of
+the handler module is reported as median over all runs. With --lambda the AWS_LAMBDA_FUNCTION_NAME variable
+is set, so clients preinitialized during the Lambda init phase are included.
+
+    python benchmarks/bench_coldstart.py --runs 20
+    python benchmarks/bench_coldstart.py --runs 20 --check benchmarks/coldstart_baseline.json
+    python benchmarks/bench_coldstart.py --runs 20 --write benchmarks/coldstart_baseline.json
+
+coldstart_baseline.json holds the medians in microseconds. Measured with 30 runs per handler, before and after
+the shared init module (sechub_common.init):
+
+    handler        before      after     after --lambda
+    GetMembers     265 ms      256 ms    475 ms
+    UpdateMember   287 ms      286 ms    434 ms
+    CheckResult    275 ms       19 ms     18 ms
+    Ingest         230 ms      279 ms    450 ms
+
+boto3 dominates the import of every handler using it on the hot path. CheckResult only needs boto3 for
+distributed Map results and no longer imports it otherwise. With --lambda the clients are created during the
+import, this time moves from the first invocation into the Lambda init phase. The medians of this machine
+vary by up to 40% between runs, --check uses a tolerance of 50%.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+LAYER = os.path.join(ROOT, "src", "Common", "python")
+HANDLERS = {
+    "GetMembers": (os.path.join(ROOT, "src", "GetMembers"), "index"),
+    "UpdateMember": (os.path.join(ROOT, "src", "UpdateMember"), "index"),
+    "CheckResult": (os.path.join(ROOT, "src", "CheckResult"), "index"),
+    "Ingest": (os.path.join(ROOT, "Terraform", "lambda"), "lambda_handlers"),
+}
+
+
+def import_time(directory, module, lambda_environment):
+    """ return cumulative import time of module in microseconds, measured in a fresh interpreter """
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join([directory, LAYER]))
+    environment.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    if lambda_environment:
+        environment["AWS_LAMBDA_FUNCTION_NAME"] = "bench_coldstart"
+    else:
+        environment.pop("AWS_LAMBDA_FUNCTION_NAME", None)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + module],
+        cwd=directory, env=environment, capture_output=True, text=True, check=True,
+    )
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = [field.strip() for field in line.split("|")]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1])
+    raise RuntimeError("No import time of {} in output".format(module))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--lambda", dest="lambda_environment", action="store_true")
+    parser.add_argument("--write", help="store results as JSON baseline")
+    parser.add_argument("--check", help="fail if a handler is slower than the JSON baseline by more than --tolerance")
+    parser.add_argument("--tolerance", type=float, default=0.5)
+    args = parser.parse_args()
+
+    results = dict()
+    for name, (directory, module) in HANDLERS.items():
+        timings = [import_time(directory, module, args.lambda_environment) for _ in range(args.runs)]
+        results[name] = int(statistics.median(timings))
+        print("{:<14} median {:>8.1f} ms   min {:>8.1f} ms".format(name, results[name] / 1000, min(timings) / 1000))
+
+    if args.write:
+        with open(args.write, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write("\n")
+    if args.check:
+        with open(args.check) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = [
+            name for name in results
+            if name in baseline and results[name] > baseline[name] * (1 + args.tolerance)
+        ]
+        if regressions:
+            print("Import time regression: " + ", ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
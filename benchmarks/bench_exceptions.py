@@ -0,0 +1,114 @@
+#!/bin/python
+"""
+Microbenchmark of exception resolution in UpdateMember.
+
+Compares the previous model, where GetMembers expanded "ALL" into every member account and UpdateMember
+scanned these lists for every control, with the indexed model of index_exceptions/resolve_exceptions.
+Both must resolve to the same exceptions.
+
+    python benchmarks/bench_exceptions.py --accounts 5000 --controls 300 --lookups 200
+"""
+
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+# the shared layer is importable as sechub_common in Lambda
+sys.path.insert(0, os.path.join(ROOT, "src", "Common", "python"))
+import src.UpdateMember.index as UpdateMember  # noqa: E402
+
+REGIONS = ["us-east-1", "us-east-2", "us-west-1", "us-west-2", "eu-west-1"]
+
+
+def generate_exceptions(accounts, controls):
+    """ return exceptions with symbolic ALL, mixing organization wide, account lists and region scoped controls """
+    exceptions = dict()
+    for number in range(controls):
+        kind = number % 4
+        exception = {"Disabled": [], "Enabled": [], "DisabledReason": "Exception " + str(number)}
+        if kind == 0:
+            exception["Disabled"] = ["ALL"]
+        elif kind == 1:
+            exception["Disabled"] = random.sample(accounts, max(1, len(accounts) // 10))
+        elif kind == 2:
+            exception["Enabled"] = ["ALL"]
+            exception["Region"] = ["us-east-1"]
+        else:
+            exception["Enabled"] = random.sample(accounts, max(1, len(accounts) // 10))
+        exceptions["Control." + str(number)] = exception
+    return exceptions
+
+
+def expand_all(exceptions, accounts):
+    """ previous GetMembers payload, "ALL" expanded into the member account list """
+    expanded = dict()
+    for control, exception in exceptions.items():
+        expanded[control] = dict(exception)
+        for key in ("Disabled", "Enabled"):
+            if exception[key][:1] == ["ALL"]:
+                expanded[control][key] = accounts
+    return expanded
+
+
+def legacy_get_exceptions(exceptions_dict, account_id, region):
+    """ previous get_exceptions: list scans of the expanded account lists for every control """
+    exceptions = {"Disabled": [], "Enabled": [], "DisabledReason": dict()}
+    for control in exceptions_dict.keys():
+        disabled = account_id in exceptions_dict[control]["Disabled"]
+        enabled = False
+        if account_id in exceptions_dict[control]["Enabled"]:
+            if "Region" in exceptions_dict[control].keys():
+                if region not in exceptions_dict[control]["Region"]:
+                    disabled = True
+            else:
+                enabled = True
+        exceptions["DisabledReason"][control] = exceptions_dict[control]["DisabledReason"]
+        if enabled and disabled:
+            pass
+        elif disabled:
+            exceptions["Disabled"].append(control)
+        elif enabled:
+            exceptions["Enabled"].append(control)
+    return exceptions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--accounts", type=int, default=5000)
+    parser.add_argument("--controls", type=int, default=300)
+    parser.add_argument("--lookups", type=int, default=200, help="accounts resolved, each in all regions")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+    random.seed(0)
+
+    accounts = [str(100000000000 + number) for number in range(args.accounts)]
+    exceptions = generate_exceptions(accounts, args.controls)
+    expanded = expand_all(exceptions, accounts)
+    lookups = random.sample(accounts, min(args.lookups, len(accounts)))
+
+    start = time.perf_counter()
+    legacy = [legacy_get_exceptions(expanded, account, region) for account in lookups for region in REGIONS]
+    legacy_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    indexed = []
+    for account in lookups:
+        # one index per UpdateMember invocation, resolved for every region
+        exception_index = UpdateMember.index_exceptions(exceptions)
+        indexed.extend(UpdateMember.resolve_exceptions(exception_index, account, region) for region in REGIONS)
+    indexed_seconds = time.perf_counter() - start
+
+    assert legacy == indexed, "indexed exceptions differ from previous resolution"
+    print("accounts=%s controls=%s lookups=%s regions=%s" % (args.accounts, args.controls, len(lookups), len(REGIONS)))
+    print("legacy   %8.3f s  %8.3f ms/account" % (legacy_seconds, 1000 * legacy_seconds / len(lookups)))
+    print("indexed  %8.3f s  %8.3f ms/account" % (indexed_seconds, 1000 * indexed_seconds / len(lookups)))
+    print("speedup  %8.1fx" % (legacy_seconds / indexed_seconds))
+
+
+if __name__ == "__main__":
+    main()
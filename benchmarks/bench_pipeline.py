@@ -0,0 +1,262 @@
+#!/bin/python
+"""
+End to end benchmark of the pipeline against the in-memory AWS backend of fake_aws.py, no AWS access needed.
+
+A scenario uploads accounts.json and items.json and runs the ingest Lambda, GetMembers, the Map of UpdateMember
+invocations as the state machine would, and CheckResult. Every scenario runs in a fresh interpreter, so module
+caches start cold and the peak memory is measured per scenario. All invocations of a scenario share one
+process, like a single warm Lambda container.
+
+    python benchmarks/bench_pipeline.py
+    python benchmarks/bench_pipeline.py --scenario medium --scenario large --executions 2
+    python benchmarks/bench_pipeline.py --accounts 300 --regions 4 --controls 250 --latency 0.01 --throttle-rate 0.02
+
+Reported per execution: wall time per step, API calls and throttled attempts per operation and the peak resident
+memory of the process (peak traced Python allocations with --tracemalloc, which slows the run down). The second
+execution of --executions 2 shows the effect of the snapshots, as no input changed since the first.
+
+The SecurityHub quotas of the shared rate limiter are lifted unless --rate-limits is set, otherwise the one
+GetEnabledStandards call per second and account dominates every scenario.
+"""
+
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+LAYER = os.path.join(ROOT, "src", "Common", "python")
+HANDLERS = {
+    "GetMembers": os.path.join(ROOT, "src", "GetMembers", "index.py"),
+    "UpdateMember": os.path.join(ROOT, "src", "UpdateMember", "index.py"),
+    "CheckResult": os.path.join(ROOT, "src", "CheckResult", "index.py"),
+    "Ingest": os.path.join(ROOT, "Terraform", "lambda", "lambda_handlers.py"),
+}
+SCENARIOS = {
+    "small": {"accounts": 10, "regions": 2, "standards": 2, "controls": 100},
+    "medium": {"accounts": 100, "regions": 4, "standards": 3, "controls": 200},
+    "large": {"accounts": 1000, "regions": 4, "standards": 3, "controls": 300},
+    "xlarge": {"accounts": 10000, "regions": 2, "standards": 2, "controls": 300},
+}
+ADMIN_ACCOUNT = "000000000000"
+CONFIG_BUCKET = "config"
+ENVIRONMENT = {
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "MemberRole": "arn:aws:iam::<accountId>:role/member",
+    "SecHubAdminAccount": ADMIN_ACCOUNT,
+    "DynamoDB": "items",
+    "ItemsDynamoDB": "items",
+    "RegionsDynamoDB": "regions",
+    "IngestStateDynamoDB": "ingest-state",
+    "SnapshotTable": "snapshots",
+    "ExecutionDataBucket": "execution-data",
+    "StateMachineArn": "arn:aws:states:us-east-1:{}:stateMachine:SecurityHubMemberUpdate".format(ADMIN_ACCOUNT),
+    "accounts_json_file": "accounts.json",
+    "items_json_file": "items.json",
+    "DebounceSeconds": "0",
+    "LOG_FORMAT": "json",
+}
+UNLIMITED_RATES = [1000000, 1000000]
+
+
+def load_handler(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.path.insert(0, os.path.dirname(path))
+    spec.loader.exec_module(module)
+    return module
+
+
+def config_files(scenario, backend):
+    """ return accounts.json and items.json of scenario, exceptions cover 5% of the controls """
+    regions = ["region-{}".format(number) for number in range(scenario["regions"])]
+    accounts = [{"AccountId": account, "Regions": regions} for account in backend.accounts]
+    controls = backend.control_ids()
+    items = [
+        {"ControlId": control, "Disabled": ["ALL"], "DisabledReason": "Benchmark exception"}
+        for control in controls[:max(1, len(controls) // 20)]
+    ]
+    return accounts, items
+
+
+def run_map(modules, payload, context, map_concurrency, execution_name):
+    """ invoke UpdateMember for the items of the inline or distributed Map, return the processed items """
+    update_member = modules["UpdateMember"].lambda_handler
+    batch_input = {key: payload.get(key) for key in ("exceptions", "baseline", "dryRun", "controls", "forceFullSync")}
+    batch_input["execution"] = execution_name
+    if "accountsLocation" in payload:
+        location = payload["accountsLocation"]
+        body = modules["backend"].objects[(location["Bucket"], location["Key"])].decode()
+        items = [json.loads(line) for line in body.splitlines()]
+        events = [
+            {"Items": items[start:start + payload["batchSize"]], "BatchInput": batch_input}
+            for start in range(0, len(items), payload["batchSize"])
+        ]
+    else:
+        events = [dict(batch_input, account=account) for account in payload["accounts"]]
+    with ThreadPoolExecutor(max_workers=map_concurrency or payload["mapConcurrency"]) as executor:
+        return list(executor.map(lambda event: update_member(event, context), events))
+
+
+def run_scenario(scenario):
+    """ run scenario in this interpreter, return its report """
+    sys.path.insert(0, LAYER)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.environ.update(ENVIRONMENT)
+    os.environ.pop("AWS_LAMBDA_FUNCTION_NAME", None)
+    rates = {} if scenario["rate_limits"] else {"default": UNLIMITED_RATES}
+    if not scenario["rate_limits"]:
+        for api in ("BatchEnableStandards", "BatchDisableStandards", "GetEnabledStandards",
+                    "BatchUpdateStandardsControlAssociations"):
+            rates[api] = UNLIMITED_RATES
+    os.environ["RateLimits"] = json.dumps(rates)
+    import fake_aws
+    from sechub_common import init
+    from sechub_common.metrics import instrument_client
+
+    backend = fake_aws.FakeBackend(
+        accounts=["{:012d}".format(100000000000 + number) for number in range(scenario["accounts"])],
+        regions=scenario["regions"], standards=scenario["standards"], controls=scenario["controls"],
+        latency=scenario["latency"], throttle_rate=scenario["throttle_rate"], drift=scenario["drift"],
+        admin_account=ADMIN_ACCOUNT,
+    )
+    for service in ("securityhub", "organizations", "dynamodb", "s3", "sts", "stepfunctions"):
+        init._clients[service] = instrument_client(backend.client(service))
+    for number in range(scenario["regions"]):
+        region = "region-{}".format(number)
+        init._clients[("securityhub", region)] = instrument_client(backend.client("securityhub", region=region))
+    init._resources["dynamodb"] = fake_aws.FakeResource(init._clients["dynamodb"])
+
+    # log records are formatted as in Lambda, but not printed
+    null_stream = open(os.devnull, "w")
+    real_stdout, sys.stdout = sys.stdout, null_stream
+    logging.getLogger().handlers = [logging.StreamHandler(null_stream)]
+    modules = {name: load_handler(name, path) for name, path in HANDLERS.items()}
+    modules["backend"] = backend
+
+    class FakeClientPool(modules["UpdateMember"].ClientPool):
+        def _create_session(self, role_arn):
+            return fake_aws.FakeSession(backend, role_arn.split(":")[4] if role_arn else None)
+
+    modules["UpdateMember"].client_pool = FakeClientPool(modules["UpdateMember"].CLIENT_CONFIG)
+    context = SimpleNamespace(invoked_function_arn="arn:aws:lambda:us-east-1:{}:function:UpdateMember".format(ADMIN_ACCOUNT))
+
+    accounts, items = config_files(scenario, backend)
+    backend.s3_put_object(None, CONFIG_BUCKET, "accounts.json", json.dumps(accounts))
+    backend.s3_put_object(None, CONFIG_BUCKET, "items.json", json.dumps(items))
+    if scenario["tracemalloc"]:
+        tracemalloc.start()
+
+    executions = []
+    for execution in range(scenario["executions"]):
+        backend.calls.clear()
+        backend.throttles.clear()
+        timings = dict()
+        start = time.perf_counter()
+        if execution == 0:
+            modules["Ingest"].lambda_handler({"Records": [{"s3": {"bucket": {"name": CONFIG_BUCKET}}}]}, None)
+            timings["Ingest"] = time.perf_counter() - start
+        step = time.perf_counter()
+        payload = modules["GetMembers"].lambda_handler({}, context)
+        timings["GetMembers"] = time.perf_counter() - step
+        step = time.perf_counter()
+        processed_items = run_map(modules, payload, context, scenario["map_concurrency"], "execution-{}".format(execution))
+        timings["UpdateMember"] = time.perf_counter() - step
+        step = time.perf_counter()
+        result = modules["CheckResult"].lambda_handler({"processedItems": processed_items}, None)
+        timings["CheckResult"] = time.perf_counter() - step
+        timings["total"] = time.perf_counter() - start
+        executions.append({
+            "timings": timings,
+            "status": result["statusCode"],
+            "mode": "distributed" if "accountsLocation" in payload else "inline",
+            "calls": {"{}.{}".format(*key): count for key, count in sorted(backend.calls.items())},
+            "throttles": sum(backend.throttles.values()),
+            "controls_changed": sum(
+                account.get("updates", {}).get("controls_changed", 0)
+                for item in processed_items for account in (item if isinstance(item, list) else [item])),
+        })
+
+    sys.stdout = real_stdout
+    report = {"scenario": scenario, "executions": executions,
+              "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+    if scenario["tracemalloc"]:
+        report["traced_peak_mb"] = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    return report
+
+
+def print_report(report):
+    scenario = report["scenario"]
+    print("{name}: {accounts} accounts, {regions} regions, {standards} standards, {controls} controls, "
+          "latency {latency}s, throttle rate {throttle_rate}".format(**scenario))
+    for number, execution in enumerate(report["executions"], 1):
+        timings = "  ".join("{} {:.2f}s".format(step, seconds) for step, seconds in execution["timings"].items())
+        print("  execution {} ({}, status {}): {}".format(number, execution["mode"], execution["status"], timings))
+        print("    {} API calls, {} throttled attempts, {} controls changed".format(
+            sum(execution["calls"].values()), execution["throttles"], execution["controls_changed"]))
+        for operation, count in sorted(execution["calls"].items(), key=lambda entry: -entry[1]):
+            print("      {:<60} {:>8}".format(operation, count))
+    memory = "  peak RSS {:.1f} MB".format(report["max_rss_mb"])
+    if "traced_peak_mb" in report:
+        memory += ", traced peak {:.1f} MB".format(report["traced_peak_mb"])
+    print(memory)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="predefined scenario, can be repeated. Default: small and medium")
+    parser.add_argument("--accounts", type=int, help="custom scenario with this number of accounts")
+    parser.add_argument("--regions", type=int, default=4)
+    parser.add_argument("--standards", type=int, default=3)
+    parser.add_argument("--controls", type=int, default=200, help="controls per standard")
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds per API call")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of throttled API calls")
+    parser.add_argument("--drift", type=float, default=0.05, help="share of controls drifted in member accounts")
+    parser.add_argument("--executions", type=int, default=1, help="state machine executions per scenario")
+    parser.add_argument("--map-concurrency", type=int, help="override the Map concurrency of the GetMembers payload")
+    parser.add_argument("--rate-limits", action="store_true", help="apply the SecurityHub quotas of the rate limiter")
+    parser.add_argument("--tracemalloc", action="store_true", help="report peak traced Python allocations")
+    parser.add_argument("--json", help="write reports as JSON to this file")
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        # child process of a single scenario
+        print(json.dumps(run_scenario(json.loads(args.run))))
+        return
+
+    options = {"latency": args.latency, "throttle_rate": args.throttle_rate, "drift": args.drift,
+               "executions": args.executions, "map_concurrency": args.map_concurrency,
+               "rate_limits": args.rate_limits, "tracemalloc": args.tracemalloc}
+    if args.accounts:
+        scenarios = [dict(options, name="custom", accounts=args.accounts, regions=args.regions,
+                          standards=args.standards, controls=args.controls)]
+    else:
+        scenarios = [dict(options, name=name, **SCENARIOS[name]) for name in args.scenario or ["small", "medium"]]
+
+    reports = []
+    for scenario in scenarios:
+        result = subprocess.run([sys.executable, os.path.abspath(__file__), "--run", json.dumps(scenario)],
+                                capture_output=True, text=True)
+        if result.returncode:
+            sys.stderr.write(result.stderr)
+            sys.exit(result.returncode)
+        reports.append(json.loads(result.stdout.splitlines()[-1]))
+        print_report(reports[-1])
+    if args.json:
+        with open(args.json, "w") as report_file:
+            json.dump(reports, report_file, indent=2)
+            report_file.write("\n")
+
+
+if __name__ == "__main__":
+    main()
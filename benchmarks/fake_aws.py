@@ -0,0 +1,351 @@
+#!/bin/python
+"""
+In-memory stand-in for the SecurityHub, Organizations, DynamoDB, S3, STS and Step Functions APIs used by the
+Lambda functions. Every call sleeps for the configured latency, is throttled with the configured probability
+and is counted per service and operation. Clients emit the botocore before-call, needs-retry and after-call
+events, so the rate limiter and the instrumentation hooks of the Lambdas run as against AWS.
+
+Only the parameters used by the Lambda functions are implemented.
+"""
+
+import datetime
+import hashlib
+import io
+import random
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+from types import SimpleNamespace
+
+import botocore.exceptions
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from botocore.hooks import HierarchicalEmitter
+
+# partition keys of the tables created by the SAM template and Terraform
+TABLE_KEYS = {
+    "items": "ControlId",
+    "regions": "AccountId",
+    "ingest-state": "StateKey",
+    "snapshots": "SnapshotKey",
+    "rate-limits": "BucketKey",
+}
+SCAN_PAGE_SIZE = 100
+LIST_PAGE_SIZE = 50
+MAX_THROTTLE_RETRIES = 5
+STANDARDS_ARN = "arn:aws:securityhub:{region}::standards/standard-{number}/v/1.0.0"
+
+
+def client_error(code, operation, message=""):
+    return botocore.exceptions.ClientError({"Error": {"Code": code, "Message": message or code}}, operation)
+
+
+def operation_name(method_name):
+    """ return API operation of a client method, e.g. GetEnabledStandards for get_enabled_standards """
+    return "".join(part.capitalize() for part in method_name.split("_"))
+
+
+class FakeBackend:
+    """
+    State and call accounting shared by all fake clients of a benchmark run
+    """
+
+    def __init__(self, accounts, regions, standards, controls, latency=0.0, throttle_rate=0.0, drift=0.05,
+                 admin_account="000000000000", seed=0):
+        self.accounts = accounts
+        self.regions = regions
+        self.standards = standards
+        self.controls = controls
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.drift = drift
+        self.admin_account = admin_account
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.throttles = Counter()
+        self.tables = {name: dict() for name in TABLE_KEYS}
+        self.objects = dict()
+        # association status changed by BatchUpdateStandardsControlAssociations
+        self.associations = dict()
+        self.executions = []
+
+    def client(self, service, account=None, region="us-east-1"):
+        return FakeClient(self, service, account or self.admin_account, region)
+
+    def call(self, client, method_name, kwargs):
+        """
+        Run the fake operation of client. Throttled attempts are retried like botocore does.
+        """
+        operation = operation_name(method_name)
+        model = SimpleNamespace(name=operation)
+        context = dict()
+        events = client.meta.events
+        event_suffix = "{}.{}".format(client.service, operation)
+        events.emit("before-call." + event_suffix, model=model, params=kwargs, context=context)
+        attempts = 0
+        while True:
+            if self.latency:
+                time.sleep(self.latency)
+            with self.lock:
+                self.calls[(client.service, operation)] += 1
+                throttled = attempts < MAX_THROTTLE_RETRIES and self.random.random() < self.throttle_rate
+                if throttled:
+                    self.throttles[(client.service, operation)] += 1
+            if not throttled:
+                break
+            attempts += 1
+            response = (None, {"Error": {"Code": "ThrottlingException"}})
+            events.emit("needs-retry." + event_suffix, response=response, operation=model, attempts=attempts,
+                        endpoint=None, caught_exception=None, request_dict=kwargs)
+            time.sleep(self.latency * 2 ** attempts)
+        handler = getattr(self, "{}_{}".format(client.service, method_name))
+        try:
+            parsed = handler(client, **kwargs)
+        except botocore.exceptions.ClientError as error:
+            events.emit("after-call." + event_suffix, http_response=None, parsed=error.response, model=model,
+                        context=context)
+            raise
+        parsed["ResponseMetadata"] = {"RetryAttempts": attempts}
+        events.emit("after-call." + event_suffix, http_response=None, parsed=parsed, model=model, context=context)
+        return parsed
+
+    # Organizations and SecurityHub
+
+    def standards_arns(self, region):
+        return [STANDARDS_ARN.format(region=region, number=number) for number in range(self.standards)]
+
+    def control_ids(self):
+        return ["Control.{}".format(number) for number in range(self.controls)]
+
+    def page(self, items, key, next_token=None, page_size=LIST_PAGE_SIZE):
+        start = int(next_token or 0)
+        response = {key: items[start:start + page_size]}
+        if start + page_size < len(items):
+            response["NextToken"] = str(start + page_size)
+        return response
+
+    def organizations_list_accounts(self, client, NextToken=None):
+        accounts = [{"Id": account, "Status": "ACTIVE"} for account in self.accounts]
+        return self.page(accounts, "Accounts", NextToken)
+
+    def securityhub_list_members(self, client, NextToken=None, **kwargs):
+        members = [{"AccountId": account, "MemberStatus": "Enabled"} for account in self.accounts]
+        return self.page(members, "Members", NextToken)
+
+    def securityhub_describe_standards(self, client, NextToken=None):
+        standards = [{"StandardsArn": arn, "Name": arn.split("/")[-3]} for arn in self.standards_arns(client.region)]
+        return self.page(standards, "Standards", NextToken)
+
+    def securityhub_get_enabled_standards(self, client, StandardsSubscriptionArns=None, NextToken=None):
+        subscriptions = [
+            {"StandardsArn": arn, "StandardsSubscriptionArn": arn.replace("::", ":" + client.account + ":", 1),
+             "StandardsStatus": "READY"}
+            for arn in self.standards_arns(client.region)
+        ]
+        return self.page(subscriptions, "StandardsSubscriptions", NextToken)
+
+    def securityhub_list_security_control_definitions(self, client, StandardsArn, NextToken=None):
+        definitions = [{"SecurityControlId": control, "CurrentRegionAvailability": "AVAILABLE"}
+                       for control in self.control_ids()]
+        return self.page(definitions, "SecurityControlDefinitions", NextToken, page_size=100)
+
+    def association_status(self, account, region, standards_arn, control):
+        key = (account, region, standards_arn, control)
+        if key in self.associations:
+            return self.associations[key]
+        # a stable share of the controls of every account drifted from the desired state
+        drifted = zlib.crc32("{}#{}#{}".format(account, region, control).encode()) % 10000 < self.drift * 10000
+        return "DISABLED" if drifted else "ENABLED"
+
+    def securityhub_batch_get_standards_control_associations(self, client, StandardsControlAssociationIds):
+        return {"StandardsControlAssociationDetails": [
+            dict(association, AssociationStatus=self.association_status(
+                client.account, client.region, association["StandardsArn"], association["SecurityControlId"]))
+            for association in StandardsControlAssociationIds
+        ]}
+
+    def securityhub_batch_update_standards_control_associations(self, client, StandardsControlAssociationUpdates):
+        with self.lock:
+            for update in StandardsControlAssociationUpdates:
+                key = (client.account, client.region, update["StandardsArn"], update["SecurityControlId"])
+                self.associations[key] = update["AssociationStatus"]
+        return {"UnprocessedAssociationUpdates": []}
+
+    # DynamoDB
+
+    def table(self, name):
+        if name not in self.tables:
+            raise client_error("ResourceNotFoundException", "DynamoDB", "Table {} not found".format(name))
+        return self.tables[name]
+
+    def item_key(self, table_name, item):
+        return item[TABLE_KEYS[table_name]]["S"]
+
+    def dynamodb_scan(self, client, TableName, Segment=0, TotalSegments=1, ExclusiveStartKey=None):
+        items = [item for index, (_, item) in enumerate(sorted(self.table(TableName).items()))
+                 if index % TotalSegments == Segment]
+        start = int(ExclusiveStartKey["Offset"]["N"]) if ExclusiveStartKey else 0
+        response = {"Items": items[start:start + SCAN_PAGE_SIZE]}
+        if start + SCAN_PAGE_SIZE < len(items):
+            response["LastEvaluatedKey"] = {"Offset": {"N": str(start + SCAN_PAGE_SIZE)}}
+        return response
+
+    def dynamodb_get_item(self, client, TableName, Key):
+        item = self.table(TableName).get(self.item_key(TableName, Key))
+        return {"Item": item} if item else {}
+
+    def dynamodb_put_item(self, client, TableName, Item):
+        with self.lock:
+            self.table(TableName)[self.item_key(TableName, Item)] = Item
+        return {}
+
+    def dynamodb_delete_item(self, client, TableName, Key, ReturnValues="NONE"):
+        with self.lock:
+            old = self.table(TableName).pop(self.item_key(TableName, Key), None)
+        return {"Attributes": old} if old and ReturnValues == "ALL_OLD" else {}
+
+    def dynamodb_update_item(self, client, TableName, Key, UpdateExpression, ExpressionAttributeValues,
+                             ConditionExpression=None, **kwargs):
+        """ SET and ADD clauses of UpdateExpression are supported, ConditionExpression is not evaluated """
+        with self.lock:
+            table = self.table(TableName)
+            item = table.setdefault(self.item_key(TableName, Key), dict(Key))
+            for action, clause in re.findall(r"(SET|ADD)\s+(.*?)(?=\s+(?:SET|ADD)\s|$)", UpdateExpression):
+                for assignment in clause.split(","):
+                    if action == "SET":
+                        name, placeholder = [part.strip() for part in assignment.split("=")]
+                        item[name] = ExpressionAttributeValues[placeholder]
+                        continue
+                    name, placeholder = assignment.split()
+                    value = ExpressionAttributeValues[placeholder]
+                    if name not in item:
+                        item[name] = value
+                    elif "N" in value:
+                        item[name] = {"N": str(float(item[name]["N"]) + float(value["N"]))}
+                    else:
+                        item[name] = {"SS": sorted(set(item[name]["SS"]) | set(value["SS"]))}
+        return {}
+
+    def dynamodb_batch_write_item(self, client, RequestItems):
+        with self.lock:
+            for table_name, requests in RequestItems.items():
+                table = self.table(table_name)
+                for request in requests:
+                    if "PutRequest" in request:
+                        table[self.item_key(table_name, request["PutRequest"]["Item"])] = request["PutRequest"]["Item"]
+                    else:
+                        table.pop(self.item_key(table_name, request["DeleteRequest"]["Key"]), None)
+        return {"UnprocessedItems": {}}
+
+    # S3
+
+    def s3_put_object(self, client, Bucket, Key, Body):
+        body = Body.encode() if isinstance(Body, str) else Body
+        with self.lock:
+            self.objects[(Bucket, Key)] = body
+        return {"ETag": '"{}"'.format(hashlib.md5(body).hexdigest())}
+
+    def s3_head_object(self, client, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise client_error("404", "HeadObject", "Not Found")
+        return {"ETag": '"{}"'.format(hashlib.md5(self.objects[(Bucket, Key)]).hexdigest())}
+
+    def s3_get_object(self, client, Bucket, Key, IfMatch=None):
+        if (Bucket, Key) not in self.objects:
+            raise client_error("NoSuchKey", "GetObject", "The specified key does not exist.")
+        body = self.objects[(Bucket, Key)]
+        return {"Body": io.BytesIO(body), "ETag": '"{}"'.format(hashlib.md5(body).hexdigest())}
+
+    # STS and Step Functions
+
+    def sts_assume_role(self, client, RoleArn, RoleSessionName):
+        return {"Credentials": {
+            "AccessKeyId": "id", "SecretAccessKey": "key", "SessionToken": "token",
+            "Expiration": datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1),
+        }}
+
+    def stepfunctions_list_executions(self, client, stateMachineArn, statusFilter=None, maxResults=None):
+        return {"executions": []}
+
+    def stepfunctions_start_execution(self, client, stateMachineArn, input):
+        with self.lock:
+            self.executions.append(input)
+        return {"executionArn": "{}:execution-{}".format(stateMachineArn, len(self.executions))}
+
+
+class FakeWaiter:
+    def wait(self, **kwargs):
+        pass
+
+
+class FakeClient:
+    """
+    Client of service in account and region, API methods are resolved on FakeBackend
+    """
+
+    def __init__(self, backend, service, account, region):
+        self.backend = backend
+        self.service = service
+        self.account = account
+        self.region = region
+        self.meta = SimpleNamespace(region_name=region, events=HierarchicalEmitter())
+        self.exceptions = SimpleNamespace(ClientError=botocore.exceptions.ClientError)
+
+    def get_waiter(self, name):
+        return FakeWaiter()
+
+    def __getattr__(self, method_name):
+        if not hasattr(self.backend, "{}_{}".format(self.service, method_name)):
+            raise AttributeError(method_name)
+        return lambda **kwargs: self.backend.call(self, method_name, kwargs)
+
+
+class FakeTable:
+    """
+    DynamoDB resource table, items are converted to the low-level format of FakeClient
+    """
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.serializer = TypeSerializer()
+        self.deserializer = TypeDeserializer()
+
+    def serialize(self, values):
+        return {key: self.serializer.serialize(value) for key, value in values.items()}
+
+    def get_item(self, Key):
+        response = self.client.get_item(TableName=self.name, Key=self.serialize(Key))
+        if "Item" in response:
+            response["Item"] = {key: self.deserializer.deserialize(value) for key, value in response["Item"].items()}
+        return response
+
+    def put_item(self, Item):
+        return self.client.put_item(TableName=self.name, Item=self.serialize(Item))
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues):
+        return self.client.update_item(TableName=self.name, Key=self.serialize(Key), UpdateExpression=UpdateExpression,
+                                       ExpressionAttributeValues=self.serialize(ExpressionAttributeValues))
+
+
+class FakeResource:
+    def __init__(self, client):
+        self.meta = SimpleNamespace(client=client)
+
+    def Table(self, name):
+        return FakeTable(self.meta.client, name)
+
+
+class FakeSession:
+    """
+    boto3 session of account, e.g. of an assumed member role
+    """
+
+    def __init__(self, backend, account=None):
+        self.backend = backend
+        self.account = account
+
+    def client(self, service, region_name="us-east-1", config=None):
+        return self.backend.client(service, self.account, region_name)
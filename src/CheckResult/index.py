@@ -1,15 +1,86 @@
 #!/bin/python
 
+import json
+from sechub_common.init import get_client
+from sechub_common.metrics import emit_summary, merge_summaries
+
+s3_client = None
+
+
+def plan_execution(summary, execution):
+    """
+    Add the changes planned for the account of execution to summary, the plan itself is in the region details
+    written to the ExecutionDataBucket
+    """
+    plan = execution.get("plan", {})
+    for key in ("standards", "controls", "update_calls"):
+        summary[key] += plan.get(key, 0)
+    if plan.get("standards") or plan.get("controls"):
+        summary["accounts"] += 1
+
+
+def read_results(result_writer_details):
+    """
+    Read the results written by the distributed Map one result file at a time. Yield account results,
+    accounts of failed batches are returned as failed.
+    """
+    global s3_client
+    if not s3_client:
+        # only the distributed Map needs S3, boto3 is not imported for inline Map results
+        s3_client = get_client("s3")
+    bucket = result_writer_details["Bucket"]
+    manifest = json.loads(s3_client.get_object(Bucket=bucket, Key=result_writer_details["Key"])["Body"].read())
+    for status, result_files in manifest["ResultFiles"].items():
+        for result_file in result_files:
+            body = s3_client.get_object(Bucket=bucket, Key=result_file["Key"])["Body"].read()
+            for batch in json.loads(body):
+                if status == "SUCCEEDED":
+                    yield from json.loads(batch["Output"])
+                    continue
+                error = batch.get("Cause") or batch.get("Error") or status
+                for item in json.loads(batch["Input"])["Items"]:
+                    yield {"statusCode": 500, "account": item["account"], "error": error}
+
+
+def get_executions(event):
+    """
+    Yield account results of the inline Map, batches are flattened, or of the distributed Map result files
+    """
+    if "resultWriter" in event:
+        yield from read_results(event["resultWriter"]["ResultWriterDetails"])
+        return
+    for item in event["processedItems"]:
+        if isinstance(item, list):
+            yield from item
+        else:
+            yield item
+
 
 def lambda_handler(event, context):
     result = {}
     failed = False
-    for execution in event["processedItems"]:
+    dry_run = False
+    summary = {"accounts": 0, "standards": 0, "controls": 0, "update_calls": 0}
+    metrics = {}
+    for execution in get_executions(event):
+        if "metrics" in execution:
+            merge_summaries(metrics, execution["metrics"])
         if execution["statusCode"] == 500:
             failed = True
             result[execution["account"]] = execution["error"]
+        if execution.get("dryRun"):
+            dry_run = True
+            plan_execution(summary, execution)
 
     if failed:
-        return {"statusCode": 500, "failed_accounts": result}
+        payload = {"statusCode": 500, "failed_accounts": result}
+    elif dry_run:
+        payload = {"statusCode": 200, "plan": summary}
+    else:
+        payload = {"statusCode": 200}
 
-    return {"statusCode": 200}
+    if metrics:
+        # API calls and step timers of all UpdateMember invocations of the execution
+        emit_summary("Execution", metrics)
+        payload["metrics"] = metrics
+    return payload
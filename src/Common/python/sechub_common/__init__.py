@@ -0,0 +1,3 @@
+"""
+Code shared by the SecurityHub Updater Lambda functions. Deployed as Lambda layer.
+"""
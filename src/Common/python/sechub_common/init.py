@@ -0,0 +1,50 @@
+#!/bin/python
+"""
+Initialization shared by the Lambda functions. boto3 is imported on first use and clients and resources are
+created once per container. In Lambda, preinit creates clients during the init phase instead of the first
+invocation.
+"""
+
+import os
+import threading
+from sechub_common.metrics import instrument_client
+
+_clients = dict()
+_resources = dict()
+# boto3 default session is not thread safe
+_lock = threading.Lock()
+
+
+def in_lambda():
+    """ return True if running in the Lambda runtime """
+    return "AWS_LAMBDA_FUNCTION_NAME" in os.environ
+
+
+def get_client(service_name, region_name=None):
+    """ return the client of service_name in region_name, the default region if None, shared by this container """
+    key = (service_name, region_name) if region_name else service_name
+    with _lock:
+        if key not in _clients:
+            import boto3
+            _clients[key] = instrument_client(boto3.client(service_name, region_name=region_name))
+        return _clients[key]
+
+
+def get_resource(service_name):
+    """ return the resource of service_name shared by this container """
+    with _lock:
+        if service_name not in _resources:
+            import boto3
+            _resources[service_name] = boto3.resource(service_name)
+            instrument_client(_resources[service_name].meta.client)
+        return _resources[service_name]
+
+
+def preinit(*service_names):
+    """
+    Return clients of service_names, created now in Lambda and None elsewhere so tests and tools importing
+    the handler modules do not need AWS credentials or a region
+    """
+    if not in_lambda():
+        return tuple(None for _ in service_names)
+    return tuple(get_client(service_name) for service_name in service_names)
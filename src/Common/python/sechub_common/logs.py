@@ -0,0 +1,150 @@
+#!/bin/python
+"""
+Logging configuration shared by the Lambda functions. Environment variables:
+
+    LOG_LEVEL         level of the root logger, INFO by default
+    LOG_FORMAT        "json" writes one JSON object per record, "text" keeps the plain format
+    LOG_MAX_LENGTH    messages are truncated to this number of characters, 2000 by default
+    LOG_SAMPLE_FIRST  records with a sample_key are logged for the first occurrences of the key, 10 by default
+    LOG_SAMPLE_EVERY  and every n-th occurrence after these, 100 by default
+
+Repetitive lines, e.g. one per control, pass extra={"sample_key": "<key>"} and are sampled per key.
+log_sampling_summary reports the suppressed records at the end of an invocation.
+"""
+
+import datetime
+import json
+import logging
+import os
+import sys
+import threading
+from collections import Counter
+
+DEFAULT_MAX_LENGTH = 2000
+DEFAULT_SAMPLE_FIRST = 10
+DEFAULT_SAMPLE_EVERY = 100
+# list items and dictionary keys kept by summarize
+SUMMARY_ITEMS = 5
+# attributes of every LogRecord, other attributes are passed with extra and written as JSON fields
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "sample_key"}
+
+
+class JsonFormatter(logging.Formatter):
+    """ Format records as JSON objects, fields passed with extra are added """
+
+    def format(self, record):
+        entry = {
+            "timestamp": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "message": record.getMessage(),
+            "logger": record.name,
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TruncatingFilter(logging.Filter):
+    """ Truncate messages longer than max_length characters """
+
+    def __init__(self, max_length):
+        super().__init__()
+        self.max_length = max_length
+
+    def filter(self, record):
+        message = record.getMessage()
+        if len(message) > self.max_length:
+            record.msg = "{}... ({} more characters)".format(message[:self.max_length], len(message) - self.max_length)
+            record.args = None
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """ Pass the first records of a sample_key and every n-th record after these, count the others """
+
+    def __init__(self, first, every):
+        super().__init__()
+        self.first = first
+        self.every = every
+        self.seen = Counter()
+        self.suppressed = Counter()
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        key = getattr(record, "sample_key", None)
+        if key is None:
+            return True
+        with self.lock:
+            self.seen[key] += 1
+            count = self.seen[key]
+            if count <= self.first or (count - self.first) % self.every == 0:
+                return True
+            self.suppressed[key] += 1
+            return False
+
+    def reset(self):
+        """ return suppressed records per key and start counting again """
+        with self.lock:
+            suppressed = dict(self.suppressed)
+            self.seen.clear()
+            self.suppressed.clear()
+        return suppressed
+
+
+sampling_filter = SamplingFilter(
+    int(os.environ.get("LOG_SAMPLE_FIRST", DEFAULT_SAMPLE_FIRST)),
+    int(os.environ.get("LOG_SAMPLE_EVERY", DEFAULT_SAMPLE_EVERY)),
+)
+
+
+def setup_logging():
+    """
+    Configure the root logger from the environment. The Lambda runtime installs its own handler, which is kept.
+    Return the root logger.
+    """
+    root = logging.getLogger()
+    if not root.handlers:
+        logging.basicConfig(stream=sys.stdout)
+    root.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+    max_length = int(os.environ.get("LOG_MAX_LENGTH", DEFAULT_MAX_LENGTH))
+    for handler in root.handlers:
+        if os.environ.get("LOG_FORMAT", "text").lower() == "json":
+            handler.setFormatter(JsonFormatter())
+        # sampled records are dropped before the truncation formats their message
+        if sampling_filter not in handler.filters:
+            handler.addFilter(sampling_filter)
+        if not any(isinstance(existing, TruncatingFilter) for existing in handler.filters):
+            handler.addFilter(TruncatingFilter(max_length))
+    return root
+
+
+def summarize(value, depth=2):
+    """
+    Return value with lists and dictionaries reduced to SUMMARY_ITEMS entries and nesting reduced to depth,
+    e.g. to log an event containing all exceptions
+    """
+    if isinstance(value, dict):
+        if depth <= 0:
+            return "<{} keys>".format(len(value))
+        summary = {key: summarize(item, depth - 1) for key, item in list(value.items())[:SUMMARY_ITEMS]}
+        if len(value) > SUMMARY_ITEMS:
+            summary["..."] = "{} more keys".format(len(value) - SUMMARY_ITEMS)
+        return summary
+    if isinstance(value, (list, tuple, set, frozenset)):
+        if depth <= 0:
+            return "<{} items>".format(len(value))
+        summary = [summarize(item, depth - 1) for item in list(value)[:SUMMARY_ITEMS]]
+        if len(value) > SUMMARY_ITEMS:
+            summary.append("... {} more items".format(len(value) - SUMMARY_ITEMS))
+        return summary
+    return value
+
+
+def log_sampling_summary(logger):
+    """ log the number of records suppressed by sampling since the last call """
+    suppressed = sampling_filter.reset()
+    if suppressed:
+        logger.info("Suppressed %s sampled log records: %s", sum(suppressed.values()), suppressed)
@@ -0,0 +1,214 @@
+#!/bin/python
+"""
+Instrumentation shared by the Lambda functions. A botocore event hook counts calls, retries, throttles, errors
+and latency per operation, account and region, timers measure the steps of a handler. Results are written as
+CloudWatch Embedded Metric Format (EMF) log lines and summarized in the handler payloads.
+"""
+
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+NAMESPACE = "SecurityHubControlsDisabler"
+THROTTLING_ERROR_CODES = ("Throttling", "ThrottlingException", "TooManyRequestsException", "LimitExceededException")
+# upper bounds of the latency histogram buckets in milliseconds
+LATENCY_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+def latency_bucket(latency_ms):
+    """ return histogram bucket label of latency_ms """
+    for bound in LATENCY_BUCKETS:
+        if latency_ms <= bound:
+            return "<=" + str(bound)
+    return ">" + str(LATENCY_BUCKETS[-1])
+
+
+def api_entry():
+    """ return empty statistics of an API operation """
+    return {"calls": 0, "retries": 0, "throttles": 0, "errors": 0, "latency_ms": 0.0, "max_latency_ms": 0.0,
+            "histogram": dict()}
+
+
+class Metrics:
+    """
+    Thread safe store of API call statistics and timers, keyed by (name, account, region)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.api = dict()
+        self.timers = dict()
+
+    def record_call(self, operation, account, region, latency_ms, retries=0, error=None):
+        with self.lock:
+            entry = self.api.setdefault((operation, account, region), api_entry())
+            entry["calls"] += 1
+            entry["retries"] += retries
+            entry["errors"] += 1 if error else 0
+            entry["latency_ms"] += latency_ms
+            entry["max_latency_ms"] = max(entry["max_latency_ms"], latency_ms)
+            bucket = latency_bucket(latency_ms)
+            entry["histogram"][bucket] = entry["histogram"].get(bucket, 0) + 1
+
+    def record_throttle(self, operation, account, region):
+        with self.lock:
+            entry = self.api.setdefault((operation, account, region), api_entry())
+            entry["throttles"] += 1
+
+    def record_time(self, name, account, region, elapsed_ms):
+        with self.lock:
+            entry = self.timers.setdefault((name, account, region), {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            entry["count"] += 1
+            entry["total_ms"] += elapsed_ms
+            entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+
+    def pop(self, accounts=None):
+        """
+        Remove and return (api, timers) entries of accounts, all entries if accounts is None
+        """
+        with self.lock:
+            api = {key: self.api.pop(key) for key in list(self.api) if accounts is None or key[1] in accounts}
+            timers = {key: self.timers.pop(key) for key in list(self.timers) if accounts is None or key[1] in accounts}
+        return api, timers
+
+
+# shared by all clients and threads of this container
+metrics = Metrics()
+
+
+def instrument_client(client, account_id=None, recorder=None):
+    """
+    Record calls of client in recorder, the shared Metrics by default. Return client.
+    """
+    recorder = recorder or metrics
+    region = client.meta.region_name
+    account = account_id or "self"
+
+    def before_call(context, **kwargs):
+        context["metrics_start"] = time.perf_counter()
+
+    def after_call(context, event_name, parsed=None, exception=None, **kwargs):
+        # after-call-error of connection errors has no model, the operation is the last part of the event name
+        start = context.pop("metrics_start", None)
+        if start is None:
+            return
+        error = exception or (parsed or {}).get("Error", {}).get("Code")
+        retries = (parsed or {}).get("ResponseMetadata", {}).get("RetryAttempts", 0)
+        recorder.record_call(event_name.rsplit(".", 1)[-1], account, region, (time.perf_counter() - start) * 1000,
+                             retries, error)
+
+    def needs_retry(operation, response=None, **kwargs):
+        if response and response[1].get("Error", {}).get("Code") in THROTTLING_ERROR_CODES:
+            recorder.record_throttle(operation.name, account, region)
+
+    events = client.meta.events
+    # runs after the more specific before-call handlers, the wait for a rate limit token is not part of the latency
+    events.register("before-call", before_call, unique_id="metrics-before-call")
+    events.register("after-call", after_call, unique_id="metrics-after-call")
+    events.register("after-call-error", after_call, unique_id="metrics-after-call-error")
+    events.register("needs-retry", needs_retry, unique_id="metrics-needs-retry")
+    return client
+
+
+@contextmanager
+def timed(name, account=None, region=None, recorder=None):
+    """ record the duration of the block as timer name """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        (recorder or metrics).record_time(name, account or "self", region, (time.perf_counter() - start) * 1000)
+
+
+def summarize(api, timers):
+    """
+    Return totals of api and timers entries for handler payloads. The payload of every account is part of the
+    state machine data, details per operation are only written to the EMF lines.
+    """
+    summary = {"calls": 0, "retries": 0, "throttles": 0, "errors": 0, "latency_ms": 0.0, "max_latency_ms": 0.0,
+               "timers": dict()}
+    for entry in api.values():
+        merge_entry(summary, {key: value for key, value in entry.items() if key != "histogram"})
+    for (name, _, _), entry in timers.items():
+        summary["timers"][name] = round(summary["timers"].get(name, 0) + entry["total_ms"], 3)
+    return summary
+
+
+def merge_entry(total, entry):
+    """ add counters of entry to total, maximum values are merged """
+    for key, value in entry.items():
+        if key.startswith("max_"):
+            total[key] = max(total.get(key, 0), value)
+        else:
+            total[key] = round(total.get(key, 0) + value, 3)
+
+
+def merge_summaries(total, summary):
+    """ add a summary returned by summarize to total. Return total. """
+    merge_entry(total, {key: value for key, value in summary.items() if key != "timers"})
+    timers = total.setdefault("timers", dict())
+    for name, elapsed_ms in summary.get("timers", {}).items():
+        timers[name] = round(timers.get(name, 0) + elapsed_ms, 3)
+    return total
+
+
+def emf_line(dimensions, properties, values, units):
+    """ return an EMF log line for values with dimensions """
+    return json.dumps(dict(
+        properties,
+        _aws={
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": NAMESPACE,
+                "Dimensions": [list(dimensions)],
+                "Metrics": [{"Name": name, "Unit": units[name]} for name in values],
+            }],
+        },
+        **dimensions,
+        **values
+    ))
+
+
+def emit(function_name, api, timers, stream=None):
+    """
+    Write one EMF line per operation, account and region and per timer. Account and region are properties
+    rather than dimensions to keep the number of CloudWatch metrics independent of the organization size.
+    """
+    stream = stream or sys.stdout
+    units = {"Calls": "Count", "Retries": "Count", "Throttles": "Count", "Errors": "Count", "Latency": "Milliseconds",
+             "MaxLatency": "Milliseconds", "Duration": "Milliseconds"}
+    for (operation, account, region), entry in api.items():
+        values = {"Calls": entry["calls"], "Retries": entry["retries"], "Throttles": entry["throttles"],
+                  "Errors": entry["errors"], "MaxLatency": entry["max_latency_ms"]}
+        if entry["calls"]:
+            values["Latency"] = round(entry["latency_ms"] / entry["calls"], 3)
+        properties = {"Account": account, "Region": region, "LatencyHistogram": entry["histogram"]}
+        stream.write(emf_line({"Function": function_name, "Operation": operation}, properties, values, units) + "\n")
+    for (name, account, region), entry in timers.items():
+        properties = {"Account": account, "Region": region, "Count": entry["count"], "MaxDuration": entry["max_ms"]}
+        values = {"Duration": round(entry["total_ms"], 3)}
+        stream.write(emf_line({"Function": function_name, "Timer": name}, properties, values, units) + "\n")
+    stream.flush()
+
+
+def flush(function_name, accounts=None, stream=None):
+    """
+    Emit and remove the entries of accounts, all entries if accounts is None. Return their summary.
+    """
+    api, timers = metrics.pop(accounts)
+    emit(function_name, api, timers, stream)
+    return summarize(api, timers)
+
+
+def emit_summary(function_name, summary, stream=None):
+    """ write one EMF line with the totals of summary, e.g. the aggregate of an execution """
+    stream = stream or sys.stdout
+    units = {"Calls": "Count", "Retries": "Count", "Throttles": "Count", "Errors": "Count",
+             "MaxLatency": "Milliseconds", "ApiTime": "Milliseconds"}
+    values = {"Calls": summary.get("calls", 0), "Retries": summary.get("retries", 0),
+              "Throttles": summary.get("throttles", 0), "Errors": summary.get("errors", 0),
+              "MaxLatency": summary.get("max_latency_ms", 0), "ApiTime": summary.get("latency_ms", 0)}
+    stream.write(emf_line({"Function": function_name}, {"Timers": summary.get("timers", {})}, values, units) + "\n")
+    stream.flush()
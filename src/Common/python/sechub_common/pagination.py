@@ -0,0 +1,114 @@
+#!/bin/python
+
+import queue
+import threading
+
+# pages buffered per scan segment, bounds memory of parallel scans
+MAX_BUFFERED_PAGES = 2
+_DONE = object()
+
+
+def paginate(method, items_key, **kwargs):
+    """
+    Yield items of all pages of an API using NextToken pagination, e.g. list_members or list_accounts
+    """
+    response = method(**kwargs)
+    yield from response[items_key]
+    while "NextToken" in response:
+        response = method(NextToken=response["NextToken"], **kwargs)
+        yield from response[items_key]
+
+
+def scan_pages(client, table_name, **kwargs):
+    """
+    Yield pages of a DynamoDB scan following LastEvaluatedKey
+    """
+    response = client.scan(TableName=table_name, **kwargs)
+    yield response
+    while "LastEvaluatedKey" in response:
+        response = client.scan(TableName=table_name, ExclusiveStartKey=response["LastEvaluatedKey"], **kwargs)
+        yield response
+
+
+def scan_table(client, table_name, segments=1, **kwargs):
+    """
+    Yield all items of a DynamoDB table. With segments > 1 the segments are scanned in parallel and
+    at most MAX_BUFFERED_PAGES pages per segment are kept in memory.
+    """
+    if segments <= 1:
+        for page in scan_pages(client, table_name, **kwargs):
+            yield from page["Items"]
+        return
+
+    pages = queue.Queue(maxsize=segments * MAX_BUFFERED_PAGES)
+    stop = threading.Event()
+
+    def scan_segment(segment):
+        try:
+            for page in scan_pages(client, table_name, Segment=segment, TotalSegments=segments, **kwargs):
+                if stop.is_set():
+                    break
+                pages.put(page)
+            pages.put(_DONE)
+        except Exception as error:
+            pages.put(error)
+
+    workers = [threading.Thread(target=scan_segment, args=(segment,), daemon=True) for segment in range(segments)]
+    for worker in workers:
+        worker.start()
+    running = segments
+    try:
+        while running:
+            page = pages.get()
+            if page is _DONE:
+                running -= 1
+            elif isinstance(page, Exception):
+                raise page
+            else:
+                yield from page["Items"]
+    finally:
+        # unblock workers if the consumer stops early
+        stop.set()
+        while any(worker.is_alive() for worker in workers):
+            try:
+                pages.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def prefetch(pages, buffered=MAX_BUFFERED_PAGES):
+    """
+    Yield the pages of an iterator which is advanced by a background thread, so the next pages are fetched
+    while the consumer processes the current one. At most buffered pages are kept in memory.
+    """
+    queue_ = queue.Queue(maxsize=buffered)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for page in pages:
+                if stop.is_set():
+                    break
+                queue_.put(page)
+            queue_.put(_DONE)
+        except Exception as error:
+            queue_.put(error)
+
+    worker = threading.Thread(target=produce, daemon=True)
+    worker.start()
+    try:
+        while True:
+            page = queue_.get()
+            if page is _DONE:
+                return
+            if isinstance(page, Exception):
+                raise page
+            yield page
+    finally:
+        # unblock the producer if the consumer stops early
+        stop.set()
+        while worker.is_alive():
+            try:
+                queue_.get(timeout=0.1)
+            except queue.Empty:
+                pass
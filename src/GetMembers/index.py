@@ -1,43 +1,71 @@
 #!/bin/python
 
-import logging
-import os, sys
-import boto3
+import base64
+import hashlib
+import os, json
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import botocore
+from sechub_common.init import get_client, preinit
+from sechub_common.logs import log_sampling_summary, setup_logging
+from sechub_common.metrics import flush as flush_metrics, timed
+from sechub_common.pagination import paginate, scan_table
 
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+logger = setup_logging()
 
 DISABLED_REASON = "Exception"
-securityhub_client = None
-organizations_client = None
-dynamodb_client = None
+ALL = "ALL"
+# clients are created during the Lambda init phase and reused by warm invocations
+securityhub_client, organizations_client, dynamodb_client, s3_client = preinit("securityhub", "organizations", "dynamodb", "s3")
+CATALOG_KEY = "catalog/{region}.json"
+PREFETCH_CONCURRENCY = 8
+DEFAULT_MAP_CONCURRENCY = 3
+EXCEPTIONS_KEY = "exceptions/{digest}.json"
+COMPACT_FORMAT = "compact-v1"
+ZLIB_FORMAT = "zlib"
+S3_FORMAT = "s3"
+ACCOUNTS_KEY = "accounts/{digest}.jsonl"
+DEFAULT_DISTRIBUTED_MAP_THRESHOLD = 500
+DEFAULT_DISTRIBUTED_MAP_CONCURRENCY = 40
+DEFAULT_BATCH_SIZE = 10
+DEFAULT_ACCOUNT_BATCH_SIZE = 1
+# Step Functions limits the state payload to 256 KB
+STATE_SIZE_LIMIT = 256 * 1024
+COMPRESS_THRESHOLD = 32 * 1024
+OFFLOAD_THRESHOLD = 96 * 1024
+# upper bound of the inline Map result of one account, UpdateMember keeps region details in S3 and truncates errors
+ACCOUNT_RESULT_SIZE = 1536
 
 
-def convert_exceptions(response, member_accounts):
+def convert_accounts(control, key):
     """
-    Convert exceptions from DynamoDB into simpler dictionary format
+    Return account list of an exception. "ALL" is kept symbolic and resolved by UpdateMember.
+    """
+    accounts = [entry["S"] for entry in control[key]["L"]]
+    if accounts and accounts[0] == ALL:
+        return [ALL]
+    return accounts
+
+
+def convert_exceptions(items):
+    """
+    Convert exception items from DynamoDB into simpler dictionary format
     """
     exceptions = dict()
-    for control in response["Items"]:
+    for control in items:
         exceptions[control["ControlId"]["S"]] = dict()
 
         try:
-            if control["Disabled"]["L"][0]["S"] == "ALL":
-                exceptions[control["ControlId"]["S"]]["Disabled"] = member_accounts
-            else:
-                exceptions[control["ControlId"]["S"]]["Disabled"] = [entry["S"] for entry in control["Disabled"]["L"]]
+            exceptions[control["ControlId"]["S"]]["Disabled"] = convert_accounts(control, "Disabled")
         except KeyError:
-            logger.info('%s: No "Disabled" exceptions', control["ControlId"]["S"])
+            logger.info('%s: No "Disabled" exceptions', control["ControlId"]["S"], extra={"sample_key": "exception_defaults"})
             exceptions[control["ControlId"]["S"]]["Disabled"] = []
 
         try:
-            if control["Enabled"]["L"][0]["S"] == "ALL":
-                exceptions[control["ControlId"]["S"]]["Enabled"] = member_accounts
-            else:
-                exceptions[control["ControlId"]["S"]]["Enabled"] = [entry["S"] for entry in control["Enabled"]["L"]]
+            exceptions[control["ControlId"]["S"]]["Enabled"] = convert_accounts(control, "Enabled")
         except KeyError:
-            logger.info('%s: No "Enabled" exceptions', control["ControlId"]["S"])
+            logger.info('%s: No "Enabled" exceptions', control["ControlId"]["S"], extra={"sample_key": "exception_defaults"})
             exceptions[control["ControlId"]["S"]]["Enabled"] = []
 
         try:
@@ -48,6 +76,7 @@ def convert_exceptions(response, member_accounts):
                     '%s: No "DisabledReason". Replace by "%s"',
                     control["ControlId"]["S"],
                     DISABLED_REASON,
+                    extra={"sample_key": "exception_defaults"},
                 )
                 exceptions[control["ControlId"]["S"]][
                     "DisabledReason"
@@ -57,86 +86,267 @@ def convert_exceptions(response, member_accounts):
                 '%s: No "DisabledReason". Replace by "%s"',
                 control["ControlId"]["S"],
                 DISABLED_REASON,
+                extra={"sample_key": "exception_defaults"},
             )
             exceptions[control["ControlId"]["S"]]["DisabledReason"] = DISABLED_REASON
         try:
             if control["Region"] != "":
                 exceptions[control["ControlId"]["S"]]["Region"] = [entry["S"] for entry in control["Region"]["L"]]
         except KeyError:
-            logger.info('%s: has not "Region" in exceptions', control["ControlId"]["S"])
+            logger.info('%s: has not "Region" in exceptions', control["ControlId"]["S"], extra={"sample_key": "exception_defaults"})
 
     return exceptions
 
 
-def get_members(client):
+def compact_exceptions(exceptions):
     """
-    Use pagination to fetch list of member accounts
+    Convert exceptions into the compact wire format. Identical account lists are stored once in "groups" and
+    referenced by index, every control is [disabled group, enabled group, DisabledReason, Region or None].
     """
-    response = client.list_members()
-    members = []
-    while response:
-        members += response["Members"]
-        if "NextToken" in response:
-            response = client.list_members(NextToken=response["NextToken"])
-        else:
-            response = None
+    groups = []
+    group_index = dict()
 
-    accounts = []
-    for member in members:
-        accounts.append(member["AccountId"])
-    return accounts
+    def group(accounts):
+        key = tuple(accounts)
+        if key not in group_index:
+            group_index[key] = len(groups)
+            groups.append(accounts)
+        return group_index[key]
+
+    controls = dict()
+    for control, exception in exceptions.items():
+        controls[control] = [
+            group(exception["Disabled"]),
+            group(exception["Enabled"]),
+            exception["DisabledReason"],
+            exception.get("Region"),
+        ]
+    return {"format": COMPACT_FORMAT, "groups": groups, "controls": controls}
+
+
+def encode_exceptions(exceptions, bucket=None):
+    """
+    Encode exceptions for the state machine payload. The compact format is compressed above COMPRESS_THRESHOLD
+    bytes and offloaded to bucket above OFFLOAD_THRESHOLD bytes, so the payload stays below the Step Functions limit.
+    """
+    compact = json.dumps(compact_exceptions(exceptions), separators=(",", ":"))
+    if len(compact) <= COMPRESS_THRESHOLD:
+        return json.loads(compact)
+    compressed = base64.b64encode(zlib.compress(compact.encode())).decode()
+    if len(compressed) <= OFFLOAD_THRESHOLD or not bucket:
+        logger.info("Exceptions compressed from %s to %s bytes", len(compact), len(compressed))
+        return {"format": ZLIB_FORMAT, "data": compressed}
+    global s3_client
+    if not s3_client:
+        s3_client = get_client("s3")
+    # content addressed key, UpdateMember caches the decoded exceptions by key
+    key = EXCEPTIONS_KEY.format(digest=hashlib.sha256(compact.encode()).hexdigest())
+    s3_client.put_object(Bucket=bucket, Key=key, Body=compact)
+    logger.info("Exceptions of %s bytes offloaded to s3://%s/%s", len(compact), bucket, key)
+    return {"format": S3_FORMAT, "bucket": bucket, "key": key}
+
+
+def write_accounts(accounts, bucket):
+    """
+    Write accounts as JSON lines to bucket for the distributed Map. Return the object location.
+    """
+    global s3_client
+    if not s3_client:
+        s3_client = get_client("s3")
+    body = "\n".join(json.dumps({"account": account}) for account in accounts)
+    key = ACCOUNTS_KEY.format(digest=hashlib.sha256(body.encode()).hexdigest())
+    s3_client.put_object(Bucket=bucket, Key=key, Body=body)
+    logger.info("%s accounts written to s3://%s/%s", len(accounts), bucket, key)
+    return {"Bucket": bucket, "Key": key}
+
+
+def batch_accounts(accounts, batch_size):
+    """
+    Split accounts into lists of batch_size accounts updated by one UpdateMember invocation of the inline Map.
+    A batch_size of 1 keeps one account per invocation.
+    """
+    if batch_size <= 1:
+        return accounts
+    return [accounts[start:start + batch_size] for start in range(0, len(accounts), batch_size)]
+
+
+def inline_map_fits(payload, accounts):
+    """
+    Return True if the results of the inline Map for accounts fit into the state next to payload
+    """
+    return len(json.dumps(payload)) + len(accounts) * ACCOUNT_RESULT_SIZE < STATE_SIZE_LIMIT
+
+
+def get_members(client):
+    """
+    Yield account ids of SecurityHub member accounts
+    """
+    for member in paginate(client.list_members, "Members"):
+        yield member["AccountId"]
 
 
 def get_active_accounts(client):
     """
-    Use pagination to fetch list of Organizations member accounts and return list of active(not suspended) accounts
+    Yield ids of active(not suspended) Organizations member accounts
+    """
+    for account in paginate(client.list_accounts, "Accounts"):
+        if account["Status"] == "ACTIVE":
+            yield account["Id"]
+
+
+def get_regions(client, table_name):
+    """
+    Return all regions configured for any account in the regions table
+    """
+    regions = set()
+    for account in scan_table(client, table_name, scan_segments()):
+        regions.update(entry["S"] for entry in account["Regions"]["L"])
+    return sorted(regions)
+
+
+def scan_segments():
+    """ return number of segments DynamoDB tables are scanned with in parallel """
+    return int(os.environ.get("ScanSegments", 1))
+
+
+def get_control_catalog(client, standards_arn):
+    """
+    Use pagination to fetch control definitions of a standard. Return available and unavailable control ids.
+    """
+    response = client.list_security_control_definitions(StandardsArn=standards_arn)
+    definitions = response["SecurityControlDefinitions"]
+    while "NextToken" in response:
+        response = client.list_security_control_definitions(StandardsArn=standards_arn, NextToken=response["NextToken"])
+        definitions += response["SecurityControlDefinitions"]
+    return {
+        "Available": [item["SecurityControlId"] for item in definitions if item.get("CurrentRegionAvailability") != "UNAVAILABLE"],
+        "Unavailable": [item["SecurityControlId"] for item in definitions if item.get("CurrentRegionAvailability") == "UNAVAILABLE"],
+    }
+
+
+def prefetch_region_catalog(client, region, standards, bucket):
     """
-    response = client.list_accounts()
-    active_members = []
+    Store standards and control catalog of region in bucket, so UpdateMember does not fetch it for every account
+    """
+    try:
+        catalog = {
+            "FetchedAt": time.time(),
+            "Standards": standards,
+            "Controls": {
+                standard["StandardsArn"]: get_control_catalog(client, standard["StandardsArn"])
+                for standard in standards
+            },
+        }
+        s3_client.put_object(Bucket=bucket, Key=CATALOG_KEY.format(region=region), Body=json.dumps(catalog))
+    except botocore.exceptions.ClientError as error:
+        # UpdateMember falls back to the SecurityHub API
+        logger.error("Control catalog for %s could not be prefetched: %s", region, error)
+
 
-    while response:
-        for account in response["Accounts"]:
-            if account["Status"] == "ACTIVE":
-                active_members.append(account["Id"])
+def get_region_baseline(region, bucket=None):
+    """
+    Return StandardsArn of standards enabled in the administrator account in region.
+    Prefetch control catalog of region into bucket if set.
+    """
+    # clients of every region are created once per container
+    client = get_client("securityhub", region)
+    try:
+        response = client.describe_standards()
+        standards = response["Standards"]
+        while "NextToken" in response:
+            response = client.describe_standards(NextToken=response["NextToken"])
+            standards += response["Standards"]
+        response = client.get_enabled_standards()
+        enabled_standards = response["StandardsSubscriptions"]
+        while "NextToken" in response:
+            response = client.get_enabled_standards(NextToken=response["NextToken"])
+            enabled_standards += response["StandardsSubscriptions"]
+    except botocore.exceptions.ClientError as error:
+        # UpdateMember falls back to reading the administrator account itself
+        logger.error("Baseline for %s could not be fetched: %s", region, error)
+        return None
+    if bucket:
+        prefetch_region_catalog(client, region, standards, bucket)
+    return [standard["StandardsArn"] for standard in enabled_standards]
 
-        if "NextToken" in response:
-            response = client.list_accounts(NextToken=response["NextToken"])
-        else:
-            response = None
 
-    return active_members
+def get_baseline(regions, bucket=None):
+    """
+    Snapshot enabled standards of the administrator account for all regions once per execution
+    """
+    global s3_client
+    if bucket and not s3_client:
+        s3_client = get_client("s3")
+    with ThreadPoolExecutor(max_workers=PREFETCH_CONCURRENCY) as executor:
+        region_baselines = list(executor.map(lambda region: get_region_baseline(region, bucket), regions))
+    baseline = {
+        region: region_baseline
+        for region, region_baseline in zip(regions, region_baselines)
+        if region_baseline is not None
+    }
+    logger.info("Administrator baseline: %s", baseline)
+    return baseline
 
 
 def lambda_handler(event, context):
 
     # get a list of all member accounts
-    # Optimization - no need to reinitilize the  security hub client for every instance of this Lambda function
     global securityhub_client
     if not securityhub_client:
-        securityhub_client = boto3.client("securityhub")
+        securityhub_client = get_client("securityhub")
 
     global organizations_client
     if not organizations_client:
-        organizations_client = boto3.client("organizations")
+        organizations_client = get_client("organizations")
 
     global dynamodb_client
     if not dynamodb_client:
-        dynamodb_client = boto3.client("dynamodb")
+        dynamodb_client = get_client("dynamodb")
 
-    member_accounts = get_members(securityhub_client)
-    active_accounts = get_active_accounts(organizations_client)
+    with timed("get_active_accounts"):
+        active_accounts = set(get_active_accounts(organizations_client))
 
     # Filter out suspended accounts from list of Security Hub member accounts.
     # This is for robustness because Security Hub shows suspended member accounts as 'Enabled"
     # when it was suspended without being removed from Security Hub administrator account.
     # SH Admin account will be treated as member account
-    member_accounts = list(set(member_accounts).intersection(active_accounts))
+    with timed("get_members"):
+        member_accounts = [account for account in set(get_members(securityhub_client)) if account in active_accounts]
     member_accounts.append(os.environ["SecHubAdminAccount"])
 
-    response = dynamodb_client.scan(TableName=os.environ["DynamoDB"])
-    exceptions = convert_exceptions(response, member_accounts)
-    return {
+    with timed("get_exceptions"):
+        exceptions = convert_exceptions(scan_table(dynamodb_client, os.environ["DynamoDB"], scan_segments()))
+
+    dry_run = str(event.get("dryRun", False)).lower() == "true"
+    regions = get_regions(dynamodb_client, os.environ["RegionsDynamoDB"])
+    with timed("get_baseline"):
+        baseline = get_baseline(regions, os.environ.get("ExecutionDataBucket"))
+    payload = {
         "statusCode": 200,
-        "accounts": member_accounts,
-        "exceptions": exceptions,
+        "accounts": batch_accounts(member_accounts, int(os.environ.get("AccountBatchSize", DEFAULT_ACCOUNT_BATCH_SIZE))),
+        "exceptions": encode_exceptions(exceptions, os.environ.get("ExecutionDataBucket")),
+        "baseline": baseline,
+        "dryRun": dry_run,
+        # ControlIds changed by the exceptions ingest, None reconciles all controls
+        "controls": event.get("controls"),
+        # skip the snapshot comparison of UpdateMember and reconcile every account
+        "forceFullSync": str(event.get("forceFullSync", False)).lower() == "true",
+        # dry runs never write and can run at a higher concurrency
+        "mapConcurrency": int(os.environ.get("PlanConcurrency" if dry_run else "MapConcurrency", DEFAULT_MAP_CONCURRENCY)),
     }
+
+    # Large organizations are updated by a distributed Map reading the accounts from S3, it writes the
+    # results to S3 instead of collecting them in the state
+    threshold = int(os.environ.get("DistributedMapThreshold", DEFAULT_DISTRIBUTED_MAP_THRESHOLD))
+    distributed = threshold and (len(member_accounts) >= threshold or not inline_map_fits(payload, member_accounts))
+    if os.environ.get("ExecutionDataBucket") and distributed:
+        del payload["accounts"]
+        payload["accountsLocation"] = write_accounts(member_accounts, os.environ["ExecutionDataBucket"])
+        payload["batchSize"] = int(os.environ.get("DistributedMapBatchSize", DEFAULT_BATCH_SIZE))
+        payload["toleratedFailurePercentage"] = int(os.environ.get("ToleratedFailurePercentage", 0))
+        distributed_concurrency = int(os.environ.get("DistributedMapConcurrency", DEFAULT_DISTRIBUTED_MAP_CONCURRENCY))
+        # dry runs never run narrower than the updates they plan
+        payload["mapConcurrency"] = max(payload["mapConcurrency"], distributed_concurrency) if dry_run else distributed_concurrency
+    payload["metrics"] = flush_metrics("GetMembers")
+    log_sampling_summary(logger)
+    return payload
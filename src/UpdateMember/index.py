@@ -1,17 +1,28 @@
 #!/bin/python
 
-import logging
-import os, json, sys
+import base64
+import hashlib
+import math
+import os, json
+import random
+import threading
 import time
+import zlib
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict
 import boto3
 import botocore
+import botocore.credentials
+import botocore.session
 
 from botocore.config import Config
+from sechub_common.init import get_client, preinit
+from sechub_common.logs import log_sampling_summary, setup_logging, summarize
+from sechub_common.metrics import THROTTLING_ERROR_CODES, flush as flush_metrics, instrument_client, merge_summaries, timed
+from sechub_common.pagination import prefetch
 
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+logger = setup_logging()
 
 
 def get_enabled_standard_subscriptions(standards, account_id, security_hub_client, region):
@@ -32,24 +43,92 @@ def get_enabled_standard_subscriptions(standards, account_id, security_hub_clien
     return enabled_standards
 
 
-def get_controls(enabled_standards, security_hub_client):
-    """ return list of controls for all enabled standards """
-    controls = dict()
-    for standard in enabled_standards["StandardsSubscriptions"]:
+def get_standards(security_hub_client):
+    """ return describe_standards response for the region of security_hub_client, cached for CatalogCacheTTL seconds """
+    region = security_hub_client.meta.region_name
+    cached = standards_cache.get(region)
+    if cached and cached[0] > time.time():
+        return cached[1]
+    load_shared_catalog(region)
+    cached = standards_cache.get(region)
+    if cached and cached[0] > time.time():
+        return cached[1]
+    response = security_hub_client.describe_standards()
+    standards = {"Standards": response["Standards"]}
+    while "NextToken" in response:
+        response = security_hub_client.describe_standards(NextToken=response["NextToken"])
+        standards["Standards"] = standards["Standards"] + response["Standards"]
+    standards_cache[region] = (time.time() + catalog_cache_ttl(), standards)
+    return standards
+
+
+def get_control_catalog(standards_arn, security_hub_client):
+    """ return (available, unavailable) control ids of standards_arn in the region of security_hub_client, cached for CatalogCacheTTL seconds """
+    region = security_hub_client.meta.region_name
+    cached = catalog_cache.get((region, standards_arn))
+    if cached and cached[0] > time.time():
+        return cached[1]
+    load_shared_catalog(region)
+    cached = catalog_cache.get((region, standards_arn))
+    if cached and cached[0] > time.time():
+        return cached[1]
+    response = security_hub_client.list_security_control_definitions(
+        StandardsArn=standards_arn)
+    definitions = response["SecurityControlDefinitions"]
+    while "NextToken" in response:
+        next_token = response["NextToken"]
         response = security_hub_client.list_security_control_definitions(
-            StandardsArn=standard["StandardsArn"])
-        controls[standard["StandardsArn"]] = response["SecurityControlDefinitions"]
-        while "NextToken" in response:
-            next_token = response["NextToken"]
-            response = security_hub_client.list_security_control_definitions(
-                StandardsArn=standard["StandardsArn"], NextToken=next_token)
-            controls[standard["StandardsArn"]] = controls[standard["StandardsArn"]] + response["SecurityControlDefinitions"]
+            StandardsArn=standards_arn, NextToken=next_token)
+        definitions = definitions + response["SecurityControlDefinitions"]
+    catalog = (
+        [item['SecurityControlId'] for item in definitions if item.get('CurrentRegionAvailability') != 'UNAVAILABLE'],
+        [item['SecurityControlId'] for item in definitions if item.get('CurrentRegionAvailability') == 'UNAVAILABLE'],
+    )
+    catalog_cache[(region, standards_arn)] = (time.time() + catalog_cache_ttl(), catalog)
+    return catalog
+
+
+def load_shared_catalog(region):
+    """
+    Load the catalog prefetched by GetMembers for this execution from the ExecutionDataBucket into the module cache.
+    Entries older than CatalogCacheTTL are ignored.
+    """
+    bucket = os.environ.get("ExecutionDataBucket")
+    if not bucket:
+        return
+    global s3_client
+    if not s3_client:
+        s3_client = get_client("s3")
+    try:
+        shared_catalog = json.loads(s3_client.get_object(Bucket=bucket, Key=CATALOG_KEY.format(region=region))["Body"].read())
+    except botocore.exceptions.ClientError as error:
+        logger.info("No shared control catalog for %s: %s", region, error)
+        return
+    expires_at = shared_catalog["FetchedAt"] + catalog_cache_ttl()
+    if expires_at <= time.time():
+        logger.info("Shared control catalog for %s expired", region)
+        return
+    standards_cache[region] = (expires_at, {"Standards": shared_catalog["Standards"]})
+    for standards_arn, catalog in shared_catalog["Controls"].items():
+        catalog_cache[(region, standards_arn)] = (expires_at, (catalog["Available"], catalog["Unavailable"]))
+
+
+def catalog_cache_ttl():
+    return int(os.environ.get("CatalogCacheTTL", DEFAULT_CATALOG_CACHE_TTL))
+
+
+def get_controls(enabled_standards, security_hub_client, control_ids=None):
+    """ return list of controls for all enabled standards, restricted to control_ids if set """
+    controls = dict()
     removed_items = []
-    for key, value in controls.items():
-        control_items = [item['SecurityControlId'] for item in value if item.get('CurrentRegionAvailability') != 'UNAVAILABLE']
-        removed_items.extend([item['SecurityControlId'] for item in value if item.get('CurrentRegionAvailability') == 'UNAVAILABLE'])
-        controls[key] = control_items
-    logger.info("controls not available: %s for standards: %s", removed_items, enabled_standards['StandardsSubscriptions'])
+    for standard in enabled_standards["StandardsSubscriptions"]:
+        available, unavailable = get_control_catalog(standard["StandardsArn"], security_hub_client)
+        if control_ids is not None:
+            available = [control for control in available if control in control_ids]
+        controls[standard["StandardsArn"]] = available
+        removed_items.extend(unavailable)
+    logger.info("controls not available: %s for standards: %s", summarize(removed_items),
+                [standard["StandardsArn"] for standard in enabled_standards['StandardsSubscriptions']])
     return controls
 
 
@@ -59,98 +138,526 @@ class SecurityStandardUpdateError(Exception):
     pass
 
 
-sts_client = None
+class ControlUpdateError(Exception):
+    """ Error Class for failed control association update """
+
+    pass
+
+
 DISABLED_REASON = "Control disabled because control in DDB but not reason provided."
 DISABLED = "DISABLED"
 ENABLED = "ENABLED"
-dynamodb_client = None
+# GetMembers keeps organization wide exceptions symbolic instead of listing every account
+ALL = "ALL"
+# BatchUpdateStandardsControlAssociations accepts up to 100 updates per call
+MAX_BATCH_SIZE = 100
+MAX_UPDATE_ATTEMPTS = 5
+RETRYABLE_ERROR_CODES = ("LIMIT_EXCEEDED",)
+DEFAULT_REGION_CONCURRENCY = 4
+DEFAULT_ACCOUNT_CONCURRENCY = 4
+DEFAULT_MAX_IN_FLIGHT = 8
+DEFAULT_CATALOG_CACHE_TTL = 3600
+DEFAULT_STANDARDS_WAIT_TIMEOUT = 600
+STANDARDS_WAIT_INITIAL_DELAY = 1
+STANDARDS_WAIT_MAX_DELAY = 16
+MAX_RESUME_ATTEMPTS = 20
+CATALOG_KEY = "catalog/{region}.json"
+# SecurityHub quotas per account and region as (requests per second, burst), keyed by the operations called
+API_RATE_LIMITS = {
+    "BatchEnableStandards": (1, 1),
+    "BatchDisableStandards": (1, 1),
+    "GetEnabledStandards": (1, 1),
+    # paced like UpdateStandardsControl, which it replaces
+    "BatchUpdateStandardsControlAssociations": (1, 5),
+    "default": (10, 30),
+}
+RATE_LIMIT_ITEM_TTL = 60
+rate_limiter = None
+throttle_counts = Counter()
+throttle_lock = threading.Lock()
+# clients are created during the Lambda init phase and reused by warm invocations
+sts_client, dynamodb_client, s3_client = preinit("sts", "dynamodb", "s3")
+MAX_POOLED_SESSIONS = 32
+MAX_POOLED_CLIENTS = 128
+CLIENT_CONFIG = Config(retries={"max_attempts": 23, "mode": "adaptive"})
+DEFAULT_REGIONS_CACHE_TTL = 300
+DEFAULT_FULL_RESYNC_INTERVAL = 7 * 24 * 3600
+SNAPSHOT_KEY = "{account}#{region}"
+DETAILS_KEY = "details/{execution}/{account}.json"
+# the inline Map collects the results of all accounts in one state of at most 256 KB
+MAX_ERROR_LENGTH = 256
+regions_cache = dict()
+# Control catalogs are identical for all accounts, keep them for warm invocations
+standards_cache = dict()
+catalog_cache = dict()
+exception_index_cache = dict()
+COMPACT_FORMAT = "compact-v1"
+ZLIB_FORMAT = "zlib"
+S3_FORMAT = "s3"
 
 
 def get_control_status(standard_control_association, member_security_hub_client):
     response = member_security_hub_client.batch_get_standards_control_associations(
         StandardsControlAssociationIds=standard_control_association)
+    if response.get('UnprocessedAssociations'):
+        logger.warning("Status of %s controls could not be read: %s", len(response['UnprocessedAssociations']),
+                       summarize(response['UnprocessedAssociations']))
     return response['StandardsControlAssociationDetails']
 
 
-def update_member(controls, security_hub_client, exceptions):
+def decide_control_update(control, exceptions):
+    """
+    Return the association update needed for control to match exceptions and administrator defaults, None if it is compliant
+    """
+    if control['SecurityControlId'] in exceptions["Disabled"]:
+        if control['AssociationStatus'] != DISABLED:
+            logger.info(" %s control will be disabled in %s", control['SecurityControlId'], control['StandardsArn'],
+                        extra={"sample_key": "control_update"})
+            # Disable control in target account
+            return update_control_status(
+                control['StandardsArn'], control['SecurityControlId'],
+                DISABLED,
+                disabled_reason=exceptions["DisabledReason"][
+                    control["SecurityControlId"]
+                ],
+            )
+    elif control['SecurityControlId'] in exceptions["Enabled"]:
+        if control['AssociationStatus'] != ENABLED:
+            # Enable control in member account
+            logger.info(" %s control will be enabled in %s", control['SecurityControlId'], control['StandardsArn'],
+                        extra={"sample_key": "control_update"})
+            return update_control_status(
+                control['StandardsArn'], control['SecurityControlId'],
+                ENABLED
+            )
+    elif control['AssociationStatus'] != ENABLED:
+        # Enable control in member account
+        logger.info(" %s control not in DDB and disabled in %s", control['SecurityControlId'], control['StandardsArn'],
+                    extra={"sample_key": "control_update"})
+        return update_control_status(
+            control['StandardsArn'], control['SecurityControlId'],
+            ENABLED
+        )
+    return None
+
+
+def get_status_chunks(controls, security_hub_client):
     """
-    Identifying which control needs to be updated
+    Yield the association status of all controls in chunks of MAX_BATCH_SIZE, fetched when the chunk is requested
     """
     standard_control_association = []
-    control_count = 0
-    control_status = []
     for admin_key in controls:
         for control in controls[admin_key]:
-            control_count += 1
             standard_control_association.append({'StandardsArn': admin_key, 'SecurityControlId': control})
-            if control_count == 100:
-                control_status.extend(get_control_status(standard_control_association, security_hub_client))
+            if len(standard_control_association) == MAX_BATCH_SIZE:
+                yield get_control_status(standard_control_association, security_hub_client)
                 standard_control_association = []
-                control_count = 0
-    control_status.extend(get_control_status(standard_control_association, security_hub_client))
-    for control in control_status:
-        if control['SecurityControlId'] in exceptions["Disabled"]:
-            if control['AssociationStatus'] != DISABLED:
-                logger.info(" %s control will be disabled in %s", control['SecurityControlId'], control['StandardsArn'])
-                # Disable control in target account
-                update_control_status(
-                    control['StandardsArn'], control['SecurityControlId'],
-                    security_hub_client,
-                    DISABLED,
-                    disabled_reason=exceptions["DisabledReason"][
-                        control["SecurityControlId"]
-                    ],
-                )
-        elif control['SecurityControlId'] in exceptions["Enabled"]:
-            if control['AssociationStatus'] != ENABLED:
-                # Enable control in member account
-                logger.info(" %s control will be enabled in %s", control['SecurityControlId'], control['StandardsArn'])
-                update_control_status(
-                    control['StandardsArn'], control['SecurityControlId'],
-                    security_hub_client,
-                    ENABLED
-                )
-        elif control['AssociationStatus'] != ENABLED:
-            # Enable control in member account
-            logger.info(" %s control not in DDB and disabled in %s", control['SecurityControlId'], control['StandardsArn'])
-            update_control_status(
-                control['StandardsArn'], control['SecurityControlId'],
-                security_hub_client,
-                ENABLED
+    if standard_control_association:
+        yield get_control_status(standard_control_association, security_hub_client)
+
+
+def get_controls_status(controls, security_hub_client):
+    """
+    Yield association status of all controls, fetched in batches of MAX_BATCH_SIZE
+    """
+    for chunk in get_status_chunks(controls, security_hub_client):
+        yield from chunk
+
+
+def update_member(controls, security_hub_client, exceptions):
+    """
+    Identifying which control needs to be updated. Return batch statistics.
+    Status chunks are evaluated as they arrive, the next chunk is fetched while updates of the current one are sent.
+    """
+    exceptions = dict(exceptions, Disabled=set(exceptions["Disabled"]), Enabled=set(exceptions["Enabled"]))
+    batcher = ControlUpdateBatcher(security_hub_client)
+    for chunk in prefetch(get_status_chunks(controls, security_hub_client)):
+        for control in chunk:
+            update = decide_control_update(control, exceptions)
+            if update:
+                batcher.add(update)
+    batcher.flush()
+    return finish_updates(batcher)
+
+
+def finish_updates(batcher):
+    """
+    Log the update statistics of batcher. Return them, raise ControlUpdateError if controls could not be updated.
+    """
+    logger.info("%s controls changed with %s API calls", batcher.controls_changed, batcher.api_calls)
+    if batcher.failed:
+        raise ControlUpdateError(
+            "Controls could not be updated: " + str(batcher.failed)
+        )
+    return batcher.stats()
+
+
+def send_updates(updates, security_hub_client):
+    """
+    Send one batch of control updates. Return its ControlUpdateBatcher.
+    """
+    batcher = ControlUpdateBatcher(security_hub_client)
+    batcher.pending = list(updates)
+    batcher.flush()
+    return batcher
+
+
+async def reconcile_controls(controls, security_hub_client, exceptions, max_in_flight):
+    """
+    Fetch the status of all controls in batches of MAX_BATCH_SIZE and send updates as soon as MAX_BATCH_SIZE of them
+    are decided, with up to max_in_flight requests running. Return the ControlUpdateBatcher totals.
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(max_in_flight)
+    # boto3 is blocking, requests run in threads and the event loop schedules them
+    executor = ThreadPoolExecutor(max_workers=max_in_flight)
+
+    async def call(function, *args):
+        async with semaphore:
+            return await loop.run_in_executor(executor, function, *args)
+
+    associations = [
+        {'StandardsArn': standards_arn, 'SecurityControlId': control}
+        for standards_arn in controls for control in controls[standards_arn]
+    ]
+    status_requests = [
+        asyncio.ensure_future(call(get_control_status, associations[start:start + MAX_BATCH_SIZE], security_hub_client))
+        for start in range(0, len(associations), MAX_BATCH_SIZE)
+    ]
+    update_requests = []
+    updates = []
+    try:
+        for status_request in asyncio.as_completed(status_requests):
+            for control in await status_request:
+                update = decide_control_update(control, exceptions)
+                if update:
+                    updates.append(update)
+                    if len(updates) == MAX_BATCH_SIZE:
+                        update_requests.append(asyncio.ensure_future(call(send_updates, updates, security_hub_client)))
+                        updates = []
+        if updates:
+            update_requests.append(asyncio.ensure_future(call(send_updates, updates, security_hub_client)))
+        batchers = await asyncio.gather(*update_requests)
+    finally:
+        for request in status_requests + update_requests:
+            request.cancel()
+        executor.shutdown(wait=True)
+
+    totals = ControlUpdateBatcher(security_hub_client)
+    for batcher in batchers:
+        totals.api_calls += batcher.api_calls
+        totals.controls_changed += batcher.controls_changed
+        totals.failed.extend(batcher.failed)
+    return totals
+
+
+def update_member_async(controls, security_hub_client, exceptions):
+    """
+    Same as update_member, but status fetches and updates are pipelined with up to MaxInFlight requests
+    per region. Return batch statistics.
+    """
+    exceptions = dict(exceptions, Disabled=set(exceptions["Disabled"]), Enabled=set(exceptions["Enabled"]))
+    max_in_flight = int(os.environ.get("MaxInFlight", DEFAULT_MAX_IN_FLIGHT))
+    # imported on first use, the default engine does not pay for it at cold start
+    import asyncio
+    # every region thread runs its own event loop
+    batcher = asyncio.run(reconcile_controls(controls, security_hub_client, exceptions, max_in_flight))
+    return finish_updates(batcher)
+
+
+def get_update_engine():
+    """ return update_member or update_member_async, selected by the ReconcileEngine environment variable """
+    if os.environ.get("ReconcileEngine", "sync").lower() == "async":
+        return update_member_async
+    return update_member
+
+
+def plan_member(controls, security_hub_client, exceptions):
+    """
+    Identifying which control needs to be updated without updating it. Return {StandardsArn: [[ControlId, current, desired]]}.
+    """
+    plan = dict()
+    exceptions = dict(exceptions, Disabled=set(exceptions["Disabled"]), Enabled=set(exceptions["Enabled"]))
+    for control in get_controls_status(controls, security_hub_client):
+        update = decide_control_update(control, exceptions)
+        if update:
+            plan.setdefault(control['StandardsArn'], []).append(
+                [control['SecurityControlId'], control['AssociationStatus'], update['AssociationStatus']]
             )
+    return plan
 
 
-def update_control_status(standard_control, control_id, client, new_status, disabled_reason=None):
+def update_control_status(standard_control, control_id, new_status, disabled_reason=None):
     """
-    Updates the Security Hub control as specified in the the security hub administrator account
+    Build the association update for a Security Hub control as specified in the the security hub administrator account
     """
+    update = {
+        'StandardsArn': standard_control,
+        'SecurityControlId': control_id,
+        'AssociationStatus': new_status
+    }
     if DISABLED == new_status:
-        client.batch_update_standards_control_associations(
-            StandardsControlAssociationUpdates=[
-                {
-                    'StandardsArn': standard_control,
-                    'SecurityControlId': control_id,
-                    'AssociationStatus': new_status,
-                    'UpdatedReason': disabled_reason if disabled_reason else DISABLED_REASON
-                }
-            ]
-        )
-    else:
-        # ENABLE control
-        client.batch_update_standards_control_associations(
-            StandardsControlAssociationUpdates=[
-                {
-                    'StandardsArn': standard_control,
-                    'SecurityControlId': control_id,
-                    'AssociationStatus': new_status
-                }
-            ]
+        update['UpdatedReason'] = disabled_reason if disabled_reason else DISABLED_REASON
+    return update
+
+
+class ControlUpdateBatcher:
+    """
+    Group control association updates into batches of MAX_BATCH_SIZE and retry unprocessed updates
+    """
+
+    def __init__(self, client, batch_size=MAX_BATCH_SIZE, max_attempts=MAX_UPDATE_ATTEMPTS):
+        self.client = client
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.pending = []
+        self.api_calls = 0
+        self.controls_changed = 0
+        self.failed = []
+
+    def add(self, update):
+        self.pending.append(update)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        while self.pending:
+            batch = self.pending[:self.batch_size]
+            self.pending = self.pending[self.batch_size:]
+            self._send(batch)
+
+    def _send(self, batch):
+        attempt = 1
+        while batch:
+            self.api_calls += 1
+            response = self.client.batch_update_standards_control_associations(
+                StandardsControlAssociationUpdates=batch
+            )
+            unprocessed = response.get("UnprocessedAssociationUpdates", [])
+            self.controls_changed += len(batch) - len(unprocessed)
+            retry = []
+            for item in unprocessed:
+                if item.get("ErrorCode") in RETRYABLE_ERROR_CODES and attempt < self.max_attempts:
+                    retry.append(item["StandardsControlAssociationUpdate"])
+                else:
+                    logger.error("Control update failed: %s", item)
+                    self.failed.append({
+                        "SecurityControlId": item["StandardsControlAssociationUpdate"]["SecurityControlId"],
+                        "StandardsArn": item["StandardsControlAssociationUpdate"]["StandardsArn"],
+                        "ErrorCode": item.get("ErrorCode"),
+                    })
+            if retry:
+                logger.info("Retry %s unprocessed control updates", len(retry))
+                time.sleep(min(2 ** attempt * 0.1, 5))
+            attempt += 1
+            batch = retry
+
+    def stats(self):
+        return {
+            "controls_changed": self.controls_changed,
+            "api_calls": self.api_calls,
+            "failed": len(self.failed),
+        }
+
+
+class LocalRateLimiter:
+    """
+    In-process token bucket per key. Stand-in for DynamoDBRateLimiter when no RateLimitTable is configured.
+    """
+
+    def __init__(self, rates=None):
+        self.rates = rates or API_RATE_LIMITS
+        self.buckets = dict()
+        self.lock = threading.Lock()
+
+    def acquire(self, key, api):
+        """ Block until a token for api is available in the bucket of key. Return seconds waited. """
+        rate, burst = self.rates.get(api, self.rates["default"])
+        waited = 0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                tokens, updated_at = self.buckets.get(key, (burst, now))
+                tokens = min(burst, tokens + (now - updated_at) * rate)
+                if tokens >= 1:
+                    self.buckets[key] = (tokens - 1, now)
+                    return waited
+                self.buckets[key] = (tokens, now)
+                delay = (1 - tokens) / rate
+            time.sleep(delay)
+            waited += delay
+
+
+class DynamoDBRateLimiter:
+    """
+    Token bucket per key shared by all UpdateMember invocations. Every bucket holds burst tokens and is refilled
+    at the start of every window of burst / rate seconds, the tokens taken in a window are counted in an item of table.
+    """
+
+    def __init__(self, client, table, rates=None):
+        self.client = client
+        self.table = table
+        self.rates = rates or API_RATE_LIMITS
+
+    def acquire(self, key, api):
+        """ Block until a token for api is available in the bucket of key. Return seconds waited. """
+        rate, burst = self.rates.get(api, self.rates["default"])
+        window_seconds = max(burst / rate, 1)
+        tokens = max(round(rate * window_seconds), 1)
+        waited = 0
+        while True:
+            window = int(time.time() / window_seconds)
+            try:
+                self.client.update_item(
+                    TableName=self.table,
+                    Key={"BucketKey": {"S": "{}#{}".format(key, window)}},
+                    UpdateExpression="ADD Tokens :one SET ExpiresAt = :expires_at",
+                    ConditionExpression="attribute_not_exists(Tokens) OR Tokens < :tokens",
+                    ExpressionAttributeValues={
+                        ":one": {"N": "1"},
+                        ":tokens": {"N": str(tokens)},
+                        ":expires_at": {"N": str(int((window + 1) * window_seconds) + RATE_LIMIT_ITEM_TTL)},
+                    },
+                )
+                return waited
+            except botocore.exceptions.ClientError as error:
+                if error.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    # the limiter must not fail the update, botocore retries still handle throttling
+                    logger.warning("Rate limiter unavailable: %s", error)
+                    return waited
+            # spread the workers waiting for the next window
+            delay = (window + 1) * window_seconds - time.time() + random.uniform(0, 0.1)
+            time.sleep(max(delay, 0))
+            waited += max(delay, 0)
+
+
+def get_rate_limiter():
+    """ return rate limiter shared by all workers of this container """
+    global rate_limiter
+    if not rate_limiter:
+        rates = dict(API_RATE_LIMITS, **json.loads(os.environ.get("RateLimits", "{}")))
+        if os.environ.get("RateLimitTable"):
+            rate_limiter = DynamoDBRateLimiter(get_client("dynamodb"), os.environ["RateLimitTable"], rates)
+        else:
+            rate_limiter = LocalRateLimiter(rates)
+    return rate_limiter
+
+
+def rate_limit_client(client, account_id, region):
+    """
+    Pace the SecurityHub calls of client with the rate limiter of account_id and region and count throttled calls
+    """
+    limiter = get_rate_limiter()
+
+    def before_call(model, **kwargs):
+        limiter.acquire("{}#{}#{}".format(account_id, region, model.name), model.name)
+
+    def needs_retry(response=None, **kwargs):
+        if response and response[1].get("Error", {}).get("Code") in THROTTLING_ERROR_CODES:
+            with throttle_lock:
+                throttle_counts[(account_id, region)] += 1
+
+    client.meta.events.register("before-call.securityhub", before_call)
+    client.meta.events.register("needs-retry.securityhub", needs_retry)
+    return client
+
+
+def assume_role(role_arn):
+    """ return credentials of role_arn as metadata of botocore refreshable credentials """
+    global sts_client
+    if not sts_client:
+        sts_client = get_client("sts")
+    credentials = sts_client.assume_role(RoleArn=role_arn, RoleSessionName="SecurityHubUpdater")["Credentials"]
+    return {
+        "access_key": credentials["AccessKeyId"],
+        "secret_key": credentials["SecretAccessKey"],
+        "token": credentials["SessionToken"],
+        "expiry_time": credentials["Expiration"].isoformat(),
+    }
+
+
+class AssumeRoleProvider(botocore.credentials.CredentialProvider):
+    """
+    Credential provider of a botocore session returning refreshable credentials of role_arn
+    """
+
+    METHOD = "securityhub-updater-assume-role"
+
+    def __init__(self, role_arn):
+        super().__init__()
+        self.role_arn = role_arn
+
+    def load(self):
+        return botocore.credentials.RefreshableCredentials.create_from_metadata(
+            metadata=assume_role(self.role_arn),
+            refresh_using=lambda: assume_role(self.role_arn),
+            method=self.METHOD,
         )
 
 
-def update_standard_subscription(administrator_enabled_standards, member_enabled_standards, client):
+class ClientPool:
+    """
+    Reuse sessions per role and SecurityHub clients per (account, region, role) across regions and warm
+    invocations. Assumed role credentials are refreshed by botocore shortly before they expire.
+    The least recently used sessions and clients are dropped above max_sessions and max_clients.
+    """
+
+    def __init__(self, config, max_sessions=MAX_POOLED_SESSIONS, max_clients=MAX_POOLED_CLIENTS):
+        self.config = config
+        self.max_sessions = max_sessions
+        self.max_clients = max_clients
+        self.sessions = OrderedDict()
+        self.clients = OrderedDict()
+        self.data_loader = None
+        # boto3 sessions are not thread safe, clients are
+        self.lock = threading.RLock()
+
+    def session(self, role_arn=None):
+        """ return boto3 session of role_arn, of the Lambda execution role if None """
+        with self.lock:
+            if role_arn not in self.sessions:
+                self.sessions[role_arn] = self._create_session(role_arn)
+                if len(self.sessions) > self.max_sessions:
+                    self.sessions.popitem(last=False)
+            self.sessions.move_to_end(role_arn)
+            return self.sessions[role_arn]
+
+    def _create_session(self, role_arn):
+        botocore_session = botocore.session.get_session()
+        # the endpoint and service model data is loaded and cached once for all sessions of the pool
+        with self.lock:
+            if self.data_loader is None:
+                self.data_loader = botocore_session.get_component("data_loader")
+        botocore_session.register_component("data_loader", self.data_loader)
+        if not role_arn:
+            return boto3.session.Session(botocore_session=botocore_session)
+        # the role is resolved before the environment credentials of the Lambda execution role
+        botocore_session.get_component("credential_provider").insert_before("env", AssumeRoleProvider(role_arn))
+        # assume the role now, so errors are reported for the account and not by its first SecurityHub call
+        botocore_session.get_credentials()
+        return boto3.session.Session(botocore_session=botocore_session)
+
+    def client(self, account_id, region, role_arn=None):
+        """ return rate limited SecurityHub client of account_id in region """
+        key = (account_id, region, role_arn)
+        with self.lock:
+            if key not in self.clients:
+                client = self.session(role_arn).client("securityhub", region_name=region, config=self.config)
+                self.clients[key] = instrument_client(rate_limit_client(client, account_id, region), account_id)
+                if len(self.clients) > self.max_clients:
+                    self.clients.popitem(last=False)
+            self.clients.move_to_end(key)
+            return self.clients[key]
+
+
+# shared by all region workers and warm invocations of this container
+client_pool = ClientPool(CLIENT_CONFIG)
+
+
+def plan_standard_subscription(administrator_enabled_standards, member_enabled_standards, client):
     """
-    Update security standards to reflect state in administrator account
+    Return standards to be enabled (StandardsSubscriptionRequests) and subscriptions to be disabled in the member account
     """
     admin_standard_arns = [
         standard["StandardsArn"]
@@ -160,7 +667,7 @@ def update_standard_subscription(administrator_enabled_standards, member_enabled
         standard["StandardsArn"]
         for standard in member_enabled_standards["StandardsSubscriptions"]
     ]
-    standards = client.describe_standards()["Standards"]
+    standards = get_standards(client)["Standards"]
     standard_to_be_enabled = []
     standard_to_be_disabled = []
 
@@ -185,42 +692,38 @@ def update_standard_subscription(administrator_enabled_standards, member_enabled
                         subscription["StandardsSubscriptionArn"]
                     )
 
+    return standard_to_be_enabled, standard_to_be_disabled
+
+
+def update_standard_subscription(administrator_enabled_standards, member_enabled_standards, client, wait=True, metrics=None, changed=None):
+    """
+    Update security standards to reflect state in administrator account. Wait until the changed subscriptions
+    are settled unless wait is False. Seconds waited are added to metrics["standards_wait_seconds"], the ARNs of
+    the changed subscriptions are appended to changed.
+    """
+    standard_to_be_enabled, standard_to_be_disabled = plan_standard_subscription(
+        administrator_enabled_standards, member_enabled_standards, client
+    )
+
     standards_changed = False
 
     if len(standard_to_be_enabled) > 0:
         # enable standard
         logger.info("Enable standards: %s", str(standard_to_be_enabled))
-        client.batch_enable_standards(
+        response = client.batch_enable_standards(
             StandardsSubscriptionRequests=standard_to_be_enabled
         )
-        ready = False
-        while not ready:
-            response = client.get_enabled_standards()
-            subscription_statuses = [
-                subscription["StandardsStatus"]
-                for subscription in response["StandardsSubscriptions"]
-            ]
-            ready = all(
-                (status in ("READY", "INCOMPLETE") for status in subscription_statuses)
-            )
-            if not ready:
-                if "FAILED" in subscription_statuses:
-                    logger.error(
-                        "Standard could not be enabled: %s",
-                        str(response["StandardsSubscriptions"]),
-                    )
-                    raise SecurityStandardUpdateError(
-                        "Security standard could not be enabled: "
-                        + str(response["StandardsSubscriptions"])
-                    )
-            logger.info("Wait until standards are enabled...")
-            time.sleep(1)
-        if "INCOMPLETE" in subscription_statuses:
-            logger.info(
-                "Standard could not be enabled completely. Some controls may not be available: %s",
-                str(response["StandardsSubscriptions"]),
-            )
-        logger.info("Standards enabled")
+        subscription_arns = [
+            subscription["StandardsSubscriptionArn"]
+            for subscription in response["StandardsSubscriptions"]
+        ]
+        if changed is not None:
+            changed.extend(subscription_arns)
+        if wait:
+            wait_seconds = wait_for_standards(client, subscription_arns, "enabled")
+            if metrics is not None:
+                metrics["standards_wait_seconds"] = metrics.get("standards_wait_seconds", 0) + wait_seconds
+            logger.info("Standards enabled")
         standards_changed = True
 
     if len(standard_to_be_disabled) > 0:
@@ -229,83 +732,208 @@ def update_standard_subscription(administrator_enabled_standards, member_enabled
         client.batch_disable_standards(
             StandardsSubscriptionArns=standard_to_be_disabled
         )
-        ready = False
-        while not ready:
-            response = client.get_enabled_standards()
-            subscription_statuses = [
-                subscription["StandardsStatus"]
-                for subscription in response["StandardsSubscriptions"]
-            ]
-            ready = all(
-                (status in ("READY", "INCOMPLETE") for status in subscription_statuses)
-            )
-            if not ready:
-                if "FAILED" in subscription_statuses:
-                    logger.error(
-                        "Standard could not be disabled: %s",
-                        str(response["StandardsSubscriptions"]),
-                    )
-                    raise SecurityStandardUpdateError(
-                        "Security standard could not be disabled: "
-                        + str(response["StandardsSubscriptions"])
-                    )
-            logger.info("Wait until standards are disabled...")
-            time.sleep(1)
-        if "INCOMPLETE" in subscription_statuses:
-            logger.info(
-                "Standard could not be enabled completely. Some controls may not be available: %s",
-                str(response["StandardsSubscriptions"]),
-            )
-        logger.info("Standards disabled")
+        if changed is not None:
+            changed.extend(standard_to_be_disabled)
+        if wait:
+            wait_seconds = wait_for_standards(client, standard_to_be_disabled, "disabled")
+            if metrics is not None:
+                metrics["standards_wait_seconds"] = metrics.get("standards_wait_seconds", 0) + wait_seconds
+            logger.info("Standards disabled")
         standards_changed = True
     return standards_changed
 
 
-def get_exceptions(event, region):
+def get_subscription_statuses(client, subscription_arns):
     """
-    extract exceptions related to the processed account from event. Return dictionary.
+    Return get_enabled_standards response and statuses of subscription_arns, of all subscriptions if subscription_arns is empty
     """
-    exceptions_dict = event["exceptions"]
-    account_id = event["account"]
-    exceptions = dict()
-    exceptions["Disabled"] = []
-    exceptions["Enabled"] = []
-    exceptions["DisabledReason"] = dict()
+    if subscription_arns:
+        response = client.get_enabled_standards(StandardsSubscriptionArns=subscription_arns)
+    else:
+        response = client.get_enabled_standards()
+    subscription_statuses = [
+        subscription["StandardsStatus"]
+        for subscription in response["StandardsSubscriptions"]
+    ]
+    return response, subscription_statuses
 
-    # Identify exceptions for this account
-    for control in exceptions_dict.keys():
-        disabled = False
-        enabled = False
+
+def wait_for_standards(client, subscription_arns, action):
+    """
+    Poll the changed standard subscriptions with exponential backoff and jitter until they are READY or INCOMPLETE
+    (or removed when disabled). Raise SecurityStandardUpdateError if a subscription FAILED or StandardsWaitTimeout
+    is exceeded. Return seconds waited.
+    """
+    start = time.monotonic()
+    deadline = start + float(os.environ.get("StandardsWaitTimeout", DEFAULT_STANDARDS_WAIT_TIMEOUT))
+    delay = STANDARDS_WAIT_INITIAL_DELAY
+    while True:
+        response, subscription_statuses = get_subscription_statuses(client, subscription_arns)
+        if "FAILED" in subscription_statuses:
+            logger.error(
+                "Standard could not be %s: %s",
+                action,
+                str(response["StandardsSubscriptions"]),
+            )
+            raise SecurityStandardUpdateError(
+                "Security standard could not be " + action + ": "
+                + str(response["StandardsSubscriptions"])
+            )
+        if all(status in ("READY", "INCOMPLETE") for status in subscription_statuses):
+            break
+        if time.monotonic() + delay > deadline:
+            raise SecurityStandardUpdateError(
+                "Timeout waiting for security standard to be " + action + ": "
+                + str(response["StandardsSubscriptions"])
+            )
+        logger.info("Wait until standards are %s...", action)
+        # equal jitter keeps parallel workers from polling in lockstep
+        time.sleep(delay / 2 + random.uniform(0, delay / 2))
+        delay = min(delay * 2, STANDARDS_WAIT_MAX_DELAY)
+    if "INCOMPLETE" in subscription_statuses:
+        logger.info(
+            "Standard could not be enabled completely. Some controls may not be available: %s",
+            str(response["StandardsSubscriptions"]),
+        )
+    wait_seconds = round(time.monotonic() - start, 3)
+    logger.info("Standards %s after %s seconds", action, wait_seconds)
+    return wait_seconds
+
+
+def standards_pending(member_enabled_standards):
+    """ return True if a standard subscription of the member is still being enabled or disabled """
+    return any(
+        subscription["StandardsStatus"] in ("PENDING", "DELETING")
+        for subscription in member_enabled_standards["StandardsSubscriptions"]
+    )
+
+
+def check_resumed_standards(member_enabled_standards, subscription_arns):
+    """
+    Raise SecurityStandardUpdateError if one of the subscription_arns changed by a previous invocation FAILED,
+    like wait_for_standards does when standards are awaited. Other subscriptions of the member are not checked.
+    """
+    resumed = [
+        subscription for subscription in member_enabled_standards["StandardsSubscriptions"]
+        if subscription["StandardsSubscriptionArn"] in subscription_arns
+    ]
+    incomplete = [subscription for subscription in resumed if subscription["StandardsStatus"] == "INCOMPLETE"]
+    if incomplete:
+        logger.info("Standard updated with incomplete controls: %s", str(incomplete))
+    failed = [subscription for subscription in resumed if subscription["StandardsStatus"] == "FAILED"]
+    if failed:
+        logger.error("Standard could not be updated: %s", str(failed))
+        raise SecurityStandardUpdateError("Security standard could not be updated: " + str(failed))
+
+
+def delta_controls(event):
+    """ return set of ControlIds changed by the exceptions ingest, None if all controls are reconciled """
+    if event.get("controls") is None:
+        return None
+    return set(event["controls"])
+
+
+def async_standards(event):
+    """ return True if standard subscription changes are resumed in a later state machine step instead of waiting """
+    return str(event.get("asyncStandards", os.environ.get("AsyncStandards", "false"))).lower() == "true"
+
+
+def index_exceptions(exceptions_dict):
+    """
+    Index exceptions once per invocation. Account lists become sets and "ALL" stays symbolic, so resolving the
+    exceptions of an account is O(controls). Return list of (control, disabled, enabled, regions, disabled_reason).
+    """
+    exception_index = []
+    for control, exception in exceptions_dict.items():
         try:
-            if account_id in exceptions_dict[control]["Disabled"]:
-                disabled = True
+            disabled = frozenset(exception["Disabled"])
         except KeyError:
-            logger.info('%s: No "Disabled" exceptions.', control)
-
+            logger.info('%s: No "Disabled" exceptions.', control, extra={"sample_key": "exception_defaults"})
+            disabled = frozenset()
         try:
-            if account_id in exceptions_dict[control]["Enabled"]:
-                if "Region" in exceptions_dict[control].keys():
-                    if region not in exceptions_dict[control]["Region"]:
-                        disabled = True
-                        logger.info('%s: is going to be disabled in %s', control, region)
-                else:
-                    enabled = True
+            enabled = frozenset(exception["Enabled"])
         except KeyError:
-            logger.info('%s: No "Enabled" exceptions.', control)
-
+            logger.info('%s: No "Enabled" exceptions.', control, extra={"sample_key": "exception_defaults"})
+            enabled = frozenset()
+        regions = frozenset(exception["Region"]) if "Region" in exception else None
         try:
-            exceptions["DisabledReason"][control] = exceptions_dict[control][
-                "DisabledReason"
-            ]
+            disabled_reason = exception["DisabledReason"]
         except KeyError as error:
             logger.error('%s: No "DisabledReason".', control)
             raise error
+        exception_index.append((control, disabled, enabled, regions, disabled_reason))
+    return exception_index
+
+
+def decode_exceptions(payload):
+    """
+    Decode exceptions sent by GetMembers. Accepts the plain dictionary, the compact format, its zlib compressed
+    form and a reference to the compact format offloaded to S3.
+    """
+    if payload.get("format") == S3_FORMAT:
+        global s3_client
+        if not s3_client:
+            s3_client = get_client("s3")
+        payload = json.loads(s3_client.get_object(Bucket=payload["bucket"], Key=payload["key"])["Body"].read())
+    elif payload.get("format") == ZLIB_FORMAT:
+        payload = json.loads(zlib.decompress(base64.b64decode(payload["data"])))
+    if payload.get("format") != COMPACT_FORMAT:
+        return payload
+    groups = payload["groups"]
+    exceptions = dict()
+    for control, (disabled, enabled, disabled_reason, regions) in payload["controls"].items():
+        exceptions[control] = {"Disabled": groups[disabled], "Enabled": groups[enabled], "DisabledReason": disabled_reason}
+        if regions is not None:
+            exceptions[control]["Region"] = regions
+    return exceptions
+
+
+def load_exception_index(event):
+    """
+    Decode and index the exceptions of event. Compressed and offloaded payloads are cached by content, so warm
+    containers decode them once per execution.
+    """
+    payload = event["exceptions"]
+    if payload.get("format") == S3_FORMAT:
+        cache_key = payload["key"]
+    elif payload.get("format") == ZLIB_FORMAT:
+        cache_key = payload["data"]
+    else:
+        return index_exceptions(decode_exceptions(payload))
+    if cache_key not in exception_index_cache:
+        exception_index_cache.clear()
+        exception_index_cache[cache_key] = index_exceptions(decode_exceptions(payload))
+    return exception_index_cache[cache_key]
+
+
+def resolve_exceptions(exception_index, account_id, region):
+    """
+    Resolve indexed exceptions for account_id in region. Return dictionary.
+    """
+    exceptions = dict()
+    exceptions["Disabled"] = []
+    exceptions["Enabled"] = []
+    exceptions["DisabledReason"] = dict()
+
+    for control, disabled_accounts, enabled_accounts, regions, disabled_reason in exception_index:
+        disabled = ALL in disabled_accounts or account_id in disabled_accounts
+        enabled = False
+        if ALL in enabled_accounts or account_id in enabled_accounts:
+            if regions is not None:
+                if region not in regions:
+                    disabled = True
+                    logger.debug('%s: is going to be disabled in %s', control, region, extra={"sample_key": "exception_region"})
+            else:
+                enabled = True
+
+        exceptions["DisabledReason"][control] = disabled_reason
 
         if enabled and disabled:
             # Conflict - you cannot enable and disable a control at the same time - fallback to default settin in administrator account
             logger.info(
                 "%s: Conflict - exception states that this control should be enabled AND disabled. Fallback to SecurityHub Administrator configuration.",
                 control,
+                extra={"sample_key": "exception_conflict"},
             )
         elif disabled:
             exceptions["Disabled"].append(control)
@@ -315,94 +943,405 @@ def get_exceptions(event, region):
     return exceptions
 
 
-def convert_regions(response, member_account_id):
+def get_exceptions(event, region, exception_index=None):
+    """
+    extract exceptions related to the processed account from event. Return dictionary.
+    """
+    if exception_index is None:
+        exception_index = load_exception_index(event)
+    return resolve_exceptions(exception_index, event["account"], region)
+
+
+def get_account_item(client, table_name, member_account_id):
     """
-    Convert Items from DynamoDB into simpler dictionary format
+    Return the regions table item of member_account_id, None if the account has no item. Items are cached in
+    warm containers for RegionsCacheTTL seconds.
     """
-    account_regions = dict()
-    for account in response['Items']:
-        account_regions[account["AccountId"]["S"]] = [entry["S"] for entry in account["Regions"]["L"]]
-    if member_account_id in account_regions.keys():
-        return account_regions[member_account_id]
+    now = time.time()
+    cached = regions_cache.get(member_account_id)
+    if cached and cached[0] > now:
+        return cached[1]
+    item = client.get_item(TableName=table_name, Key={"AccountId": {"S": member_account_id}}).get("Item")
+    regions_cache[member_account_id] = (now + int(os.environ.get("RegionsCacheTTL", DEFAULT_REGIONS_CACHE_TTL)), item)
+    return item
+
+
+def convert_regions(item, member_account_id):
+    """
+    Return regions of the regions table item of member_account_id
+    """
+    if item:
+        return [entry["S"] for entry in item["Regions"]["L"]]
+    logger.info("%s not in DDB items", member_account_id)
+
+
+def get_region_concurrency(item):
+    """
+    Return number of regions processed in parallel for the regions table item of an account. The optional
+    RegionConcurrency attribute of the item overrides the RegionConcurrency environment variable.
+    """
+    if item and "RegionConcurrency" in item:
+        return int(item["RegionConcurrency"]["N"])
+    return int(os.environ.get("RegionConcurrency", DEFAULT_REGION_CONCURRENCY))
+
+
+def region_fingerprint(administrator_enabled_standards, member_enabled_standards, standard_controls, exceptions):
+    """
+    Return fingerprint of the inputs of a region reconciliation: administrator standards, member standards,
+    available controls and resolved exceptions
+    """
+    inputs = {
+        "administrator": sorted(standard["StandardsArn"] for standard in administrator_enabled_standards["StandardsSubscriptions"]),
+        "member": sorted(
+            [standard["StandardsArn"], standard.get("StandardsStatus")]
+            for standard in member_enabled_standards["StandardsSubscriptions"]
+        ),
+        "controls": {standards_arn: sorted(controls) for standards_arn, controls in standard_controls.items()},
+        "exceptions": {
+            "Disabled": sorted(exceptions["Disabled"]),
+            "Enabled": sorted(exceptions["Enabled"]),
+            "DisabledReason": {control: exceptions["DisabledReason"][control] for control in exceptions["Disabled"]},
+        },
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def snapshot_current(event, member_account_id, region, fingerprint):
+    """
+    Return True if the snapshot of the last successful reconciliation has the same fingerprint and is younger
+    than FullResyncInterval seconds. The fingerprint does not cover control statuses, so controls changed directly
+    in the member account are only corrected after this interval or by executions with the forceFullSync input,
+    which the Event Trigger sets.
+    """
+    if not os.environ.get("SnapshotTable") or event.get("forceFullSync"):
+        return False
+    item = dynamodb_client.get_item(
+        TableName=os.environ["SnapshotTable"],
+        Key={"SnapshotKey": {"S": SNAPSHOT_KEY.format(account=member_account_id, region=region)}},
+    ).get("Item")
+    if not item or item["Fingerprint"]["S"] != fingerprint:
+        return False
+    interval = int(os.environ.get("FullResyncInterval", DEFAULT_FULL_RESYNC_INTERVAL))
+    return time.time() - float(item["SyncedAt"]["N"]) < interval
+
+
+def save_snapshot(member_account_id, region, fingerprint):
+    """ store fingerprint of a successful reconciliation of member_account_id in region """
+    if not os.environ.get("SnapshotTable"):
+        return
+    now = int(time.time())
+    interval = int(os.environ.get("FullResyncInterval", DEFAULT_FULL_RESYNC_INTERVAL))
+    dynamodb_client.put_item(
+        TableName=os.environ["SnapshotTable"],
+        Item={
+            "SnapshotKey": {"S": SNAPSHOT_KEY.format(account=member_account_id, region=region)},
+            "Fingerprint": {"S": fingerprint},
+            "SyncedAt": {"N": str(now)},
+            # snapshots of removed accounts expire
+            "ExpiresAt": {"N": str(now + 2 * interval)},
+        },
+    )
+
+
+def reconcile_region(event, region, administrator_account_id, member_account_id, role_arn, exception_index=None):
+    """
+    Update standards and controls of the member account in one region. Return update statistics and
+    standards wait time, or {"pending": True, "subscriptions": [...]} with the ARNs of the changed subscriptions if the
+    standards update continues asynchronously.
+    """
+    member_security_hub_client = client_pool.client(member_account_id, region, role_arn)
+    baseline = event.get("baseline", {})
+    if region in baseline:
+        # Administrator standards were captured once for all accounts by GetMembers
+        standards = get_standards(member_security_hub_client)
+        administrator_enabled_standards = {
+            "StandardsSubscriptions": [{"StandardsArn": standards_arn} for standards_arn in baseline[region]]
+        }
     else:
-        logger.info("%s not in DDB items", member_account_id)
+        administrator_security_hub_client = client_pool.client(administrator_account_id, region)
+        # Get standard subscription controls
+        standards = get_standards(administrator_security_hub_client)
+        # Get enabled standards
+        administrator_enabled_standards = get_enabled_standard_subscriptions(
+            standards, administrator_account_id, administrator_security_hub_client, region)
 
+    member_enabled_standards = get_enabled_standard_subscriptions(
+        standards, member_account_id, member_security_hub_client, region
+    )
+    logger.info("Update Account %s in %s region", member_account_id, region)
+    if event.get("dryRun"):
+        return plan_region(event, region, administrator_enabled_standards, member_enabled_standards, member_security_hub_client, exception_index)
+    wait = not async_standards(event)
+    metrics = dict()
+    # subscriptions changed by the previous invocation of a resumed region
+    resumed_subscriptions = event.get("previousResult", {}).get("pendingSubscriptions", {}).get(region, [])
+
+    if standards_pending(member_enabled_standards):
+        # Standards update started by a previous invocation has not finished yet
+        pending_subscriptions = [
+            subscription["StandardsSubscriptionArn"]
+            for subscription in member_enabled_standards["StandardsSubscriptions"]
+            if subscription["StandardsStatus"] in ("PENDING", "DELETING")
+        ]
+        if not wait:
+            return {"pending": True, "subscriptions": sorted(set(resumed_subscriptions) | set(pending_subscriptions))}
+        metrics["standards_wait_seconds"] = wait_for_standards(member_security_hub_client, pending_subscriptions, "updated")
+        member_enabled_standards = get_enabled_standard_subscriptions(
+            standards, member_account_id, member_security_hub_client, region
+        )
+    if region in event.get("pendingRegions", []):
+        # the standards update of the previous invocation finished, but not necessarily successfully
+        check_resumed_standards(member_enabled_standards, resumed_subscriptions)
+
+    # Update standard subscriptions in member account
+    changed_subscriptions = []
+    with timed("update_standard_subscription", member_account_id, region):
+        standards_updated = update_standard_subscription(
+            administrator_enabled_standards,
+            member_enabled_standards,
+            member_security_hub_client,
+            wait=wait,
+            metrics=metrics,
+            changed=changed_subscriptions,
+        )
+    if standards_updated:
+        if not wait:
+            logger.info("Standards update of %s in %s continues asynchronously", member_account_id, region)
+            return {"pending": True, "subscriptions": changed_subscriptions}
+        logger.info("Fetch enabled standards again.")
+        member_enabled_standards = get_enabled_standard_subscriptions(
+            standards, member_account_id, member_security_hub_client, region
+        )
+    # Get Controls, only the changed ones in delta mode
+    with timed("get_controls", member_account_id, region):
+        standard_controls = get_controls(member_enabled_standards, member_security_hub_client, delta_controls(event))
+
+    # Get exceptions
+    exceptions = get_exceptions(event, region, exception_index)
+    logger.info("Exceptions of %s in %s: %s disabled, %s enabled", member_account_id, region,
+                len(exceptions["Disabled"]), len(exceptions["Enabled"]))
+    logger.debug("Exceptions: %s", exceptions)
+
+    # Skip accounts whose inputs did not change since the last successful reconciliation
+    full_sync = delta_controls(event) is None
+    fingerprint = region_fingerprint(administrator_enabled_standards, member_enabled_standards, standard_controls, exceptions)
+    if full_sync and not standards_updated and snapshot_current(event, member_account_id, region, fingerprint):
+        logger.info("Account %s in %s unchanged since last reconciliation", member_account_id, region)
+        metrics["updates"] = {"controls_changed": 0, "api_calls": 0, "failed": 0}
+        metrics["skipped"] = True
+        return metrics
+
+    # Disable/enable the controls in member account
+    with timed("update_member", member_account_id, region):
+        metrics["updates"] = get_update_engine()(standard_controls, member_security_hub_client, exceptions)
+    if full_sync:
+        save_snapshot(member_account_id, region, fingerprint)
+    return metrics
+
+
+def plan_region(event, region, administrator_enabled_standards, member_enabled_standards, client, exception_index=None):
+    """
+    Read-only counterpart of reconcile_region. Return standards and controls that would be changed in the region.
+    """
+    standard_to_be_enabled, standard_to_be_disabled = plan_standard_subscription(
+        administrator_enabled_standards, member_enabled_standards, client
+    )
+    # Controls of standards to be disabled are not reconciled, controls of standards to be enabled
+    # can only be read once the standard is enabled
+    member_enabled_standards = {
+        "StandardsSubscriptions": [
+            subscription for subscription in member_enabled_standards["StandardsSubscriptions"]
+            if subscription["StandardsSubscriptionArn"] not in standard_to_be_disabled
+        ]
+    }
+    standard_controls = get_controls(member_enabled_standards, client, delta_controls(event))
+    plan = {"controls": plan_member(standard_controls, client, get_exceptions(event, region, exception_index))}
+    if standard_to_be_enabled:
+        plan["enable_standards"] = [standard["StandardsArn"] for standard in standard_to_be_enabled]
+    if standard_to_be_disabled:
+        plan["disable_standards"] = standard_to_be_disabled
+    return {"plan": plan}
+
+
+def count_plan(plan):
+    """
+    Return the number of standards and controls changed by the plan of a region and of update calls needed to apply it
+    """
+    standards = len(plan.get("enable_standards", [])) + len(plan.get("disable_standards", []))
+    controls = sum(len(changes) for changes in plan.get("controls", {}).values())
+    return {"standards": standards, "controls": controls, "update_calls": standards + math.ceil(controls / MAX_BATCH_SIZE)}
+
+
+def run_region(event, region, administrator_account_id, member_account_id, role_arn, exception_index=None):
+    """
+    Run reconcile_region and isolate its errors so a failing region does not discard the others. Return region result.
+    Regions waiting for a standards update to finish are returned with statusCode 202 and the pending subscriptions.
+    """
+    start = time.monotonic()
+    try:
+        region_result = reconcile_region(event, region, administrator_account_id, member_account_id, role_arn, exception_index)
+        if region_result.pop("pending", False):
+            result = {"region": region, "statusCode": 202, "subscriptions": region_result.get("subscriptions", [])}
+        else:
+            result = dict(region=region, statusCode=200, **region_result)
+    except Exception as error:
+        logger.exception("Account %s failed in %s region", member_account_id, region)
+        result = {"region": region, "statusCode": 500, "error": str(error)}
+    result["duration"] = round(time.monotonic() - start, 3)
+    with throttle_lock:
+        # throttles of the shared administrator clients are reported by the account that sees them first
+        result["throttles"] = (throttle_counts.pop((member_account_id, region), 0)
+                               + throttle_counts.pop((administrator_account_id, region), 0))
+    return result
 
-def lambda_handler(event, context):
-    logger.info(event)
 
+def update_account(event, context):
+    """
+    Reconcile all regions of the member account in event. Return account result.
+    """
     global dynamodb_client
     if not dynamodb_client:
-        dynamodb_client = boto3.client("dynamodb")
-    response = dynamodb_client.scan(TableName=os.environ["RegionsDynamoDB"])
+        dynamodb_client = get_client("dynamodb")
+    member_account_id = event["account"]
+    account_item = get_account_item(dynamodb_client, os.environ["RegionsDynamoDB"], member_account_id)
 
     try:
-        # set variables and boto3 clients
-        config = Config(
-            retries={
-                'max_attempts': 23,
-                'mode': 'standard'
-                }
-            )
         administrator_account_id = context.invoked_function_arn.split(":")[4]
-        member_account_id = event["account"]
-        regions = convert_regions(response, member_account_id)
+        # Resumed invocations only process the regions still waiting for a standards update
+        regions = event.get("pendingRegions") or convert_regions(account_item, member_account_id) or []
+        region_concurrency = get_region_concurrency(account_item)
 
         role_arn = os.environ["MemberRole"].replace("<accountId>", member_account_id)
-        global sts_client
-        if not sts_client:
-            sts_client = boto3.client("sts")
-        assumed_role_object = sts_client.assume_role(
-            RoleArn=role_arn, RoleSessionName="SecurityHubUpdater"
-        )
-        credentials = assumed_role_object["Credentials"]
-
-        for region in regions:
-            administrator_security_hub_client = boto3.client("securityhub", config=config,
-                                                             region_name=region)
-            # Get standard subscription controls
-            standards = administrator_security_hub_client.describe_standards()
-            # Get enabled standards
-            administrator_enabled_standards = get_enabled_standard_subscriptions(
-                standards, administrator_account_id, administrator_security_hub_client, region)
-
-            member_security_hub_client = boto3.client(
-                "securityhub",
-                aws_access_key_id=credentials["AccessKeyId"],
-                aws_secret_access_key=credentials["SecretAccessKey"],
-                aws_session_token=credentials["SessionToken"],
-                config=config, region_name=region
-            )
+        # assumes the role unless a warm container still holds valid credentials
+        client_pool.session(role_arn)
 
-            member_enabled_standards = get_enabled_standard_subscriptions(
-                standards, member_account_id, member_security_hub_client, region
-            )
-            logger.info("Update Account %s in %s region", member_account_id, region)
+    except botocore.exceptions.ClientError as error:
+        logger.error(error)
+        return {"statusCode": 500, "account": member_account_id, "error": str(error)}
 
-            # Update standard subscriptions in member account
-            standards_updated = update_standard_subscription(
-                administrator_enabled_standards,
-                member_enabled_standards,
-                member_security_hub_client,
-            )
-            if standards_updated:
-                logger.info("Fetch enabled standards again.")
-                member_enabled_standards = get_enabled_standard_subscriptions(
-                    standards, member_account_id, member_security_hub_client, region
-                )
-            # Get Controls
-            standard_controls = get_controls(member_enabled_standards, member_security_hub_client)
+    # Exceptions are indexed once and resolved per region
+    exception_index = load_exception_index(event)
+    with ThreadPoolExecutor(max_workers=max(1, min(region_concurrency, len(regions)))) as executor:
+        region_results = list(executor.map(
+            lambda region: run_region(event, region, administrator_account_id, member_account_id, role_arn, exception_index),
+            regions
+        ))
 
-            # Get exceptions
-            exceptions = get_exceptions(event, region)
-            logger.info("Exceptions: %s", str(exceptions))
+    resume_attempt = event.get("resumeAttempt", 0)
+    pending_regions = {result["region"]: result["subscriptions"] for result in region_results if result["statusCode"] == 202}
+    if pending_regions and resume_attempt >= MAX_RESUME_ATTEMPTS:
+        for result in region_results:
+            if result["statusCode"] == 202:
+                result.update(statusCode=500, error="Security standard update still pending")
+        pending_regions = {}
+    region_results = [result for result in region_results if result["statusCode"] != 202]
+    return account_payload(event, context, member_account_id, region_results, pending_regions, resume_attempt)
 
-            # Disable/enable the controls in member account
 
-            update_member(standard_controls, member_security_hub_client, exceptions)
+def account_payload(event, context, member_account_id, region_results, pending_regions, resume_attempt):
+    """
+    Return the account result for the state machine: totals and failed regions. Results of resumed invocations are
+    added to the totals of event["previousResult"], the region details are written to the ExecutionDataBucket.
+    pending_regions maps the regions waiting for a standards update to the ARNs of their changed subscriptions.
+    """
+    previous = event.get("previousResult", {})
+    update_stats = dict({"controls_changed": 0, "api_calls": 0, "failed": 0}, **previous.get("updates", {}))
+    for result in region_results:
+        for key in update_stats:
+            update_stats[key] += result.get("updates", {}).get(key, 0)
+    failed_regions = [result for result in region_results if result["statusCode"] == 500]
 
-    except botocore.exceptions.ClientError as error:
-        logger.error(error)
-        return {"statusCode": 500, "account": member_account_id, "error": str(error)}
+    payload = {"statusCode": 200, "account": member_account_id, "updates": update_stats,
+               "throttles": previous.get("throttles", 0) + sum(result.get("throttles", 0) for result in region_results),
+               # API calls and step timers of this account, written as EMF lines and aggregated by CheckResult
+               "metrics": merge_summaries(dict(previous.get("metrics", {})), flush_metrics("UpdateMember", [member_account_id]))}
+    if event.get("dryRun"):
+        payload["dryRun"] = True
+        # the planned changes are part of the region details, CheckResult only needs their number
+        plan = dict({"standards": 0, "controls": 0, "update_calls": 0}, **previous.get("plan", {}))
+        for result in region_results:
+            for key, count in count_plan(result.get("plan", {})).items():
+                plan[key] += count
+        payload["plan"] = plan
+    errors = [error for error in [previous.get("error")] if error]
+    errors.extend(result["region"] + ": " + result["error"] for result in failed_regions)
+    if errors:
+        payload["statusCode"] = 500
+        payload["failedRegions"] = previous.get("failedRegions", []) + [result["region"] for result in failed_regions]
+        error = "; ".join(errors)
+        payload["error"] = error if len(error) <= MAX_ERROR_LENGTH else error[:MAX_ERROR_LENGTH] + "..."
+    details_key = write_details(event, context, member_account_id, region_results)
+    if details_key:
+        payload["detailsKey"] = details_key
+    if pending_regions:
+        # The state machine waits and invokes UpdateMember again for these regions
+        payload["pendingRegions"] = list(pending_regions)
+        # checked by the resumed invocation, the other subscriptions of the member are left alone
+        payload["pendingSubscriptions"] = pending_regions
+        payload["resumeAttempt"] = resume_attempt + 1
+    return payload
 
-    return {"statusCode": 200, "account": member_account_id}
+
+def write_details(event, context, member_account_id, region_results):
+    """
+    Write the region results of member_account_id to the ExecutionDataBucket, after the regions of the previous
+    invocation if the update was resumed. Return the object key, None if no bucket is configured.
+    """
+    bucket = os.environ.get("ExecutionDataBucket")
+    if not bucket:
+        logger.debug("Region results of %s: %s", member_account_id, region_results)
+        return None
+    global s3_client
+    if not s3_client:
+        s3_client = get_client("s3")
+    previous_key = event.get("previousResult", {}).get("detailsKey")
+    if previous_key:
+        region_results = json.loads(s3_client.get_object(Bucket=bucket, Key=previous_key)["Body"].read()) + region_results
+    key = DETAILS_KEY.format(execution=event.get("execution") or context.aws_request_id, account=member_account_id)
+    s3_client.put_object(Bucket=bucket, Key=key, Body=json.dumps(region_results))
+    return key
+
+
+def update_accounts(accounts, event, context):
+    """
+    Update several member accounts with up to AccountConcurrency workers. Standards are always awaited because
+    batches are not resumed, failures of an account are returned in its result and do not fail the others.
+    Return account results in the order of accounts.
+    """
+    def update(account):
+        try:
+            return update_account(dict(event, account=account, asyncStandards=False), context)
+        except Exception as error:
+            logger.exception("Account %s failed", account)
+            return {"statusCode": 500, "account": account, "error": str(error)}
+
+    account_concurrency = int(os.environ.get("AccountConcurrency", DEFAULT_ACCOUNT_CONCURRENCY))
+    with ThreadPoolExecutor(max_workers=max(1, min(account_concurrency, len(accounts)))) as executor:
+        return list(executor.map(update, accounts))
+
+
+def update_batch(event, context):
+    """
+    Update the accounts of a distributed Map batch
+    """
+    return update_accounts([item["account"] for item in event["Items"]], event["BatchInput"], context)
+
+
+def lambda_handler(event, context):
+    # the event contains all exceptions, only a summary is logged
+    logger.info("Event: %s", summarize(event))
+
+    # Distributed Map batches contain several accounts
+    if "Items" in event:
+        response = update_batch(event, context)
+    # inline Map items are lists of accounts if GetMembers batches them
+    elif isinstance(event.get("account"), list):
+        response = update_accounts(event["account"], event, context)
+    else:
+        response = update_account(event, context)
+    # calls of the Lambda role, e.g. DynamoDB, S3 and the administrator account
+    shared = flush_metrics("UpdateMember")
+    if isinstance(response, dict):
+        response["metrics"] = merge_summaries(response.get("metrics", {}), shared)
+    log_sampling_summary(logger)
+    return response
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The ingest Lambda is deployed by Terraform from its own directory
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "Terraform", "lambda"))
+# Code shared by all Lambda functions is deployed as Lambda layer
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "Common", "python"))
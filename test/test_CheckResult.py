@@ -1,6 +1,8 @@
+import io
 import json
 import pytest
 import src.CheckResult.index as CheckResult
+from unittest.mock import patch, MagicMock
 
 
 def test_lambda_handler():
@@ -12,3 +14,43 @@ def test_lambda_handler():
     assert expected_response_failed == response_failed
     response_success = CheckResult.lambda_handler(event_success, {})
     assert expected_response_success == response_success
+
+
+def test_lambda_handler_plan():
+    event = {"processedItems": [
+        {"statusCode": 200, "account": "acc_1", "dryRun": True, "plan": {"standards": 1, "controls": 150, "update_calls": 3}},
+        {"statusCode": 200, "account": "acc_2", "dryRun": True, "plan": {"standards": 0, "controls": 0, "update_calls": 0}},
+    ]}
+    response = CheckResult.lambda_handler(event, {})
+    assert response == {"statusCode": 200, "plan": {"accounts": 1, "standards": 1, "controls": 150, "update_calls": 3}}
+
+
+def test_lambda_handler_batches():
+    event = {"processedItems": [[{"statusCode": 200, "account": "acc_1"}, {"statusCode": 500, "account": "acc_2", "error": "Reason"}], [{"statusCode": 200, "account": "acc_3"}]]}
+    assert CheckResult.lambda_handler(event, {}) == {"statusCode": 500, "failed_accounts": {"acc_2": "Reason"}}
+
+
+def test_lambda_handler_result_writer():
+    """
+    Results of the distributed Map are read from the result files listed in the manifest
+    """
+    objects = {
+        "results/manifest.json": {"ResultFiles": {"FAILED": [{"Key": "results/FAILED_0.json"}], "SUCCEEDED": [{"Key": "results/SUCCEEDED_0.json"}]}},
+        "results/SUCCEEDED_0.json": [{"Status": "SUCCEEDED", "Output": json.dumps([{"statusCode": 200, "account": "acc_1"}])}],
+        "results/FAILED_0.json": [{"Status": "FAILED", "Cause": "Lambda timed out", "Input": json.dumps({"Items": [{"account": "acc_2"}, {"account": "acc_3"}]})}],
+    }
+    s3 = MagicMock()
+    s3.get_object.side_effect = lambda Bucket, Key: {"Body": io.BytesIO(json.dumps(objects[Key]).encode())}
+    event = {"resultWriter": {"MapRunArn": "arn", "ResultWriterDetails": {"Bucket": "bucket", "Key": "results/manifest.json"}}}
+    with patch.object(CheckResult, "s3_client", s3):
+        response = CheckResult.lambda_handler(event, {})
+    assert response == {"statusCode": 500, "failed_accounts": {"acc_2": "Lambda timed out", "acc_3": "Lambda timed out"}}
+
+
+def test_lambda_handler_metrics():
+    summary = {"calls": 3, "retries": 1, "throttles": 0, "errors": 0, "latency_ms": 30.0, "max_latency_ms": 20.0, "timers": {"update_member": 50.0}}
+    event = {"processedItems": [{"statusCode": 200, "account": "acc_1", "metrics": summary}, [{"statusCode": 200, "account": "acc_2", "metrics": summary}]]}
+    response = CheckResult.lambda_handler(event, {})
+    assert response["metrics"]["calls"] == 6
+    assert response["metrics"]["max_latency_ms"] == 20.0
+    assert response["metrics"]["timers"] == {"update_member": 100.0}
@@ -1,10 +1,86 @@
 import json
 import pytest
 import src.GetMembers.index as GetMembers
+from unittest.mock import patch, MagicMock
 
 
 def test_convert_exceptions():
     dynamodb_response = json.loads('{"Items": [{"ControlId": {"S": "CIS.1.1"}, "Disabled": {"L": [{"S": "111111111111"}]}, "Enabled": {"L": []}, "DisabledReason": {"S": "Some_Reason"}}, {"Disabled": {"L": []}, "ControlId": {"S": "CIS.1.2"}, "Enabled": {"L": [{"S": "22222222222"}]}}, {"Disabled": {"L": [{"S": "111111111111"}]}, "ControlId": {"S": "CIS.1.4"}}, {"ControlId": {"S": "CIS.1.3"}, "Enabled": {"L": [{"S": "22222222222"}]}, "DisabledReason": {"S": ""}}, {"ControlId": {"S": "CIS.1.5"}}]}')
     expected_response = {"CIS.1.1": {"Disabled": ["111111111111"], "Enabled": [], "DisabledReason": "Some_Reason"}, "CIS.1.2": {"Disabled": [], "Enabled": ["22222222222"], "DisabledReason": GetMembers.DISABLED_REASON}, "CIS.1.3": {"Disabled": [], "Enabled": ["22222222222"], "DisabledReason": GetMembers.DISABLED_REASON}, "CIS.1.4": {"Disabled": ["111111111111"], "Enabled": [], "DisabledReason": GetMembers.DISABLED_REASON}, "CIS.1.5": {"Disabled": [], "Enabled": [], "DisabledReason": GetMembers.DISABLED_REASON}}
-    response = GetMembers.convert_exceptions(dynamodb_response)
+    response = GetMembers.convert_exceptions(dynamodb_response["Items"])
     assert expected_response == response
+
+
+def test_convert_exceptions_all():
+    dynamodb_response = {"Items": [{"ControlId": {"S": "IAM.6"}, "Disabled": {"L": [{"S": "ALL"}]}, "DisabledReason": {"S": "We use virtual MFA"}}]}
+    response = GetMembers.convert_exceptions(dynamodb_response["Items"])
+    assert response == {"IAM.6": {"Disabled": ["ALL"], "Enabled": [], "DisabledReason": "We use virtual MFA"}}
+
+
+def test_get_regions():
+    client = MagicMock()
+    client.scan.return_value = {"Items": [{"AccountId": {"S": "111111111111"}, "Regions": {"L": [{"S": "us-east-1"}, {"S": "us-west-2"}]}}, {"AccountId": {"S": "22222222222"}, "Regions": {"L": [{"S": "us-east-1"}]}}]}
+    assert GetMembers.get_regions(client, "regions") == ["us-east-1", "us-west-2"]
+
+
+@patch("src.GetMembers.index.get_client")
+def test_get_baseline(get_client):
+    client = get_client.return_value
+    client.describe_standards.return_value = {"Standards": [{"StandardsArn": "arn"}, {"StandardsArn": "arn_2"}]}
+    client.get_enabled_standards.return_value = {"StandardsSubscriptions": [{"StandardsArn": "arn", "StandardsStatus": "READY"}]}
+    client.list_security_control_definitions.return_value = {"SecurityControlDefinitions": [{"SecurityControlId": "CIS.1.1", "CurrentRegionAvailability": "AVAILABLE"}, {"SecurityControlId": "CIS.1.2", "CurrentRegionAvailability": "UNAVAILABLE"}]}
+    s3 = MagicMock()
+    with patch.object(GetMembers, "s3_client", s3):
+        baseline = GetMembers.get_baseline(["us-east-1"], "bucket")
+    assert baseline == {"us-east-1": ["arn"]}
+    get_client.assert_called_once_with("securityhub", "us-east-1")
+    body = json.loads(s3.put_object.call_args.kwargs["Body"])
+    assert s3.put_object.call_args.kwargs["Key"] == "catalog/us-east-1.json"
+    assert body["Standards"] == [{"StandardsArn": "arn"}, {"StandardsArn": "arn_2"}]
+    assert body["Controls"]["arn"] == {"Available": ["CIS.1.1"], "Unavailable": ["CIS.1.2"]}
+
+
+@patch("src.GetMembers.index.get_client")
+def test_get_baseline_without_bucket(get_client):
+    client = get_client.return_value
+    client.describe_standards.return_value = {"Standards": [{"StandardsArn": "arn"}]}
+    client.get_enabled_standards.return_value = {"StandardsSubscriptions": []}
+    assert GetMembers.get_baseline(["us-east-1", "eu-west-1"]) == {"us-east-1": [], "eu-west-1": []}
+    client.list_security_control_definitions.assert_not_called()
+
+
+def test_encode_exceptions():
+    accounts = ["%012d" % account for account in range(3000)]
+    exceptions = {
+        "CIS.%s" % control: {"Disabled": accounts, "Enabled": [], "DisabledReason": "Exception"}
+        for control in range(50)
+    }
+    exceptions["CIS.0"]["Region"] = ["us-east-1"]
+    compact = GetMembers.compact_exceptions({"CIS.0": exceptions["CIS.0"], "CIS.1": exceptions["CIS.1"]})
+    assert compact["groups"] == [accounts, []]
+    assert compact["controls"]["CIS.0"] == [0, 1, "Exception", ["us-east-1"]]
+    assert compact["controls"]["CIS.1"] == [0, 1, "Exception", None]
+
+    # account lists are stored once but still exceed the compression threshold
+    assert GetMembers.encode_exceptions(exceptions)["format"] == "zlib"
+    s3 = MagicMock()
+    with patch.object(GetMembers, "s3_client", s3), patch.object(GetMembers, "OFFLOAD_THRESHOLD", 10):
+        payload = GetMembers.encode_exceptions(exceptions, "bucket")
+    assert payload["format"] == "s3"
+    assert payload["key"] == s3.put_object.call_args.kwargs["Key"]
+
+
+def test_write_accounts():
+    s3 = MagicMock()
+    with patch.object(GetMembers, "s3_client", s3):
+        location = GetMembers.write_accounts(["111111111111", "222222222222"], "bucket")
+    assert location == {"Bucket": "bucket", "Key": s3.put_object.call_args.kwargs["Key"]}
+    assert location["Key"].startswith("accounts/")
+    lines = s3.put_object.call_args.kwargs["Body"].split("\n")
+    assert [json.loads(line) for line in lines] == [{"account": "111111111111"}, {"account": "222222222222"}]
+
+
+def test_batch_accounts():
+    accounts = ["1", "2", "3", "4", "5"]
+    assert GetMembers.batch_accounts(accounts, 1) == accounts
+    assert GetMembers.batch_accounts(accounts, 2) == [["1", "2"], ["3", "4"], ["5"]]
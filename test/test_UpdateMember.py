@@ -1,9 +1,14 @@
+import base64
+import datetime
+import io
 import json
+import time
 import pytest
 import src.UpdateMember.index as UpdateMember
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, ANY
 import logging
 import botocore
+import zlib
 
 logger = logging.getLogger()
 
@@ -11,26 +16,104 @@ logger = logging.getLogger()
 def test_get_exceptions():
     event = json.loads('{ "account": "acc_id_1", "exceptions": { "CIS.1.1": { "Disabled": [ "acc_id_1" ], "Enabled": [], "DisabledReason": "Some_Reason"}, "CIS.1.2": { "Disabled": [], "Enabled": [ "acc_id_1" ] , "DisabledReason": "Exception"}, "CIS.1.3": { "Disabled": [ "acc_id_1" ], "Enabled": [ "acc_id_1" ], "DisabledReason": "Exception" }, "CIS.1.4": { "Disabled": [ "acc_id_1" ], "Enabled": [], "DisabledReason": "Exception" }}}')
     expected_response = {"Disabled": ["CIS.1.1", "CIS.1.4"], "Enabled": ["CIS.1.2"], "DisabledReason": {"CIS.1.1": "Some_Reason", "CIS.1.2": "Exception", "CIS.1.3": "Exception", "CIS.1.4": "Exception"}}
-    response = UpdateMember.get_exceptions(event)
+    response = UpdateMember.get_exceptions(event, "us-east-1")
     assert expected_response == response
 
     event_missing_disabled_reason = json.loads('{ "account": "acc_id_1", "exceptions": { "CIS.1.1": { "Disabled": [ "acc_id_1" ], "Enabled": [], "DisabledReason": "Some_Reason"}, "CIS.1.2": { "Disabled": [], "Enabled": [ "acc_id_1" ] , "DisabledReason": "Exception"}, "CIS.1.3": { "Disabled": [ "acc_id_1" ], "Enabled": [ "acc_id_1" ], "DisabledReason": "Exception" }, "CIS.1.4": { "Disabled": [ "acc_id_1" ], "Enabled": [], "DisabledReason": "Exception" }, "CIS.1.5": {} }}')
     with pytest.raises(KeyError):
-        UpdateMember.get_exceptions(event_missing_disabled_reason)
+        UpdateMember.get_exceptions(event_missing_disabled_reason, "us-east-1")
+
+
+def test_get_exceptions_all_and_region():
+    """
+    "ALL" applies to every account. Controls enabled for a list of regions are disabled in all other regions.
+    """
+    event = {"account": "acc_id_1", "exceptions": {
+        "IAM.6": {"Disabled": ["ALL"], "Enabled": [], "DisabledReason": "We use virtual MFA"},
+        "KMS.2": {"Disabled": [], "Enabled": ["ALL"], "DisabledReason": "Global resource", "Region": ["us-east-1"]},
+        "CloudTrail.6": {"Disabled": ["acc_id_2"], "Enabled": [], "DisabledReason": "Exception"},
+        "CloudTrail.7": {"Disabled": ["ALL"], "Enabled": ["acc_id_1"], "DisabledReason": "Exception"},
+    }}
+    exception_index = UpdateMember.index_exceptions(event["exceptions"])
+    us_east_1 = UpdateMember.get_exceptions(event, "us-east-1", exception_index)
+    assert us_east_1["Disabled"] == ["IAM.6"]
+    assert us_east_1["Enabled"] == []
+    eu_west_1 = UpdateMember.get_exceptions(event, "eu-west-1", exception_index)
+    assert eu_west_1["Disabled"] == ["IAM.6", "KMS.2"]
+    assert eu_west_1["Enabled"] == []
+    assert eu_west_1["DisabledReason"]["KMS.2"] == "Global resource"
+
+
+def test_load_exception_index():
+    """
+    Compressed and offloaded exceptions decode to the same index as the plain dictionary
+    """
+    import src.GetMembers.index as GetMembers
+    exceptions = {
+        "IAM.6": {"Disabled": ["ALL"], "Enabled": [], "DisabledReason": "We use virtual MFA"},
+        "KMS.2": {"Disabled": [], "Enabled": ["ALL"], "DisabledReason": "Global resource", "Region": ["us-east-1"]},
+    }
+    expected = UpdateMember.index_exceptions(exceptions)
+    compact = GetMembers.compact_exceptions(exceptions)
+    compressed = {"format": "zlib", "data": base64.b64encode(zlib.compress(json.dumps(compact).encode())).decode()}
+    assert UpdateMember.load_exception_index({"exceptions": compact}) == expected
+    assert UpdateMember.load_exception_index({"exceptions": compressed}) == expected
+
+    s3 = MagicMock()
+    s3.get_object.return_value = {"Body": io.BytesIO(json.dumps(compact).encode())}
+    offloaded = {"format": "s3", "bucket": "bucket", "key": "exceptions/digest.json"}
+    with patch.object(UpdateMember, "s3_client", s3):
+        assert UpdateMember.load_exception_index({"exceptions": offloaded}) == expected
+        # warm invocations reuse the decoded exceptions
+        assert UpdateMember.load_exception_index({"exceptions": offloaded}) == expected
+    s3.get_object.assert_called_once_with(Bucket="bucket", Key="exceptions/digest.json")
+
+
+EVENT = json.loads('{ "account": "acc_1", "exceptions": { "CIS.1.1": { "Disabled": [ "acc_1" ], "Enabled": [], "DisabledReason": "Some_Reason" }, "CIS.1.2": { "Disabled": [], "Enabled": [ "acc_1" ], "DisabledReason": "Exception" }, "CIS.1.4": { "Disabled": [ "acc_1" ], "Enabled": [], "DisabledReason": "Exception" }, "CIS.1.3": { "Disabled": [], "Enabled": [ "acc_1" ], "DisabledReason": "Exception" }, "CIS.1.5": { "Disabled": [], "Enabled": [], "DisabledReason": "Exception" } } }')
+NO_UPDATES = {"controls_changed": 0, "api_calls": 0, "failed": 0}
+
+
+def regions_table(*regions, concurrency=None):
+    item = {"AccountId": {"S": "acc_1"}, "Regions": {"L": [{"S": region} for region in regions]}}
+    if concurrency:
+        item["RegionConcurrency"] = {"N": str(concurrency)}
+    dynamodb = MagicMock()
+    dynamodb.get_item.return_value = {"Item": item}
+    return dynamodb
+
+
+@pytest.fixture(autouse=True)
+def clear_regions_cache():
+    UpdateMember.regions_cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def client_pool():
+    with patch.object(UpdateMember, "client_pool", UpdateMember.ClientPool(UpdateMember.CLIENT_CONFIG)) as pool:
+        yield pool
+
+
+def sts_client():
+    sts = MagicMock()
+    sts.assume_role.return_value = {"Credentials": {
+        "AccessKeyId": "id", "SecretAccessKey": "key", "SessionToken": "token",
+        "Expiration": datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1),
+    }}
+    return sts
 
 
 @patch("src.UpdateMember.index.boto3")
 @patch("src.UpdateMember.index.os")
 @patch("src.UpdateMember.index.get_enabled_standard_subscriptions")
-def test_lambda_handler_success(get_enabled_standard_subscriptions, boto3, os):
+def test_lambda_handler_success(get_enabled_standard_subscriptions, os, boto3):
     """
     Test assuming no security standards are enabled in SecurityHub Administrator. Only running bare minimum of lambda handler. Runs successfully.
     """
-    event = json.loads('{ "account": "acc_1", "exceptions": { "CIS.1.1": { "Disabled": [ "acc_1" ], "Enabled": [], "DisabledReason": "Some_Reason" }, "CIS.1.2": { "Disabled": [], "Enabled": [ "acc_1" ], "DisabledReason": "Exception" }, "CIS.1.4": { "Disabled": [ "acc_1" ], "Enabled": [], "DisabledReason": "Exception" }, "CIS.1.3": { "Disabled": [], "Enabled": [ "acc_1" ], "DisabledReason": "Exception" }, "CIS.1.5": { "Disabled": [], "Enabled": [], "DisabledReason": "Exception" } } }')
+    os.environ = {"MemberRole": "arn:aws:iam::<accountId>:role/member", "RegionsDynamoDB": "regions"}
     context = MagicMock(return_value="admin_acc")
-    expected_response_success = {"statusCode": 200, "account": "acc_1"}
-    with patch.object(UpdateMember, "update_standard_subscription", return_value=True):
-        response = UpdateMember.lambda_handler(event, context)
+    expected_response_success = {"statusCode": 200, "account": "acc_1", "updates": NO_UPDATES, "throttles": 0, "metrics": ANY}
+    with patch.object(UpdateMember, "update_standard_subscription", return_value=True), patch.object(UpdateMember, "dynamodb_client", regions_table("us-east-1")), patch.object(UpdateMember, "sts_client", sts_client()):
+        response = UpdateMember.lambda_handler(EVENT, context)
     assert get_enabled_standard_subscriptions.call_count == 3
     assert response == expected_response_success
 
@@ -41,18 +124,97 @@ def test_lambda_handler_fail(boto3, os):
     """
     Test assuming no security standards are enabled in SecurityHub Administrator. Only running bare minimum of lambda handler. Raises error.
     """
-    event = json.loads('{ "account": "acc_1", "exceptions": { "CIS.1.1": { "Disabled": [ "acc_1" ], "Enabled": [], "DisabledReason": "Some_Reason" }, "CIS.1.2": { "Disabled": [], "Enabled": [ "acc_1" ], "DisabledReason": "Exception" }, "CIS.1.4": { "Disabled": [ "acc_1" ], "Enabled": [], "DisabledReason": "Exception" }, "CIS.1.3": { "Disabled": [], "Enabled": [ "acc_1" ], "DisabledReason": "Exception" }, "CIS.1.5": { "Disabled": [], "Enabled": [], "DisabledReason": "Exception" } } }')
     error_message = "SomeClientError"
     operation = "SomeOperation"
-    error = MagicMock()
-    error.get.return_value.get.return_value = error_message
-    boto3.client = MagicMock(side_effect=botocore.exceptions.ClientError(error, operation))
+    sts = MagicMock()
+    sts.assume_role.side_effect = botocore.exceptions.ClientError({"Error": {"Code": error_message, "Message": error_message}}, operation)
     context = MagicMock(return_value="admin_acc")
-    expected_response_fail = {"statusCode": 500, "account": "acc_1", "error": "An error occurred (" + error_message + ") when calling the " + operation + " operation: " + error_message}
-    response = UpdateMember.lambda_handler(event, context)
+    expected_response_fail = {"statusCode": 500, "account": "acc_1", "error": "An error occurred (" + error_message + ") when calling the " + operation + " operation: " + error_message, "metrics": ANY}
+    with patch.object(UpdateMember, "dynamodb_client", regions_table("us-east-1")), patch.object(UpdateMember, "sts_client", sts):
+        response = UpdateMember.lambda_handler(EVENT, context)
     assert response == expected_response_fail
 
 
+def test_lambda_handler_batch():
+    """
+    Distributed Map batches update every account and isolate failing accounts
+    """
+    event = {"Items": [{"account": "acc_1"}, {"account": "acc_2"}], "BatchInput": {"exceptions": EVENT["exceptions"], "dryRun": False}}
+    updated = []
+
+    def update_account(account_event, context):
+        if account_event["account"] == "acc_2":
+            raise ValueError("Broken")
+        updated.append(account_event)
+        return {"statusCode": 200, "account": account_event["account"]}
+
+    with patch.object(UpdateMember, "update_account", side_effect=update_account):
+        response = UpdateMember.lambda_handler(event, MagicMock())
+    assert response == [{"statusCode": 200, "account": "acc_1"}, {"statusCode": 500, "account": "acc_2", "error": "Broken"}]
+    assert updated[0]["exceptions"] == EVENT["exceptions"]
+    assert updated[0]["asyncStandards"] is False
+
+
+@patch("src.UpdateMember.index.os")
+@patch("src.UpdateMember.index.boto3")
+def test_lambda_handler_region_isolation(boto3, os):
+    """
+    A failing region is reported without discarding the results of the other regions.
+    """
+    os.environ = {"MemberRole": "arn:aws:iam::<accountId>:role/member", "RegionsDynamoDB": "regions"}
+    context = MagicMock()
+
+    def reconcile_region(event, region, *args):
+        if region == "us-west-2":
+            raise UpdateMember.SecurityStandardUpdateError("Security standard could not be enabled")
+        return {"updates": {"controls_changed": 2, "api_calls": 1, "failed": 0}}
+
+    with patch.object(UpdateMember, "reconcile_region", side_effect=reconcile_region), patch.object(UpdateMember, "dynamodb_client", regions_table("us-east-1", "us-west-2", "eu-west-1", concurrency=2)), patch.object(UpdateMember, "sts_client", sts_client()):
+        response = UpdateMember.lambda_handler(EVENT, context)
+    assert response["statusCode"] == 500
+    assert response["error"] == "us-west-2: Security standard could not be enabled"
+    assert response["updates"] == {"controls_changed": 4, "api_calls": 2, "failed": 0}
+    assert response["failedRegions"] == ["us-west-2"]
+
+
+@patch("src.UpdateMember.index.boto3")
+def test_reconcile_region_uses_baseline(boto3):
+    """
+    Administrator standards are taken from the baseline captured by GetMembers, no administrator client is created.
+    """
+    session = boto3.session.Session.return_value
+    session.client.return_value.meta.region_name = "test-baseline"
+    session.client.return_value.describe_standards.return_value = {"Standards": [{"StandardsArn": "arn"}]}
+    event = {"account": "acc_1", "exceptions": {}, "baseline": {"test-baseline": ["arn"]}}
+    with patch.object(UpdateMember, "get_enabled_standard_subscriptions") as get_enabled_standard_subscriptions, patch.object(UpdateMember, "update_standard_subscription", return_value=False) as update_standard_subscription, patch.object(UpdateMember, "update_member", return_value=NO_UPDATES), patch.object(UpdateMember, "sts_client", sts_client()):
+        UpdateMember.reconcile_region(event, "test-baseline", "admin_acc", "acc_1", "arn:aws:iam::acc_1:role/member")
+    assert session.client.call_count == 1
+    get_enabled_standard_subscriptions.assert_called_once_with({"Standards": [{"StandardsArn": "arn"}]}, "acc_1", session.client.return_value, "test-baseline")
+    assert update_standard_subscription.call_args.args[0] == {"StandardsSubscriptions": [{"StandardsArn": "arn"}]}
+
+
+@patch("src.UpdateMember.index.os")
+def test_get_region_concurrency(os):
+    os.environ = {"RegionConcurrency": "6"}
+    assert UpdateMember.get_region_concurrency(regions_table("us-east-1").get_item()["Item"]) == 6
+    assert UpdateMember.get_region_concurrency(regions_table("us-east-1", concurrency=2).get_item()["Item"]) == 2
+    os.environ = {}
+    assert UpdateMember.get_region_concurrency(regions_table("us-east-1").get_item()["Item"]) == UpdateMember.DEFAULT_REGION_CONCURRENCY
+    assert UpdateMember.get_region_concurrency(None) == UpdateMember.DEFAULT_REGION_CONCURRENCY
+
+
+@patch("src.UpdateMember.index.time")
+def test_get_account_item_cached(time):
+    time.time.return_value = 1000
+    dynamodb = regions_table("us-east-1")
+    assert UpdateMember.get_account_item(dynamodb, "regions", "acc_1")["Regions"] == {"L": [{"S": "us-east-1"}]}
+    assert UpdateMember.get_account_item(dynamodb, "regions", "acc_1")["Regions"] == {"L": [{"S": "us-east-1"}]}
+    dynamodb.get_item.assert_called_once_with(TableName="regions", Key={"AccountId": {"S": "acc_1"}})
+    time.time.return_value = 1000 + UpdateMember.DEFAULT_REGIONS_CACHE_TTL
+    UpdateMember.get_account_item(dynamodb, "regions", "acc_1")
+    assert dynamodb.get_item.call_count == 2
+
+
 @patch("src.UpdateMember.index.os")
 def test_get_enabled_standard_subscriptions(os):
     os.environ = {"AWS_REGION": "us-west-1"}
@@ -60,56 +222,181 @@ def test_get_enabled_standard_subscriptions(os):
     account_id = "acc_id"
     standards = {'Standards': [{'StandardsArn': 'arn:aws:securityhub:us-west-1::standard/aws-foundational-security-best-practices/v/1.0', 'Name': 'name', 'Description': 'description', 'EnabledByDefault': True}], 'NextToken': 'string'}
     subscription_arns = ["arn:aws:securityhub:us-west-1:acc_id:standard/aws-foundational-security-best-practices/v/1.0"]
-    UpdateMember.get_enabled_standard_subscriptions(standards, account_id, client)
+    UpdateMember.get_enabled_standard_subscriptions(standards, account_id, client, "us-west-1")
     client.get_enabled_standards.assert_called_with(StandardsSubscriptionArns=subscription_arns)
 
 
-@patch("src.UpdateMember.index.update_control_status")
-def test_update_member_exception_disabled(update_control_status):
+def mock_status_client(association_status):
+    client = MagicMock()
+    client.batch_get_standards_control_associations.return_value = {"StandardsControlAssociationDetails": [{"StandardsArn": "standard_1", "SecurityControlId": "CIS.1.1", "AssociationStatus": association_status}]}
+    client.batch_update_standards_control_associations.return_value = {"UnprocessedAssociationUpdates": []}
+    return client
+
+
+def test_update_member_exception_disabled():
     """
     Top level for loop identifying which control needs to be updated. Exceptionally disable control.
     """
-    DISABLED = "DISABLED"
-    ENABLED = "ENABLED"
-    client = MagicMock()
-    admin_controls = {"standard_1": [{"StandardsControlArn": "cis_1_1_arn", "ControlStatus": ENABLED, "ControlId": "CIS.1.1"}]}
-    member_controls = {"standard_1": [{"StandardsControlArn": "cis_1_1_arn", "ControlStatus": ENABLED, "ControlId": "CIS.1.1"}]}
+    client = mock_status_client("ENABLED")
+    controls = {"standard_1": ["CIS.1.1"]}
     exceptions = {"Disabled": ["CIS.1.1"], "Enabled": [], "DisabledReason": {"CIS.1.1": "SomeReason"}}
 
-    UpdateMember.update_member(admin_controls, member_controls, client, exceptions)
-    update_control_status.assert_called_once_with(member_controls["standard_1"][0], client, DISABLED, disabled_reason=exceptions["DisabledReason"]["CIS.1.1"])
+    stats = UpdateMember.update_member(controls, client, exceptions)
+    client.batch_update_standards_control_associations.assert_called_once_with(StandardsControlAssociationUpdates=[{"StandardsArn": "standard_1", "SecurityControlId": "CIS.1.1", "AssociationStatus": "DISABLED", "UpdatedReason": "SomeReason"}])
+    assert stats == {"controls_changed": 1, "api_calls": 1, "failed": 0}
 
 
-@patch("src.UpdateMember.index.update_control_status")
-def test_update_member_exception_enabled(update_control_status):
+def test_update_member_exception_enabled():
     """
     Top level for loop identifying which control needs to be updated. Exceptionally enable control.
     """
-    DISABLED = "DISABLED"
-    ENABLED = "ENABLED"
-    client = MagicMock()
-    admin_controls = {"standard_1": [{"StandardsControlArn": "cis_1_1_arn", "ControlStatus": DISABLED, "ControlId": "CIS.1.1"}]}
-    member_controls = {"standard_1": [{"StandardsControlArn": "cis_1_1_arn", "ControlStatus": DISABLED, "ControlId": "CIS.1.1"}]}
+    client = mock_status_client("DISABLED")
+    controls = {"standard_1": ["CIS.1.1"]}
     exceptions = {"Disabled": [], "Enabled": ["CIS.1.1"], "DisabledReason": {}}
 
-    UpdateMember.update_member(admin_controls, member_controls, client, exceptions)
-    update_control_status.assert_called_once_with(member_controls["standard_1"][0], client, ENABLED)
+    UpdateMember.update_member(controls, client, exceptions)
+    client.batch_update_standards_control_associations.assert_called_once_with(StandardsControlAssociationUpdates=[{"StandardsArn": "standard_1", "SecurityControlId": "CIS.1.1", "AssociationStatus": "ENABLED"}])
 
 
-@patch("src.UpdateMember.index.update_control_status")
-def test_update_member_regular(update_control_status):
+def test_update_member_regular():
     """
     Top level for loop identifying which control needs to be updated without exception.
     """
-    DISABLED = "DISABLED"
-    ENABLED = "ENABLED"
+    client = mock_status_client("ENABLED")
+    controls = {"standard_1": ["CIS.1.1"]}
+    exceptions = {"Disabled": [], "Enabled": [], "DisabledReason": {}}
+
+    stats = UpdateMember.update_member(controls, client, exceptions)
+    client.batch_update_standards_control_associations.assert_not_called()
+    assert stats == {"controls_changed": 0, "api_calls": 0, "failed": 0}
+
+
+def test_update_member_batches_updates():
+    """
+    250 drifted controls are sent in 3 calls instead of 250.
+    """
+    control_ids = ["Control." + str(number) for number in range(250)]
     client = MagicMock()
-    admin_controls = {"standard_1": [{"StandardsControlArn": "cis_1_1_arn", "ControlStatus": DISABLED, "ControlId": "CIS.1.1"}]}
-    member_controls = {"standard_1": [{"StandardsControlArn": "cis_1_1_arn", "ControlStatus": ENABLED, "ControlId": "CIS.1.1"}]}
+    client.batch_get_standards_control_associations.side_effect = lambda StandardsControlAssociationIds: {"StandardsControlAssociationDetails": [dict(association, AssociationStatus="DISABLED") for association in StandardsControlAssociationIds]}
+    client.batch_update_standards_control_associations.return_value = {"UnprocessedAssociationUpdates": []}
     exceptions = {"Disabled": [], "Enabled": [], "DisabledReason": {}}
 
-    UpdateMember.update_member(admin_controls, member_controls, client, exceptions)
-    update_control_status.assert_called_once_with(member_controls["standard_1"][0], client, DISABLED)
+    stats = UpdateMember.update_member({"standard_1": control_ids}, client, exceptions)
+    assert client.batch_get_standards_control_associations.call_count == 3
+    assert [len(call.kwargs["StandardsControlAssociationUpdates"]) for call in client.batch_update_standards_control_associations.call_args_list] == [100, 100, 50]
+    assert stats == {"controls_changed": 250, "api_calls": 3, "failed": 0}
+
+
+def test_update_member_async_matches_sync():
+    """
+    Both engines send the same control updates and return the same statistics
+    """
+    control_ids = ["Control." + str(number) for number in range(250)]
+    exceptions = {"Disabled": control_ids[:120], "Enabled": control_ids[200:], "DisabledReason": {control: "Exception" for control in control_ids}}
+
+    def status_client():
+        client = MagicMock()
+        client.batch_get_standards_control_associations.side_effect = lambda StandardsControlAssociationIds: {"StandardsControlAssociationDetails": [dict(association, AssociationStatus="ENABLED" if int(association["SecurityControlId"].split(".")[1]) % 2 else "DISABLED") for association in StandardsControlAssociationIds]}
+        client.batch_update_standards_control_associations.return_value = {"UnprocessedAssociationUpdates": []}
+        return client
+
+    def sent_updates(client):
+        return sorted((update["SecurityControlId"], update["AssociationStatus"]) for call in client.batch_update_standards_control_associations.call_args_list for update in call.kwargs["StandardsControlAssociationUpdates"])
+
+    sync_client, async_client = status_client(), status_client()
+    stats = UpdateMember.update_member({"standard_1": control_ids}, sync_client, exceptions)
+    with patch.dict(UpdateMember.os.environ, {"MaxInFlight": "3"}):
+        assert UpdateMember.update_member_async({"standard_1": control_ids}, async_client, exceptions) == stats
+    assert sent_updates(async_client) == sent_updates(sync_client)
+    assert async_client.batch_get_standards_control_associations.call_count == 3
+
+    async_client.batch_update_standards_control_associations.return_value = {"UnprocessedAssociationUpdates": [{"StandardsControlAssociationUpdate": {"SecurityControlId": "Control.0", "StandardsArn": "standard_1"}, "ErrorCode": "INVALID_INPUT"}]}
+    with pytest.raises(UpdateMember.ControlUpdateError):
+        UpdateMember.update_member_async({"standard_1": control_ids}, async_client, exceptions)
+
+
+def test_plan_member():
+    """
+    Planning returns current and desired status of drifted controls without updating them.
+    """
+    client = MagicMock()
+    client.batch_get_standards_control_associations.return_value = {"StandardsControlAssociationDetails": [
+        {"StandardsArn": "standard_1", "SecurityControlId": "CIS.1.1", "AssociationStatus": "ENABLED"},
+        {"StandardsArn": "standard_1", "SecurityControlId": "CIS.1.2", "AssociationStatus": "DISABLED"},
+        {"StandardsArn": "standard_1", "SecurityControlId": "CIS.1.3", "AssociationStatus": "ENABLED"},
+    ]}
+    exceptions = {"Disabled": ["CIS.1.1"], "Enabled": [], "DisabledReason": {"CIS.1.1": "SomeReason"}}
+
+    plan = UpdateMember.plan_member({"standard_1": ["CIS.1.1", "CIS.1.2", "CIS.1.3"]}, client, exceptions)
+    assert plan == {"standard_1": [["CIS.1.1", "ENABLED", "DISABLED"], ["CIS.1.2", "DISABLED", "ENABLED"]]}
+    client.batch_update_standards_control_associations.assert_not_called()
+
+
+def test_plan_region():
+    """
+    Standard changes are planned, controls of standards to be disabled are skipped.
+    """
+    client = securityhub_client("test-plan-region")
+    client.describe_standards.return_value = {"Standards": [{"StandardsArn": "arn_1"}, {"StandardsArn": "arn_2"}, {"StandardsArn": "arn_3"}]}
+    administrator_enabled_standards = {"StandardsSubscriptions": [{"StandardsArn": "arn_1"}, {"StandardsArn": "arn_2"}]}
+    member_enabled_standards = {"StandardsSubscriptions": [
+        {"StandardsArn": "arn_1", "StandardsSubscriptionArn": "arn:aws:securityhub:us-east-1:acc_1:subscription/standard_1/v/1.0", "StandardsStatus": "READY"},
+        {"StandardsArn": "arn_3", "StandardsSubscriptionArn": "arn:aws:securityhub:us-east-1:acc_1:subscription/standard_3/v/1.0", "StandardsStatus": "READY"},
+    ]}
+    client.batch_get_standards_control_associations.return_value = {"StandardsControlAssociationDetails": [{"StandardsArn": "arn_1", "SecurityControlId": "CIS.1.2", "AssociationStatus": "DISABLED"}]}
+    with patch.object(UpdateMember, "plan_standard_subscription", return_value=([{"StandardsArn": "arn_2"}], ["arn:aws:securityhub:us-east-1:acc_1:subscription/standard_3/v/1.0"])):
+        result = UpdateMember.plan_region({"account": "acc_1", "exceptions": {}}, "us-east-1", administrator_enabled_standards, member_enabled_standards, client)
+    assert result == {"plan": {
+        "controls": {"arn_1": [["CIS.1.2", "DISABLED", "ENABLED"]]},
+        "enable_standards": ["arn_2"],
+        "disable_standards": ["arn:aws:securityhub:us-east-1:acc_1:subscription/standard_3/v/1.0"],
+    }}
+    client.list_security_control_definitions.assert_called_with(StandardsArn="arn_1", NextToken="token")
+    client.batch_enable_standards.assert_not_called()
+    client.batch_disable_standards.assert_not_called()
+
+
+@patch("src.UpdateMember.index.os")
+def test_account_payload_plan(os):
+    """
+    Dry runs return the number of planned changes, the plans are part of the region details
+    """
+    os.environ = {}
+    plan_1 = {"controls": {"standard_1": [["CIS.1.1", "ENABLED", "DISABLED"]] * 150}, "enable_standards": ["standard_2"]}
+    region_results = [{"region": "us-east-1", "statusCode": 200, "plan": plan_1}, {"region": "us-west-2", "statusCode": 200, "plan": {"controls": {}}}]
+    payload = UpdateMember.account_payload(dict(EVENT, dryRun=True), MagicMock(), "acc_1", region_results, [], 0)
+    assert payload["plan"] == {"standards": 1, "controls": 150, "update_calls": 3}
+    assert "regions" not in payload
+
+
+@patch("src.UpdateMember.index.time")
+def test_control_update_batcher_retries_unprocessed(time):
+    """
+    Only unprocessed updates with a retryable error are sent again. Permanent errors are reported.
+    """
+    updates = [UpdateMember.update_control_status("standard_1", control_id, "ENABLED") for control_id in ("A.1", "A.2", "A.3")]
+    client = MagicMock()
+    client.batch_update_standards_control_associations.side_effect = [
+        {"UnprocessedAssociationUpdates": [{"StandardsControlAssociationUpdate": updates[1], "ErrorCode": "LIMIT_EXCEEDED"}, {"StandardsControlAssociationUpdate": updates[2], "ErrorCode": "INVALID_INPUT"}]},
+        {"UnprocessedAssociationUpdates": []},
+    ]
+    batcher = UpdateMember.ControlUpdateBatcher(client)
+    for update in updates:
+        batcher.add(update)
+    batcher.flush()
+
+    assert client.batch_update_standards_control_associations.call_args_list[1].kwargs == {"StandardsControlAssociationUpdates": [updates[1]]}
+    assert batcher.stats() == {"controls_changed": 2, "api_calls": 2, "failed": 1}
+    assert batcher.failed[0]["SecurityControlId"] == "A.3"
+
+
+def test_update_member_raises_on_failed_updates():
+    client = mock_status_client("ENABLED")
+    client.batch_update_standards_control_associations.return_value = {"UnprocessedAssociationUpdates": [{"StandardsControlAssociationUpdate": {"StandardsArn": "standard_1", "SecurityControlId": "CIS.1.1", "AssociationStatus": "DISABLED"}, "ErrorCode": "ACCESS_DENIED"}]}
+    exceptions = {"Disabled": ["CIS.1.1"], "Enabled": [], "DisabledReason": {"CIS.1.1": "SomeReason"}}
+
+    with pytest.raises(UpdateMember.ControlUpdateError):
+        UpdateMember.update_member({"standard_1": ["CIS.1.1"]}, client, exceptions)
 
 
 def test_update_standard_subscription_enable():
@@ -186,27 +473,358 @@ def test_update_standard_subscription_disable_fail():
         UpdateMember.update_standard_subscription(administrator_enabled_standards_none, member_enabled_standards, client)
 
 
-def test_update_control_status():
-    member_control = {"StandardsControlArn": "Arn"}
+@patch("src.UpdateMember.index.time.sleep")
+def test_wait_for_standards_backoff(sleep):
+    """
+    Only the changed subscriptions are polled, with growing delays, until they are ready.
+    """
+    client = MagicMock()
+    client.get_enabled_standards.side_effect = [
+        {"StandardsSubscriptions": [{"StandardsStatus": "PENDING"}]},
+        {"StandardsSubscriptions": [{"StandardsStatus": "PENDING"}]},
+        {"StandardsSubscriptions": [{"StandardsStatus": "READY"}]},
+    ]
+    UpdateMember.wait_for_standards(client, ["subscription_1"], "enabled")
+    client.get_enabled_standards.assert_called_with(StandardsSubscriptionArns=["subscription_1"])
+    delays = [call.args[0] for call in sleep.call_args_list]
+    assert len(delays) == 2
+    assert 0.5 <= delays[0] <= 1 and 1 <= delays[1] <= 2
+
+
+@patch("src.UpdateMember.index.time.sleep")
+def test_wait_for_standards_timeout(sleep):
+    client = MagicMock()
+    client.get_enabled_standards.return_value = {"StandardsSubscriptions": [{"StandardsStatus": "DELETING"}]}
+    with patch.dict("os.environ", {"StandardsWaitTimeout": "0"}):
+        with pytest.raises(UpdateMember.SecurityStandardUpdateError):
+            UpdateMember.wait_for_standards(client, ["subscription_1"], "disabled")
+    sleep.assert_not_called()
+
+
+def test_update_standard_subscription_async():
+    """
+    Enable standard without waiting, the state machine resumes the region later
+    """
+    administrator_enabled_standards = {"StandardsSubscriptions": [{"StandardsArn": "standard_1"}]}
+    member_enabled_standards_none = {"StandardsSubscriptions": []}
     client = MagicMock()
+    client.describe_standards.return_value = {"Standards": [{"StandardsArn": "standard_1"}]}
+
+    standards_changed = UpdateMember.update_standard_subscription(administrator_enabled_standards, member_enabled_standards_none, client, wait=False)
+    assert standards_changed
+    client.batch_enable_standards.assert_called_once_with(StandardsSubscriptionRequests=[{"StandardsArn": "standard_1"}])
+    client.get_enabled_standards.assert_not_called()
+
+
+@patch("src.UpdateMember.index.os")
+@patch("src.UpdateMember.index.boto3")
+def test_lambda_handler_pending_regions(boto3, os):
+    """
+    Regions waiting for a standards update are returned as pendingRegions and added to the previous result when resumed.
+    """
+    os.environ = {"MemberRole": "arn:aws:iam::<accountId>:role/member", "RegionsDynamoDB": "regions"}
+    updates = {"controls_changed": 1, "api_calls": 1, "failed": 0}
+
+    def reconcile_region(event, region, *args):
+        if region == "us-west-2" and "pendingRegions" not in event:
+            return {"pending": True, "subscriptions": ["subscription"]}
+        return {"updates": updates}
+
+    with patch.object(UpdateMember, "reconcile_region", side_effect=reconcile_region), patch.object(UpdateMember, "dynamodb_client", regions_table("us-east-1", "us-west-2")), patch.object(UpdateMember, "sts_client", sts_client()):
+        response = UpdateMember.lambda_handler(EVENT, MagicMock())
+        assert response["statusCode"] == 200
+        assert response["pendingRegions"] == ["us-west-2"]
+        assert response["pendingSubscriptions"] == {"us-west-2": ["subscription"]}
+        assert response["updates"] == updates
+
+        resumed_event = dict(EVENT, pendingRegions=response["pendingRegions"], previousResult=response, resumeAttempt=response["resumeAttempt"])
+        response = UpdateMember.lambda_handler(resumed_event, MagicMock())
+    assert "pendingRegions" not in response
+    assert response["updates"] == {"controls_changed": 2, "api_calls": 2, "failed": 0}
+
+
+@patch("src.UpdateMember.index.os")
+def test_account_payload_details(os):
+    """
+    Region details are written to the ExecutionDataBucket, the account result only keeps totals and failed regions
+    """
+    os.environ = {"ExecutionDataBucket": "bucket"}
+    import src.GetMembers.index as GetMembers
+    regions = ["ap-southeast-{}".format(number) for number in range(17)]
+    region_results = [
+        {"region": region, "statusCode": 500, "error": "An error occurred (AccessDenied) " * 10, "duration": 1.5, "throttles": 0}
+        for region in regions
+    ]
+    s3 = MagicMock()
+    s3.get_object.return_value = {"Body": io.BytesIO(json.dumps([{"region": "us-east-1", "statusCode": 200}]).encode())}
+    previous = {"statusCode": 200, "account": "acc_1", "updates": {"controls_changed": 3, "api_calls": 1, "failed": 0}, "detailsKey": "details/execution/acc_1.json"}
+    with patch.object(UpdateMember, "s3_client", s3):
+        payload = UpdateMember.account_payload(dict(EVENT, execution="execution", previousResult=previous), MagicMock(), "acc_1", region_results, [], 1)
+    assert payload["statusCode"] == 500
+    assert payload["failedRegions"] == regions
+    assert payload["updates"] == {"controls_changed": 3, "api_calls": 1, "failed": 0}
+    assert payload["detailsKey"] == "details/execution/acc_1.json"
+    assert len(json.dumps(payload)) < GetMembers.ACCOUNT_RESULT_SIZE
+    details = json.loads(s3.put_object.call_args.kwargs["Body"])
+    assert [result["region"] for result in details] == ["us-east-1"] + regions
+
+
+def test_reconcile_region_resumed_standards_failed():
+    """
+    A resumed region fails if the standards update of the previous invocation did not succeed
+    """
+    client = securityhub_client("us-east-1")
+    event = {"account": "acc_1", "exceptions": EVENT["exceptions"], "baseline": {"us-east-1": ["arn"]}, "pendingRegions": ["us-east-1"],
+             "previousResult": {"pendingSubscriptions": {"us-east-1": ["subscription"]}}}
+    failed = {"StandardsSubscriptions": [{"StandardsArn": "arn", "StandardsSubscriptionArn": "subscription", "StandardsStatus": "FAILED"}]}
+    with patch.object(UpdateMember, "client_pool") as client_pool, patch.object(UpdateMember, "get_standards", return_value={"Standards": []}), patch.object(UpdateMember, "get_enabled_standard_subscriptions", return_value=failed), patch.object(UpdateMember, "update_member") as update_member:
+        client_pool.client.return_value = client
+        with pytest.raises(UpdateMember.SecurityStandardUpdateError):
+            UpdateMember.reconcile_region(event, "us-east-1", "admin_acc", "acc_1", "role")
+    update_member.assert_not_called()
+
+
+def test_reconcile_region_resumed_standards_incomplete():
+    """
+    A resumed region only checks the subscriptions changed by the previous invocation, INCOMPLETE ones do not fail it
+    """
+    client = securityhub_client("us-east-1")
+    event = {"account": "acc_1", "exceptions": EVENT["exceptions"], "baseline": {"us-east-1": ["arn", "arn_2"]}, "pendingRegions": ["us-east-1"],
+             "previousResult": {"pendingSubscriptions": {"us-east-1": ["subscription"]}}}
+    subscriptions = {"StandardsSubscriptions": [
+        {"StandardsArn": "arn", "StandardsSubscriptionArn": "subscription", "StandardsStatus": "READY"},
+        {"StandardsArn": "arn_2", "StandardsSubscriptionArn": "subscription_2", "StandardsStatus": "INCOMPLETE"},
+    ]}
+    with patch.object(UpdateMember, "client_pool") as client_pool, patch.object(UpdateMember, "get_standards", return_value={"Standards": []}), patch.object(UpdateMember, "get_enabled_standard_subscriptions", return_value=subscriptions), patch.object(UpdateMember, "get_controls", return_value={}), patch.object(UpdateMember, "update_member", return_value=NO_UPDATES) as update_member:
+        client_pool.client.return_value = client
+        UpdateMember.reconcile_region(event, "us-east-1", "admin_acc", "acc_1", "role")
+    update_member.assert_called_once()
+
+
+def test_lambda_handler_account_batch():
+    """
+    Batches of accounts are updated by a worker pool, a failed account does not fail the others
+    """
+    def update_account(event, context):
+        assert event["asyncStandards"] is False
+        if event["account"] == "acc_2":
+            raise RuntimeError("failed")
+        return {"statusCode": 200, "account": event["account"]}
+
+    with patch.object(UpdateMember, "update_account", side_effect=update_account):
+        response = UpdateMember.lambda_handler(dict(EVENT, account=["acc_1", "acc_2", "acc_3"]), MagicMock())
+    assert [result["account"] for result in response] == ["acc_1", "acc_2", "acc_3"]
+    assert [result["statusCode"] for result in response] == [200, 500, 200]
+    assert response[1]["error"] == "failed"
+
+
+def test_update_control_status():
     disabled_reason = "Some_Reason"
 
     new_status = "DISABLED"
-    UpdateMember.update_control_status(member_control, client, new_status, disabled_reason)
-    client.update_standards_control.assert_called_with(StandardsControlArn="Arn", ControlStatus=new_status, DisabledReason="Some_Reason")
-    UpdateMember.update_control_status(member_control, client, new_status)
-    client.update_standards_control.assert_called_with(StandardsControlArn="Arn", ControlStatus=new_status, DisabledReason=UpdateMember.DISABLED_REASON)
+    update = UpdateMember.update_control_status("Arn", "CIS.1.1", new_status, disabled_reason)
+    assert update == {"StandardsArn": "Arn", "SecurityControlId": "CIS.1.1", "AssociationStatus": new_status, "UpdatedReason": "Some_Reason"}
+    update = UpdateMember.update_control_status("Arn", "CIS.1.1", new_status)
+    assert update["UpdatedReason"] == UpdateMember.DISABLED_REASON
 
     new_status = "ENABLED"
-    UpdateMember.update_control_status(member_control, client, new_status, disabled_reason)
-    client.update_standards_control.assert_called_with(StandardsControlArn="Arn", ControlStatus=new_status)
+    update = UpdateMember.update_control_status("Arn", "CIS.1.1", new_status, disabled_reason)
+    assert update == {"StandardsArn": "Arn", "SecurityControlId": "CIS.1.1", "AssociationStatus": new_status}
+
+
+def securityhub_client(region):
+    client = MagicMock()
+    client.meta.region_name = region
+    client.list_security_control_definitions.side_effect = [
+        {"SecurityControlDefinitions": [{"SecurityControlId": "CIS.1.1", "CurrentRegionAvailability": "AVAILABLE"}], "NextToken": "token"},
+        {"SecurityControlDefinitions": [{"SecurityControlId": "CIS.1.2", "CurrentRegionAvailability": "UNAVAILABLE"}]},
+    ]
+    return client
 
 
 def test_get_controls():
     enabled_standards = {"StandardsSubscriptions": [{"StandardsArn": "arn", "StandardsSubscriptionArn": "arn"}]}
-    control = {'StandardsControlArn': 'string', 'ControlStatus': 'ENABLED', 'DisabledReason': 'string', 'ControlStatusUpdatedAt': "date", 'ControlId': 'string', 'Title': 'string', 'Description': 'string', 'RemediationUrl': 'string', 'SeverityRating': 'LOW', 'RelatedRequirements': ['string']}
-    client = MagicMock()
-    client.describe_standards_controls.return_value = {"Controls": [control]}
-    expected_response = {"arn": [control]}
+    client = securityhub_client("test-get-controls-1")
+    expected_response = {"arn": ["CIS.1.1"]}
     response = UpdateMember.get_controls(enabled_standards, client)
     assert response == expected_response
+    client.list_security_control_definitions.assert_called_with(StandardsArn="arn", NextToken="token")
+
+
+def test_get_controls_delta():
+    enabled_standards = {"StandardsSubscriptions": [{"StandardsArn": "arn", "StandardsSubscriptionArn": "arn"}]}
+    client = securityhub_client("test-get-controls-delta")
+    assert UpdateMember.get_controls(enabled_standards, client, {"CIS.1.3"}) == {"arn": []}
+    assert UpdateMember.get_controls(enabled_standards, client, {"CIS.1.1"}) == {"arn": ["CIS.1.1"]}
+    assert UpdateMember.delta_controls({"controls": None}) is None
+    assert UpdateMember.delta_controls({"controls": ["CIS.1.1"]}) == {"CIS.1.1"}
+
+
+def test_get_controls_cached():
+    """
+    The catalog of a region and standard is fetched once and reused for other accounts until the TTL expires.
+    """
+    enabled_standards = {"StandardsSubscriptions": [{"StandardsArn": "arn", "StandardsSubscriptionArn": "arn"}]}
+    client = securityhub_client("test-get-controls-2")
+    other_account_client = securityhub_client("test-get-controls-2")
+    UpdateMember.get_controls(enabled_standards, client)
+    assert UpdateMember.get_controls(enabled_standards, other_account_client) == {"arn": ["CIS.1.1"]}
+    other_account_client.list_security_control_definitions.assert_not_called()
+
+    with patch("time.time", return_value=time.time() + UpdateMember.DEFAULT_CATALOG_CACHE_TTL + 1):
+        UpdateMember.get_controls(enabled_standards, other_account_client)
+    assert other_account_client.list_security_control_definitions.call_count == 2
+
+
+def test_get_standards_from_shared_catalog():
+    """
+    Standards and controls prefetched by GetMembers are read from S3 instead of the SecurityHub API.
+    """
+    shared_catalog = {"FetchedAt": time.time(), "Standards": [{"StandardsArn": "arn"}], "Controls": {"arn": {"Available": ["CIS.1.1"], "Unavailable": []}}}
+    s3 = MagicMock()
+    s3.get_object.return_value = {"Body": io.BytesIO(json.dumps(shared_catalog).encode())}
+    client = securityhub_client("test-shared-catalog")
+    with patch.dict("os.environ", {"ExecutionDataBucket": "bucket"}), patch.object(UpdateMember, "s3_client", s3):
+        assert UpdateMember.get_standards(client) == {"Standards": [{"StandardsArn": "arn"}]}
+        assert UpdateMember.get_control_catalog("arn", client) == (["CIS.1.1"], [])
+    s3.get_object.assert_called_once_with(Bucket="bucket", Key="catalog/test-shared-catalog.json")
+    client.describe_standards.assert_not_called()
+    client.list_security_control_definitions.assert_not_called()
+
+
+@patch("src.UpdateMember.index.time")
+def test_local_rate_limiter(time):
+    time.monotonic.return_value = 100
+    limiter = UpdateMember.LocalRateLimiter({"BatchEnableStandards": (1, 1), "default": (10, 2)})
+    assert limiter.acquire("acc_1#us-east-1#GetEnabledStandards", "GetEnabledStandards") == 0
+    assert limiter.acquire("acc_1#us-east-1#GetEnabledStandards", "GetEnabledStandards") == 0
+    assert limiter.acquire("acc_1#us-east-1#BatchEnableStandards", "BatchEnableStandards") == 0
+
+    # empty bucket waits until the next token is refilled
+    time.sleep.side_effect = lambda delay: setattr(time.monotonic, "return_value", time.monotonic.return_value + delay)
+    assert limiter.acquire("acc_1#us-east-1#BatchEnableStandards", "BatchEnableStandards") == 1
+    time.sleep.assert_called_once_with(1)
+
+
+@patch("src.UpdateMember.index.time")
+def test_dynamodb_rate_limiter(time):
+    time.time.return_value = 1000.5
+    client = MagicMock()
+    client.update_item.side_effect = [
+        botocore.exceptions.ClientError({"Error": {"Code": "ConditionalCheckFailedException"}}, "UpdateItem"),
+        {},
+    ]
+    limiter = UpdateMember.DynamoDBRateLimiter(client, "rate-limits")
+    assert limiter.acquire("acc_1#us-east-1#BatchEnableStandards", "BatchEnableStandards") > 0
+    assert client.update_item.call_args.kwargs["Key"] == {"BucketKey": {"S": "acc_1#us-east-1#BatchEnableStandards#1000"}}
+    assert client.update_item.call_args.kwargs["ExpressionAttributeValues"][":tokens"] == {"N": "1"}
+
+    # a burst of 30 at 10 requests per second is allowed once per window of 3 seconds
+    client.update_item.side_effect = None
+    limiter = UpdateMember.DynamoDBRateLimiter(client, "rate-limits", {"default": (10, 30)})
+    assert limiter.acquire("acc_1#us-east-1#DescribeStandards", "DescribeStandards") == 0
+    assert client.update_item.call_args.kwargs["Key"] == {"BucketKey": {"S": "acc_1#us-east-1#DescribeStandards#333"}}
+    assert client.update_item.call_args.kwargs["ExpressionAttributeValues"][":tokens"] == {"N": "30"}
+
+    # an unavailable table does not block the update
+    client.update_item.side_effect = botocore.exceptions.ClientError({"Error": {"Code": "ResourceNotFoundException"}}, "UpdateItem")
+    assert limiter.acquire("acc_1#us-east-1#BatchEnableStandards", "BatchEnableStandards") == 0
+
+
+def test_rate_limit_client():
+    client = MagicMock()
+    limiter = MagicMock()
+    with patch.object(UpdateMember, "rate_limiter", limiter):
+        UpdateMember.rate_limit_client(client, "admin_acc", "us-east-1")
+    handlers = {call.args[0]: call.args[1] for call in client.meta.events.register.call_args_list}
+    model = MagicMock()
+    model.name = "GetEnabledStandards"
+    handlers["before-call.securityhub"](model=model, params={})
+    limiter.acquire.assert_called_once_with("admin_acc#us-east-1#GetEnabledStandards", "GetEnabledStandards")
+
+    handlers["needs-retry.securityhub"](response=(None, {"Error": {"Code": "TooManyRequestsException"}}), attempts=1)
+    handlers["needs-retry.securityhub"](response=(None, {}), attempts=1)
+    assert UpdateMember.throttle_counts.pop(("admin_acc", "us-east-1")) == 1
+
+
+@patch("src.UpdateMember.index.boto3")
+def test_client_pool_reuses_clients(boto3, client_pool):
+    """
+    Credentials are assumed once per role and clients are created once per account, region and role
+    """
+    sts = sts_client()
+    with patch.object(UpdateMember, "sts_client", sts), patch.object(UpdateMember, "rate_limiter", MagicMock()):
+        client = client_pool.client("acc_1", "us-east-1", "arn:aws:iam::acc_1:role/member")
+        assert client_pool.client("acc_1", "us-east-1", "arn:aws:iam::acc_1:role/member") is client
+        client_pool.client("acc_1", "eu-west-1", "arn:aws:iam::acc_1:role/member")
+        client_pool.client("admin_acc", "us-east-1")
+    sts.assume_role.assert_called_once_with(RoleArn="arn:aws:iam::acc_1:role/member", RoleSessionName="SecurityHubUpdater")
+    assert boto3.session.Session.return_value.client.call_count == 3
+
+
+@patch("src.UpdateMember.index.boto3")
+def test_client_pool_refreshes_credentials(boto3, client_pool):
+    """
+    Credentials expiring within the botocore refresh window are assumed again
+    """
+    sts = sts_client()
+    sts.assume_role.return_value["Credentials"]["Expiration"] = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(minutes=5)
+    with patch.object(UpdateMember, "sts_client", sts):
+        session = client_pool.session("arn:aws:iam::acc_1:role/member")
+    credentials = boto3.session.Session.call_args.kwargs["botocore_session"].get_credentials()
+    sts.assume_role.return_value["Credentials"]["Expiration"] = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+    with patch.object(UpdateMember, "sts_client", sts):
+        assert client_pool.session("arn:aws:iam::acc_1:role/member") is session
+        credentials.get_frozen_credentials()
+    assert sts.assume_role.call_count == 2
+
+
+def test_client_pool_shares_data_loader(client_pool):
+    """
+    Sessions of all roles share one loader, so the service model data is loaded once per container
+    """
+    with patch.object(UpdateMember, "sts_client", sts_client()):
+        member = client_pool.session("arn:aws:iam::acc_1:role/member")
+        other_member = client_pool.session("arn:aws:iam::acc_2:role/member")
+    execution_role = client_pool.session()
+    loaders = [session._session.get_component("data_loader") for session in (member, other_member, execution_role)]
+    assert loaders[0] is client_pool.data_loader
+    assert all(loader is loaders[0] for loader in loaders)
+    assert member.get_credentials().access_key == "id"
+
+
+def test_client_pool_bounded(client_pool):
+    client_pool.max_clients = 2
+    with patch.object(UpdateMember, "boto3"), patch.object(UpdateMember, "rate_limiter", MagicMock()):
+        for region in ("us-east-1", "us-west-2", "eu-west-1"):
+            client_pool.client("admin_acc", region)
+    assert list(client_pool.clients) == [("admin_acc", "us-west-2", None), ("admin_acc", "eu-west-1", None)]
+
+
+@patch("src.UpdateMember.index.os")
+def test_reconcile_region_skips_unchanged(os):
+    """
+    Regions with an unchanged fingerprint are not reconciled until the forced resync interval passed
+    """
+    os.environ = {"SnapshotTable": "snapshots", "FullResyncInterval": "3600"}
+    client = securityhub_client("us-east-1")
+    event = {"account": "acc_1", "exceptions": EVENT["exceptions"], "baseline": {"us-east-1": []}}
+    dynamodb = MagicMock()
+    dynamodb.get_item.return_value = {}
+    with patch.object(UpdateMember, "client_pool") as client_pool, patch.object(UpdateMember, "dynamodb_client", dynamodb), patch.object(UpdateMember, "get_enabled_standard_subscriptions", return_value={"StandardsSubscriptions": []}), patch.object(UpdateMember, "update_member", return_value=NO_UPDATES) as update_member:
+        client_pool.client.return_value = client
+        assert "skipped" not in UpdateMember.reconcile_region(event, "us-east-1", "admin_acc", "acc_1", "role")
+        snapshot = dynamodb.put_item.call_args.kwargs["Item"]
+        assert snapshot["SnapshotKey"] == {"S": "acc_1#us-east-1"}
+
+        dynamodb.get_item.return_value = {"Item": snapshot}
+        assert UpdateMember.reconcile_region(event, "us-east-1", "admin_acc", "acc_1", "role")["skipped"] is True
+        assert update_member.call_count == 1
+
+        # changed exceptions, forced and expired resyncs reconcile again
+        changed = dict(event, exceptions={"CIS.1.1": {"Disabled": ["acc_1"], "Enabled": [], "DisabledReason": "Changed"}})
+        assert "skipped" not in UpdateMember.reconcile_region(changed, "us-east-1", "admin_acc", "acc_1", "role")
+        assert "skipped" not in UpdateMember.reconcile_region(dict(event, forceFullSync=True), "us-east-1", "admin_acc", "acc_1", "role")
+        snapshot["SyncedAt"] = {"N": "0"}
+        assert "skipped" not in UpdateMember.reconcile_region(event, "us-east-1", "admin_acc", "acc_1", "role")
+        assert update_member.call_count == 4
@@ -0,0 +1,230 @@
+import hashlib
+import io
+import json
+import pytest
+import lambda_handlers
+from unittest.mock import patch, MagicMock
+
+
+def test_diff_items():
+    items = [
+        {"ControlId": {"S": "IAM.6"}, "Disabled": {"L": [{"S": "ALL"}]}, "DisabledReason": {"S": "We use virtual MFA"}},
+        {"ControlId": {"S": "CloudTrail.5"}, "Disabled": {"L": [{"S": "ALL"}]}, "DisabledReason": {"S": "Old reason"}},
+        {"ControlId": {"S": "GuardDuty.1"}, "Disabled": {"L": [{"S": "ALL"}]}, "DisabledReason": {"S": "Removed"}},
+    ]
+    data = [
+        {"ControlId": "IAM.6", "Disabled": ["ALL"], "DisabledReason": "We use virtual MFA"},
+        {"ControlId": "CloudTrail.5", "Disabled": ["ALL"], "DisabledReason": "New reason"},
+        {"ControlId": "KMS.2", "Enabled": ["ALL"], "DisabledReason": "Global resource", "Region": ["us-east-1"]},
+    ]
+    to_write, to_delete, counts = lambda_handlers.diff_items(items, data, "ControlId")
+    assert [entry["ControlId"] for entry in to_write] == ["CloudTrail.5", "KMS.2"]
+    assert to_delete == ["GuardDuty.1"]
+    assert counts == {"added": 1, "updated": 1, "deleted": 1, "unchanged": 1}
+
+
+def test_diff_items_numbers():
+    items = [{"AccountId": {"S": "111111111111"}, "Regions": {"L": [{"S": "us-east-1"}]}, "RegionConcurrency": {"N": "2"}}]
+    data = [{"AccountId": "111111111111", "Regions": ["us-east-1"], "RegionConcurrency": 2}]
+    assert lambda_handlers.diff_items(items, data, "AccountId")[2]["unchanged"] == 1
+
+
+@patch("lambda_handlers.time")
+@patch("lambda_handlers.get_client")
+def test_process_item(get_client, time):
+    """
+    Changed items are written in batches of 25, unprocessed items are retried
+    """
+    client = get_client.return_value
+    data = [{"AccountId": str(account), "Regions": ["us-east-1"]} for account in range(30)]
+    items = [{"AccountId": {"S": "removed"}, "Regions": {"L": [{"S": "us-east-1"}]}}]
+    unprocessed = {"PutRequest": {"Item": {"AccountId": {"S": "0"}, "Regions": {"L": [{"S": "us-east-1"}]}}}}
+    client.batch_write_item.side_effect = [{"UnprocessedItems": {"regions": [unprocessed]}}, {}, {}]
+    changed, counts = lambda_handlers.process_item(items, data, "regions", "AccountId")
+    assert changed == [str(account) for account in range(30)] + ["removed"]
+    assert counts == {"added": 30, "updated": 0, "deleted": 1, "unchanged": 0}
+    batches = [call.kwargs["RequestItems"]["regions"] for call in client.batch_write_item.call_args_list]
+    assert [len(batch) for batch in batches] == [25, 1, 6]
+    assert batches[0][0] == {"PutRequest": {"Item": {"AccountId": {"S": "0"}, "Regions": {"L": [{"S": "us-east-1"}]}}}}
+    assert batches[2][-1] == {"DeleteRequest": {"Key": {"AccountId": {"S": "removed"}}}}
+
+
+@patch("lambda_handlers.get_client")
+def test_process_item_empty_file(get_client):
+    items = [{"ControlId": {"S": "IAM.6"}, "Disabled": {"L": [{"S": "ALL"}]}, "DisabledReason": {"S": "Reason"}}]
+    changed, counts = lambda_handlers.process_item(items, [], "items", "ControlId")
+    assert changed == []
+    get_client.return_value.batch_write_item.assert_not_called()
+
+
+def pending_table(client):
+    """ keep the pending changes item of the mocked client in memory """
+    pending = dict()
+
+    def update_item(TableName, Key, UpdateExpression, ExpressionAttributeValues):
+        if ":full_sync" in ExpressionAttributeValues:
+            pending["FullSync"] = {"BOOL": True}
+        else:
+            controls = set(pending.get("Controls", {}).get("SS", [])) | set(ExpressionAttributeValues[":controls"]["SS"])
+            pending["Controls"] = {"SS": sorted(controls)}
+
+    def delete_item(TableName, Key, ReturnValues):
+        attributes = dict(pending)
+        pending.clear()
+        return {"Attributes": attributes} if attributes else {}
+
+    client.update_item.side_effect = update_item
+    client.delete_item.side_effect = delete_item
+    return pending
+
+
+@patch.dict("os.environ", {"IngestStateDynamoDB": "ingest-state"})
+@patch("lambda_handlers.get_client")
+def test_start_execution_delta(get_client):
+    client = get_client.return_value
+    pending_table(client)
+    client.list_executions.return_value = {"executions": []}
+    client.start_execution.return_value = {"executionArn": "execution_arn"}
+    lambda_handlers.start_execution("table", "state_machine_arn", controls=["IAM.6"])
+    client.get_waiter.assert_called_with("table_exists")
+    client.start_execution.assert_called_once_with(stateMachineArn="state_machine_arn", input='{"controls": ["IAM.6"]}')
+    lambda_handlers.start_execution("table", "state_machine_arn")
+    client.start_execution.assert_called_with(stateMachineArn="state_machine_arn", input="{}")
+
+
+@patch.dict("os.environ", {"IngestStateDynamoDB": "ingest-state", "StateMachineArn": "state_machine_arn"})
+@patch("lambda_handlers.get_client")
+def test_start_execution_coalesces_changes(get_client):
+    """
+    Changes uploaded during an execution are started as one execution when it finishes
+    """
+    client = get_client.return_value
+    pending = pending_table(client)
+    client.list_executions.return_value = {"executions": [{"executionArn": "running"}]}
+    client.start_execution.return_value = {"executionArn": "execution_arn"}
+    assert lambda_handlers.start_execution("table", "state_machine_arn", controls=["IAM.6"])["statusCode"] == 202
+    assert lambda_handlers.start_execution("table", "state_machine_arn", controls=["KMS.2", "IAM.6"])["statusCode"] == 202
+    client.start_execution.assert_not_called()
+    assert pending == {"Controls": {"SS": ["IAM.6", "KMS.2"]}}
+
+    # the finished execution may still be listed as running
+    finished = {"source": "aws.states", "detail": {"status": "SUCCEEDED", "executionArn": "running"}}
+    lambda_handlers.lambda_handler(finished, None)
+    client.start_execution.assert_called_once_with(stateMachineArn="state_machine_arn", input='{"controls": ["IAM.6", "KMS.2"]}')
+    # nothing pending, no further execution
+    lambda_handlers.lambda_handler(finished, None)
+    assert client.start_execution.call_count == 1
+
+
+@patch.dict("os.environ", {"IngestStateDynamoDB": "ingest-state"})
+@patch("lambda_handlers.get_client")
+def test_start_execution_full_sync_wins(get_client):
+    client = get_client.return_value
+    pending = pending_table(client)
+    client.list_executions.return_value = {"executions": [{"executionArn": "running"}]}
+    lambda_handlers.start_execution("table", "state_machine_arn", controls=["IAM.6"])
+    lambda_handlers.start_execution("table", "state_machine_arn")
+    assert lambda_handlers.claim_pending_changes() == {"controls": None}
+
+
+def ingest_clients(get_client, get_resource, body, state):
+    s3 = MagicMock()
+    s3.head_object.return_value = {"ETag": '"etag"'}
+    s3.get_object.return_value = {"Body": io.BytesIO(json.dumps(body).encode())}
+    dynamodb = MagicMock()
+    dynamodb.batch_write_item.return_value = {}
+    get_client.side_effect = lambda service: s3 if service == "s3" else dynamodb
+    state_table = get_resource.return_value.Table.return_value
+    state_table.get_item.return_value = {"Item": state} if state else {}
+    return s3, dynamodb, state_table
+
+
+@patch.dict("os.environ", {"IngestStateDynamoDB": "ingest-state"})
+@patch("lambda_handlers.get_resource")
+@patch("lambda_handlers.get_client")
+def test_ingest_file_unchanged(get_client, get_resource):
+    data = [{"ControlId": "IAM.6", "Disabled": ["ALL"], "DisabledReason": "We use virtual MFA"}]
+    s3, dynamodb, state_table = ingest_clients(get_client, get_resource, data, {"StateKey": "file#items.json", "ETag": '"etag"'})
+    assert lambda_handlers.ingest_file("bucket", "items.json", "items", "ControlId") == ([], {"skipped": True}, None)
+    s3.get_object.assert_not_called()
+
+    # same content uploaded as a new object
+    body = json.dumps(data).encode()
+    state = {"StateKey": "file#items.json", "ETag": '"old"', "ContentHash": hashlib.sha256(body).hexdigest()}
+    s3, dynamodb, state_table = ingest_clients(get_client, get_resource, data, state)
+    assert lambda_handlers.ingest_file("bucket", "items.json", "items", "ControlId") == ([], {"skipped": True}, None)
+    dynamodb.batch_write_item.assert_not_called()
+    dynamodb.scan.assert_not_called()
+
+
+@patch.dict("os.environ", {"IngestStateDynamoDB": "ingest-state"})
+@patch("lambda_handlers.get_resource")
+@patch("lambda_handlers.get_client")
+def test_ingest_file_item_hashes(get_client, get_resource):
+    """
+    Items are compared with the hashes of the previous ingest, the table is not scanned
+    """
+    unchanged = {"ControlId": "IAM.6", "Disabled": ["ALL"], "DisabledReason": "We use virtual MFA"}
+    changed = {"ControlId": "CloudTrail.5", "Disabled": ["ALL"], "DisabledReason": "New reason"}
+    item_hashes = {"IAM.6": lambda_handlers.item_hash(unchanged), "CloudTrail.5": "old", "GuardDuty.1": "removed"}
+    s3, dynamodb, state_table = ingest_clients(get_client, get_resource, [unchanged, changed], {"StateKey": "file#items.json", "ETag": '"old"', "ContentHash": "old", "ItemHashes": item_hashes})
+    changed_keys, counts, state = lambda_handlers.ingest_file("bucket", "items.json", "items", "ControlId")
+    assert changed_keys == ["CloudTrail.5", "GuardDuty.1"]
+    assert counts == {"added": 0, "updated": 1, "deleted": 1, "unchanged": 1}
+    dynamodb.scan.assert_not_called()
+    state_table.put_item.assert_not_called()
+    assert state["ETag"] == '"etag"'
+    assert state["ItemHashes"] == {"IAM.6": item_hashes["IAM.6"], "CloudTrail.5": lambda_handlers.item_hash(changed)}
+
+
+@patch.dict("os.environ", {"IngestStateDynamoDB": "ingest-state"})
+@patch("lambda_handlers.get_resource")
+@patch("lambda_handlers.get_client")
+def test_ingest_file_first_ingest(get_client, get_resource):
+    data = [{"ControlId": "IAM.6", "Disabled": ["ALL"], "DisabledReason": "We use virtual MFA"}]
+    s3, dynamodb, state_table = ingest_clients(get_client, get_resource, data, None)
+    dynamodb.scan.return_value = {"Items": []}
+    changed_keys, counts, state = lambda_handlers.ingest_file("bucket", "items.json", "items", "ControlId")
+    assert changed_keys == ["IAM.6"]
+    dynamodb.scan.assert_called_once_with(TableName="items")
+    assert "ItemHashes" in state
+
+
+@patch.dict("os.environ", {"IngestStateDynamoDB": "ingest-state", "ItemsDynamoDB": "items", "RegionsDynamoDB": "regions",
+                           "StateMachineArn": "state_machine_arn", "accounts_json_file": "accounts.json", "items_json_file": "items.json"})
+@patch("lambda_handlers.get_resource")
+@patch("lambda_handlers.get_client")
+def test_lambda_handler_saves_state_after_pending(get_client, get_resource):
+    """
+    The file state is only saved once the changes are recorded as pending, a retried event ingests the file again
+    """
+    data = [{"ControlId": "IAM.6", "Disabled": ["ALL"], "DisabledReason": "We use virtual MFA"}]
+    s3, dynamodb, state_table = ingest_clients(get_client, get_resource, data, {"StateKey": "file#items.json", "ETag": '"old"', "ContentHash": "old", "ItemHashes": {}})
+    s3.head_object.side_effect = lambda Bucket, Key: {"ETag": '"etag"' if Key == "items.json" else '"accounts"'}
+    state_table.get_item.side_effect = lambda Key: {"Item": {"ETag": '"accounts"'}} if Key["StateKey"] == "file#accounts.json" else {"Item": {"ETag": '"old"', "ContentHash": "old", "ItemHashes": {}}}
+    dynamodb.update_item.side_effect = RuntimeError("DynamoDB unavailable")
+    event = {"Records": [{"s3": {"bucket": {"name": "bucket"}}}]}
+    with pytest.raises(RuntimeError):
+        lambda_handlers.lambda_handler(event, None)
+    state_table.put_item.assert_not_called()
+
+    dynamodb.update_item.side_effect = None
+    dynamodb.list_executions.return_value = {"executions": [{"executionArn": "running"}]}
+    s3.get_object.return_value = {"Body": io.BytesIO(json.dumps(data).encode())}
+    assert lambda_handlers.lambda_handler(event, None)["statusCode"] == 202
+    assert state_table.put_item.call_args.kwargs["Item"]["ETag"] == '"etag"'
+
+
+@patch.dict("os.environ", {"IngestStateDynamoDB": "ingest-state"})
+@patch("lambda_handlers.get_resource")
+def test_save_file_states_item_size(get_resource):
+    """
+    A state exceeding the DynamoDB item size is saved without its item hashes
+    """
+    import botocore.exceptions
+    state_table = get_resource.return_value.Table.return_value
+    too_large = botocore.exceptions.ClientError(
+        {"Error": {"Code": "ValidationException", "Message": "Item size has exceeded the maximum allowed size"}}, "PutItem")
+    state_table.put_item.side_effect = [too_large, None]
+    lambda_handlers.save_file_states([{"StateKey": "file#accounts.json", "ETag": '"etag"', "ContentHash": "hash", "ItemHashes": {"111111111111": "hash"}}])
+    assert state_table.put_item.call_args.kwargs["Item"] == {"StateKey": "file#accounts.json", "ETag": '"etag"', "ContentHash": "hash"}
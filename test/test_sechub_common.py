@@ -0,0 +1,195 @@
+import io
+import json
+import pytest
+import botocore.config
+import botocore.session
+from botocore.awsrequest import AWSResponse
+from unittest.mock import patch, MagicMock
+import logging
+from sechub_common import init, logs, metrics
+from sechub_common.pagination import paginate, prefetch, scan_table
+
+
+def test_paginate():
+    method = MagicMock(side_effect=[{"Members": [1, 2], "NextToken": "token"}, {"Members": [3]}])
+    assert list(paginate(method, "Members", OnlyAssociated=True)) == [1, 2, 3]
+    assert method.call_args.kwargs == {"NextToken": "token", "OnlyAssociated": True}
+
+
+def test_scan_table():
+    client = MagicMock()
+    client.scan.side_effect = [{"Items": [1, 2], "LastEvaluatedKey": {"Id": 2}}, {"Items": [3]}]
+    assert list(scan_table(client, "table")) == [1, 2, 3]
+    assert client.scan.call_args.kwargs == {"TableName": "table", "ExclusiveStartKey": {"Id": 2}}
+
+
+def segmented_table(pages_per_segment):
+    def scan(TableName, Segment, TotalSegments, ExclusiveStartKey=None):
+        page = ExclusiveStartKey["Page"] if ExclusiveStartKey else 0
+        response = {"Items": ["{}-{}".format(Segment, page)]}
+        if page + 1 < pages_per_segment:
+            response["LastEvaluatedKey"] = {"Page": page + 1}
+        return response
+    client = MagicMock()
+    client.scan.side_effect = scan
+    return client
+
+
+def test_scan_table_segments():
+    items = list(scan_table(segmented_table(5), "table", segments=3))
+    assert sorted(items) == sorted("{}-{}".format(segment, page) for segment in range(3) for page in range(5))
+
+
+def test_scan_table_segments_early_stop():
+    items = scan_table(segmented_table(100), "table", segments=4)
+    assert len([item for _, item in zip(range(3), items)]) == 3
+    items.close()
+
+
+def test_scan_table_segments_error():
+    client = MagicMock()
+    client.scan.side_effect = ValueError("Scan failed")
+    with pytest.raises(ValueError):
+        list(scan_table(client, "table", segments=2))
+
+
+def test_prefetch():
+    fetched = []
+
+    def pages():
+        for page in range(5):
+            fetched.append(page)
+            yield page
+
+    assert list(prefetch(pages())) == [0, 1, 2, 3, 4]
+    # the producer stops when the consumer stops early
+    fetched.clear()
+    items = prefetch(pages(), buffered=1)
+    assert next(items) == 0
+    items.close()
+    assert len(fetched) <= 3
+
+
+def test_prefetch_error():
+    def pages():
+        yield 1
+        raise ValueError("Request failed")
+
+    with pytest.raises(ValueError):
+        list(prefetch(pages()))
+
+
+def test_preinit(monkeypatch):
+    monkeypatch.delenv("AWS_LAMBDA_FUNCTION_NAME", raising=False)
+    assert init.preinit("s3", "sts") == (None, None)
+
+    monkeypatch.setenv("AWS_LAMBDA_FUNCTION_NAME", "GetMembers")
+    with patch("boto3.client") as client, patch.dict(init._clients, clear=True):
+        s3, sts = init.preinit("s3", "sts")
+        # clients are shared by the container
+        assert init.get_client("s3") is s3
+    assert [call.args for call in client.call_args_list] == [("s3",), ("sts",)]
+
+
+def test_get_client_region():
+    with patch("boto3.client") as client, patch.dict(init._clients, clear=True):
+        client.side_effect = lambda service_name, region_name=None: MagicMock()
+        eu_west_1 = init.get_client("securityhub", "eu-west-1")
+        assert init.get_client("securityhub", "eu-west-1") is eu_west_1
+        assert init.get_client("securityhub", "us-east-1") is not eu_west_1
+    assert [call.kwargs["region_name"] for call in client.call_args_list] == ["eu-west-1", "us-east-1"]
+
+
+class RawResponse:
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+def test_instrument_client():
+    recorder = metrics.Metrics()
+    client = botocore.session.get_session().create_client(
+        "securityhub", region_name="us-east-1", aws_access_key_id="id", aws_secret_access_key="key",
+        config=botocore.config.Config(retries={"max_attempts": 2, "mode": "standard"}))
+    metrics.instrument_client(client, "111111111111", recorder)
+    responses = [
+        (429, {"__type": "TooManyRequestsException", "message": "Rate exceeded"}),
+        (200, {"StandardsSubscriptions": []}),
+        (403, {"__type": "AccessDeniedException", "message": "Denied"}),
+    ]
+
+    def send(request, **kwargs):
+        status, body = responses.pop(0)
+        return AWSResponse(request.url, status, {"x-amzn-ErrorType": body.get("__type", "")}, RawResponse(json.dumps(body).encode()))
+
+    client.meta.events.register("before-send", send)
+    with patch("time.sleep"):
+        client.get_enabled_standards()
+        with pytest.raises(client.exceptions.ClientError):
+            client.get_enabled_standards()
+    entry = recorder.api[("GetEnabledStandards", "111111111111", "us-east-1")]
+    assert entry["calls"] == 2
+    assert entry["retries"] == 1
+    assert entry["throttles"] == 1
+    assert entry["errors"] == 1
+    assert sum(entry["histogram"].values()) == 2
+
+
+def test_flush_metrics():
+    with patch.object(metrics, "metrics", metrics.Metrics()):
+        metrics.metrics.record_call("GetEnabledStandards", "111111111111", "us-east-1", 20.0)
+        metrics.metrics.record_call("GetEnabledStandards", "222222222222", "us-east-1", 40.0, retries=1)
+        with metrics.timed("get_controls", "111111111111", "us-east-1"):
+            pass
+        stream = io.StringIO()
+        summary = metrics.flush("UpdateMember", ["111111111111"], stream)
+        assert summary["calls"] == 1
+        assert list(summary["timers"]) == ["get_controls"]
+        lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+        assert lines[0]["Operation"] == "GetEnabledStandards"
+        assert lines[0]["_aws"]["CloudWatchMetrics"][0]["Dimensions"] == [["Function", "Operation"]]
+        assert lines[1]["Timer"] == "get_controls"
+        # entries of other accounts are kept for the next flush
+        assert metrics.flush("UpdateMember", stream=stream)["retries"] == 1
+
+    total = metrics.merge_summaries({}, summary)
+    metrics.merge_summaries(total, summary)
+    assert total["calls"] == 2
+    assert total["max_latency_ms"] == 20.0
+
+
+def test_json_formatter_and_truncation():
+    record = logging.LogRecord("root", logging.INFO, "index.py", 1, "Event: %s", ("x" * 50,), None)
+    record.account = "111111111111"
+    logs.TruncatingFilter(20).filter(record)
+    entry = json.loads(logs.JsonFormatter().format(record))
+    assert entry["level"] == "INFO"
+    assert entry["message"] == "Event: " + "x" * 13 + "... (37 more characters)"
+    assert entry["account"] == "111111111111"
+
+
+def test_sampling_filter():
+    sampling = logs.SamplingFilter(first=2, every=3)
+
+    def record(key=None):
+        record = logging.LogRecord("root", logging.INFO, "index.py", 1, "line", (), None)
+        if key:
+            record.sample_key = key
+        return record
+
+    assert [sampling.filter(record("control_update")) for _ in range(8)] == [True, True, False, False, True, False, False, True]
+    assert sampling.filter(record())
+    assert sampling.reset() == {"control_update": 4}
+    assert sampling.filter(record("control_update"))
+
+
+def test_summarize():
+    event = {"account": "111111111111", "exceptions": {"Control.{}".format(number): {"Disabled": ["ALL"]} for number in range(100)}}
+    summary = logs.summarize(event)
+    assert summary["account"] == "111111111111"
+    assert len(summary["exceptions"]) == logs.SUMMARY_ITEMS + 1
+    assert summary["exceptions"]["..."] == "95 more keys"
+    assert summary["exceptions"]["Control.0"] == "<1 keys>"
+    assert logs.summarize(list(range(7))) == [0, 1, 2, 3, 4, "... 2 more items"]